@@ -1,16 +1,14 @@
 """ taken from our solution to TP6, with the addition of the Skinned class from TP7 """
 
 # Python built-in modules
-from bisect import bisect, bisect_left      # search sorted keyframe lists
+from bisect import bisect_left     # search sorted keyframe lists
 
 # External, non built-in modules
-import OpenGL.GL as GL              # standard Python OpenGL wrapper
-import glfw                         # lean window system wrapper for OpenGL
 import numpy as np                  # all matrix manipulations & OpenGL args
 
 from core import Node
 from transform import (lerp, quaternion_slerp, quaternion_matrix, translate,
-                       scale, identity)
+                       scale, identity, transform_box, union_box)
 
 
 # -------------- Keyframing Utilities TP6 ------------------------------------
@@ -73,14 +71,30 @@ class KeyFrameControlNode(Node):
             if times[-1] > self.duration:
                 self.duration = times[-1]
 
-    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
+    def animate(self, frame):
+        """ interpolate our node transform from keys at the frame time """
+        profiler = frame.profiler
+        if profiler:
+            profiler.begin('keyframes')
+        self.transform = self.keyframes.value(frame.time % self.duration)
+        if profiler:
+            profiler.end()
+
+    def traverse(self, frame, visit, model=identity()):
         """ When redraw requested, interpolate our node transform from keys """
-        self.transform = self.keyframes.value(glfw.get_time() % self.duration)
-        super().draw(primitives=primitives, **uniforms)
+        self.animate(frame)
+        super().traverse(frame, visit, model)
+
+    def update_subtree(self, frame, model=identity()):
+        """ Keep animating while culled, e.g. for bones of skinned meshes """
+        self.animate(frame)
+        super().update_subtree(frame, model)
 
 
 class Skinned:
     """ Skinned mesh decorator, passes bone world transforms to shader """
+    static = False  # bounds follow the bones
+
     def __init__(self, mesh, bone_nodes, bone_offsets):
         self.mesh = mesh
 
@@ -88,10 +102,19 @@ class Skinned:
         self.bone_nodes = bone_nodes
         self.bone_offsets = np.array(bone_offsets, np.float32)
 
-    def draw(self, **uniforms):
+    def world_bounds(self, model=None):
+        """ skinned vertices are weighted averages of the vertex transformed by its bones,
+            so the union of the mesh bounds transformed by every bone contains them all """
+        bounds = getattr(self.mesh, 'bounds', None)
+        if bounds is None:
+            return None
+        world_transforms = [node.world_transform for node in self.bone_nodes]
+        return union_box(transform_box(world_transforms @ self.bone_offsets, bounds))
+
+    def draw(self, frame, model, **uniforms):
         world_transforms = [node.world_transform for node in self.bone_nodes]
         uniforms['bone_matrix'] = world_transforms @ self.bone_offsets
-        self.mesh.draw(**uniforms)
+        self.mesh.draw(frame, model, **uniforms)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+""" asset lookup: indexed file names of asset directories and textures shared between users
+
+    Models refer to their textures by names that rarely match the files on disk
+    (paths of the artist's machine, other extensions...). An AssetIndex lists the
+    files below an asset directory once, file name -> paths, so that such names
+    resolve with a dictionary lookup instead of walking the whole directory. The
+    index is saved in the cache directory and rebuilt when the modification time
+    of one of its directories changes, i.e. when files were added, removed or renamed.
+
+    Textures of image files are shared through a registry: every file is decoded
+    and uploaded once for all the meshes, models and loads that use it. Images of
+    the same size and format become layers of one texture array, so that materials
+    drawn one after the other (see core.RenderQueue) share their texture bindings.
+
+        path = find_asset('assets/FantasyCharacters/Spider', 'Spider_diffuse.png')
+        diffuse_map = shared_texture(path)
+
+    Images can be decoded ahead of time, e.g. by a worker thread (see loader.py), and
+    given to shared_texture instead of their file, which then only uploads them.
+"""
+
+import bisect
+import json
+import os
+import tempfile
+import weakref
+
+import numpy as np
+
+from cache import CACHE_DIR, cache_key
+from texture import TextureArray, load_mipmaps
+
+
+class AssetIndex:
+    """ Names of the files below a root directory, see the module documentation """
+    def __init__(self, root, directory=CACHE_DIR):
+        self.root = os.path.abspath(root)
+        self.file = os.path.join(directory, 'assets-%s.json' % cache_key('asset index', root=self.root))
+        index = self.read() or self.build()
+        self.directories = index['directories']     # directory -> modification time when indexed
+        self.files = index['files']                 # file name -> paths relative to root, os.walk order
+        self.names = sorted(self.files)
+        self.order = {name: i for i, name in enumerate(self.files)}
+
+    def read(self):
+        """ saved index, None if there is none or one of its directories changed since """
+        try:
+            with open(self.file) as file:
+                index = json.load(file)
+            for path, mtime in index['directories'].items():
+                if os.stat(os.path.join(self.root, path)).st_mtime != mtime:
+                    return None
+        except (OSError, ValueError, KeyError):
+            return None
+        return index
+
+    def build(self):
+        """ walk the root directory and save its index """
+        index = dict(directories={}, files={})
+        for path, _, names in os.walk(self.root, followlinks=True):
+            relative = os.path.relpath(path, self.root)
+            index['directories'][relative] = os.stat(path).st_mtime
+            for name in names:
+                index['files'].setdefault(name, []).append(os.path.join(relative, name))
+
+        # written to a temporary file first so that readers never see half written indices
+        try:
+            os.makedirs(os.path.dirname(self.file), exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.file), prefix='.tmp-',
+                                             suffix='.json', delete=False) as file:
+                json.dump(index, file)
+            os.replace(file.name, self.file)
+        except OSError:     # the index then only lives in this process
+            pass
+        return index
+
+    def find(self, name):
+        """ path of the file called name, or else of the first file whose name starts with
+            name or is the start of name (e.g. other extensions), None if there is none """
+        paths = self.files.get(name)
+        if paths is None:
+            # names starting with name follow it in sorted order, names it starts with are its prefixes
+            candidates = [name[:length] for length in range(1, len(name)) if name[:length] in self.files]
+            start = bisect.bisect_left(self.names, name)
+            while start < len(self.names) and self.names[start].startswith(name):
+                candidates.append(self.names[start])
+                start += 1
+            if not candidates:
+                return None
+            paths = self.files[min(candidates, key=self.order.get)]
+        return os.path.normpath(os.path.join(self.root, paths[0]))
+
+
+# asset indices of the process, by root directory
+indices = {}
+
+
+def find_asset(root, name):
+    """ path of the file called name below the root directory, see AssetIndex.find """
+    root = os.path.abspath(root)
+    if root not in indices:
+        indices[root] = AssetIndex(root)
+    return indices[root].find(name)
+
+
+class DecodedImage:
+    """ Mip levels of an image file read ahead of its texture, see decode_textures. Given to
+        shared_texture instead of the file, they are uploaded unless its texture already exists,
+        and freed with this object rather than kept for a texture that may never be created. """
+    def __init__(self, tex_file):
+        self.file = tex_file
+        self.levels = [np.array(level) for level in load_mipmaps(tex_file)]
+
+
+class TextureRegistry:
+    """ Textures of image files by file and texture parameters, each being a layer of the texture
+        array of the images with its size, format and parameters. The registry only keeps weak
+        references: a texture is counted as used as long as a drawable refers to it, and its layer
+        is released for another image once the last one is gone, arrays being deleted with their
+        last layer. """
+    def __init__(self):
+        self.textures = weakref.WeakValueDictionary()
+        self.arrays = weakref.WeakValueDictionary()     # (image shape, texture parameters) -> TextureArray
+
+    def get(self, tex_file, **params):
+        """ texture (TextureLayer) of an image file or DecodedImage, loaded unless a user of
+            the same texture exists """
+        image = tex_file if isinstance(tex_file, DecodedImage) else None
+        path = os.path.realpath(tex_file if image is None else image.file)
+        key = (path, tuple(sorted(params.items())))
+        texture = self.textures.get(key)
+        if texture is None:
+            levels = load_mipmaps(tex_file) if image is None else image.levels
+            array_key = (levels[0].shape, key[1])
+            array = self.arrays.get(array_key)
+            if array is None:
+                array = self.arrays[array_key] = TextureArray(capacity=4, **params)
+            texture = self.textures[key] = array.add(levels)
+        return texture
+
+    def __len__(self):
+        return len(self.textures)
+
+
+# textures of the process, the GL context being shared by the whole viewer
+textures = TextureRegistry()
+
+
+def shared_texture(tex_file, **params):
+    """ texture of an image file or DecodedImage, shared with every other user of it, see TextureRegistry """
+    return textures.get(tex_file, **params)
+
+
+def decode_textures(*tex_files):
+    """ DecodedImage of every image file, to be given to shared_texture instead of the files.
+        Does not need the GL context, e.g. to decode images on a worker thread """
+    return [DecodedImage(tex_file) for tex_file in tex_files]
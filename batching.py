@@ -0,0 +1,116 @@
+""" static batching: meshes that never move merged into a few large ones
+
+    A StaticBatch replaces a scene graph subtree, e.g. a model returned by
+    core.load. The vertices of its static meshes are transformed into the space
+    of the subtree root, then meshes sharing shader, textures and uniforms are
+    merged into one vertex array drawn with a single draw call. Animated nodes,
+    skinned or otherwise special drawables are kept as they are.
+    The original subtree is kept untouched as the source of the batch, it can be
+    put back in place to be edited and batched again:
+
+        batch = StaticBatch(model)
+        parent.replace(model, batch)
+        ...
+        parent.replace(batch, batch.unbatch())
+"""
+
+import OpenGL.GL as GL
+import numpy as np
+
+from core import Mesh, Node
+from texture import Textured
+from transform import identity
+
+
+def batchable(drawable):
+    """ (mesh, textures) of a plain static mesh, optionally textured, drawn as indexed or non
+        indexed triangles, None if the drawable does anything else when drawn """
+    textures = {}
+    if isinstance(drawable, Textured) and type(drawable).draw is Textured.draw:
+        drawable, textures = drawable.drawable, drawable.textures
+    if not isinstance(drawable, Mesh) or type(drawable).draw is not Mesh.draw or not drawable.static:
+        return None
+    index = drawable.vertex_array.index
+    if drawable.primitives != GL.GL_TRIANGLES or (index is not None and (
+            index.restart is not None or index.ranges != [(index.size, 0)])):
+        return None
+    return drawable, textures
+
+
+def batch_key(mesh, textures):
+    """ meshes with the same key render identically and can be merged """
+    uniforms = tuple(sorted((name, np.asarray(value).tobytes()) for name, value in mesh.uniforms.items()))
+    layout = tuple(sorted((name, layout[1:3]) for name, layout in mesh.vertex_array.layout.items()))
+    return mesh.shader, tuple(textures.items()), uniforms, layout
+
+
+def merge(meshes):
+    """ attributes and index of (mesh, transform) pairs merged into one triangle mesh,
+        positions, normals and tangents being transformed """
+    attributes, indices, offset = {}, [], 0
+    for mesh, transform in meshes:
+        vertex_array = mesh.vertex_array
+        linear = transform[:3, :3]
+        for name in vertex_array.layout:
+            data = vertex_array.read_attribute(name)
+            if name == 'position':
+                data = data @ linear.T + transform[:3, 3]
+            elif name in ('normal', 'tangent'):
+                # normals transform with the inverse transpose, tangents like positions. They are not
+                # normalized, the shader then gets exactly what the whole transform chain would give
+                data = data @ (np.linalg.inv(linear) if name == 'normal' else linear.T)
+            attributes.setdefault(name, []).append(data)
+
+        count = vertex_array.arguments[1]
+        index = np.arange(count) if vertex_array.index is None else vertex_array.index.read()
+        indices.append(index.astype(np.uint32) + offset)
+        offset += count
+
+    attributes = {name: np.concatenate(data).astype(np.float32) for name, data in attributes.items()}
+    return attributes, np.concatenate(indices)
+
+
+class StaticBatch(Node):
+    """ Node drawing a subtree with its static meshes merged, in place of the subtree.
+        The subtree (source) is kept as it is, see unbatch. """
+    def __init__(self, source):
+        super().__init__(transform=source.transform)
+        self.source = source
+
+        # static meshes grouped by render state, the rest is kept below nodes with the same relative transform
+        groups, kept = {}, []
+        self.collect(source, identity(), groups, kept)
+
+        for (shader, textures, _, _), meshes in groups.items():
+            attributes, index = merge(meshes)
+            mesh = Mesh(shader, attributes, uniforms=dict(meshes[0][0].uniforms), index=index)
+            self.add(Textured(mesh, **dict(textures)) if textures else mesh)
+        for transform, children in kept:
+            if np.array_equal(transform, identity()):
+                self.add(*children)
+            else:
+                self.add(Node(children, transform))
+        self.batched = sum(len(meshes) for meshes in groups.values())
+
+    def collect(self, node, transform, groups, kept):
+        """ sort the children of node (relative transform to the source root given) into mesh groups
+            and kept children. Only plain nodes keep the transform they are created with. """
+        others = []
+        for child in node.children:
+            if isinstance(child, Node):
+                if type(child) is Node and child.is_static():
+                    self.collect(child, transform @ child.transform, groups, kept)
+                else:
+                    others.append(child)
+                continue
+            mesh_textures = batchable(child)
+            if mesh_textures is None:
+                others.append(child)
+            else:
+                groups.setdefault(batch_key(*mesh_textures), []).append((mesh_textures[0], transform))
+        if others:
+            kept.append((transform, others))
+
+    def unbatch(self):
+        """ the original subtree, e.g. to be edited then put back instead of the batch """
+        return self.source
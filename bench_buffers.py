@@ -0,0 +1,149 @@
+""" microbenchmark of the vertex buffer update strategies of VertexArray
+
+    A grid of CPU animated water vertices is updated and drawn every frame with
+    each strategy: recreating the vertex array, glBufferSubData of all or part
+    of the vertices, orphaning, and a ring of buffer segments with fences.
+    With Mesa, the llvmpipe software rasteriser is forced by an environment
+    variable; uploads and draws then compete for the same CPU cores.
+    The GL context is that of a hidden window, which needs a display server,
+    unless --headless renders offscreen (see offscreen.py), e.g. in CI:
+
+        LIBGL_ALWAYS_SOFTWARE=1 python bench_buffers.py --headless [--grid-size 256] [--frames 200]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# PyOpenGL picks its platform when imported, offscreen contexts need EGL (or OSMesa) instead of GLX
+if '--headless' in sys.argv:
+    os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+
+import OpenGL.GL as GL
+import glfw
+import numpy as np
+
+from core import Shader, VertexArray
+from grid import grid_positions, grid_index_buffer
+from offscreen import create_context, Framebuffer
+
+VERTEX_SHADER = """#version 330 core
+uniform mat4 transform;
+in vec3 position;
+void main() {
+    gl_Position = transform * vec4(position, 1);
+}"""
+
+FRAGMENT_SHADER = """#version 330 core
+out vec4 out_color;
+void main() {
+    out_color = vec4(0.2, 0.4, 0.8, 1);
+}"""
+
+# name -> (vertex array arguments, update arguments), None for recreating the vertex array
+STRATEGIES = {
+    'recreate':       None,
+    'subdata':        (dict(usage=GL.GL_DYNAMIC_DRAW), dict()),
+    'subdata 1/8':    (dict(usage=GL.GL_DYNAMIC_DRAW), dict(part=8)),
+    'orphan':         (dict(usage=GL.GL_STREAM_DRAW), dict(orphan=True)),
+    'ring 3 frames':  (dict(usage=GL.GL_STREAM_DRAW, frames=3), dict()),
+}
+
+
+def water_frames(grid_size, count=8):
+    """ positions of a few frames of waves on a grid_size x grid_size grid, computed ahead
+        of time so that only buffer updates and draws are measured """
+    positions = grid_positions(grid_size, grid_size, spacing=2 / grid_size)
+    frames = []
+    for time_ in np.linspace(0, 2 * np.pi, count, endpoint=False):
+        frame = positions.copy()
+        frame[:, 2] = 0.05 * np.sin(8 * frame[:, 0] + time_) * np.cos(6 * frame[:, 1] + time_)
+        frames.append(frame)
+    return frames
+
+
+def run(name, shader, frames, grid_size, count):
+    """ time count frames of one strategy, returns per frame CPU times and the total time
+        until the GPU is done, in seconds """
+    index = grid_index_buffer(grid_size, grid_size)
+    strategy = STRATEGIES[name]
+    vertex_array = None
+    if strategy is not None:
+        vertex_array = VertexArray(shader, {'position': frames[0]}, index, **strategy[0])
+    update = dict(strategy[1]) if strategy else {}
+    part = update.pop('part', 1)
+    rows = len(frames[0]) // part
+
+    GL.glUseProgram(shader.glid)
+    shader.set_uniforms({'transform': np.identity(4)})
+    GL.glFinish()
+
+    times = []
+    start = time.perf_counter()
+    for i in range(count):
+        frame_start = time.perf_counter()
+        positions = frames[i % len(frames)]
+        if strategy is None:
+            vertex_array = VertexArray(shader, {'position': positions}, index)
+        else:
+            # partial updates move a band of vertices across the grid
+            first = (i % part) * rows
+            vertex_array.update({'position': positions[first:first + rows]}, first, **update)
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT)
+        vertex_array.execute(GL.GL_TRIANGLES)
+        GL.glFlush()
+        times.append(time.perf_counter() - frame_start)
+    GL.glFinish()
+    return np.array(times), time.perf_counter() - start
+
+
+def benchmark(grid_size=256, count=200, strategies=STRATEGIES):
+    """ run all strategies in the current GL context and print their timings """
+    shader = Shader(VERTEX_SHADER, FRAGMENT_SHADER)
+    frames = water_frames(grid_size)
+    megabytes = frames[0].nbytes / 1024**2
+    print('%s, %d vertices (%.1f MiB of positions), %d frames' %
+          (GL.glGetString(GL.GL_RENDERER).decode(), len(frames[0]), megabytes, count))
+    print('%-16s %10s %10s %10s %12s' % ('strategy', 'mean ms', 'median ms', 'p95 ms', 'total ms'))
+    results = {}
+    for name in strategies:
+        run(name, shader, frames, grid_size, 10)    # warm up
+        times, total = run(name, shader, frames, grid_size, count)
+        results[name] = (times, total)
+        print('%-16s %10.2f %10.2f %10.2f %12.1f' % (name, times.mean() * 1e3, np.median(times) * 1e3,
+                                                     np.percentile(times, 95) * 1e3, total * 1e3))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--grid-size', type=int, default=256)
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--headless', action='store_true', help='render offscreen, without a display server')
+    args = parser.parse_args()
+
+    if args.headless:
+        context = create_context()
+        framebuffer = Framebuffer(256, 256)
+        benchmark(args.grid_size, args.frames)
+        del framebuffer
+        context.close()
+        return
+
+    # hidden window, only used for its GL context
+    glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
+    glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
+    glfw.window_hint(glfw.OPENGL_FORWARD_COMPAT, GL.GL_TRUE)
+    glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+    glfw.window_hint(glfw.VISIBLE, False)
+    window = glfw.create_window(256, 256, 'bench_buffers', None, None)
+    glfw.make_context_current(window)
+    glfw.swap_interval(0)
+
+    benchmark(args.grid_size, args.frames)
+    glfw.destroy_window(window)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+""" reproducible rendering benchmark of the viewer.py scene
+
+    The scene is rendered headless (see offscreen.py) along scripted camera paths, with a
+    fixed clock and waiting for the GPU at the end of every frame. For every path, the frame
+    time percentiles and per frame counts (draw calls, triangles, uniform uploads, bytes of
+    uniforms, buffers and textures uploaded) are written to a JSON file, along with the time
+    spent in every startup phase. By default the scene is the original one, with the full
+    resolution ground and the water sheet, the level of detail modes are scene parameters.
+
+        python benchmark.py run --frames 300 --output results.json
+        python benchmark.py run --sweep grid_size=256,512,1024 --output sweep.json
+        python benchmark.py run --sweep ground=full,clipmap --water projected --output lod.json
+        python benchmark.py compare base.json results.json --threshold 0.1
+
+    A sweep runs the benchmark for every value of a scene parameter, each in its own process
+    so that startup phases are measured from scratch. Comparing two result files lists the
+    metrics of matching runs that got worse by more than the threshold, and exits with
+    status 1 if any did. With Mesa, LIBGL_ALWAYS_SOFTWARE=1 selects the software rasteriser.
+"""
+
+import argparse
+import ctypes
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+# headless rendering needs the EGL platform, selected before OpenGL is imported
+os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+
+import OpenGL.GL as GL
+import numpy as np
+
+from core import Viewer
+from transform import Trackball, quaternion_from_euler, quaternion_from_axis_angle, quaternion_mul
+from viewer import build_scene
+
+# camera path name -> keys of (path fraction, heading, elevation, distance, lift) of the trackball
+# orbiting the bridge at the origin. Angles are in degrees, a negative elevation looks down.
+# The camera is lifted along its up axis by panning, e.g. to look up from above the bridge
+CAMERA_PATHS = {
+    # close to the bridge and the spiders, turning around them
+    'bridge': [(0, 0, -20, 12, 0), (0.5, 90, -10, 4, 0), (1, 180, -20, 12, 0)],
+    # wide views over the terrain, from high above to the horizon
+    'terrain': [(0, 0, -50, 200, 0), (0.5, 90, -25, 250, 0), (1, 180, -5, 300, 0)],
+    # looking up, the skybox covers almost every pixel
+    'skybox': [(0, 0, 45, 5, 10), (1, 360, 45, 5, 10)],
+}
+
+def choice(*values):
+    """ parser of a command line value that must be one of values """
+    def parse(value):
+        assert value in values, '%s is not one of %s' % (value, values)
+        return value
+    return parse
+
+
+def water_size(value):
+    """ vertices per side of the water sheet, or WIDTHxHEIGHT of the projected grid """
+    return tuple(int(n) for n in value.split('x')) if 'x' in value else int(value)
+
+
+# scene parameters of build_scene: name -> (default, parser of a command line value).
+# The default water size depends on the water mode, see viewer.WATER_SIZES
+PARAMETERS = {
+    'grid_size': (1024, int),
+    'ground': ('full', choice('full', 'clipmap', 'streaming')),
+    'water': ('sheet', choice('sheet', 'projected')),
+    'water_size': (None, water_size),
+    'crowd_size': (1, int),
+}
+
+# per frame counters of FrameContext.stats reported for every path
+COUNTERS = ('draw_calls', 'uniforms_issued', 'uniform_bytes', 'buffer_bytes', 'texture_bytes',
+            'program_binds', 'texture_binds')
+
+# metrics compared between runs, lower is better
+COMPARED = [('frame_ms', 'p50'), ('frame_ms', 'p95'), ('cpu_ms', 'p50'), ('cpu_ms', 'p95'),
+            ('draw_calls', 'mean'), ('triangles', 'mean'), ('uploaded_bytes', 'mean')]
+
+
+def place_camera(trackball, keys, fraction):
+    """ move the trackball to the camera path keys interpolated at fraction of the path """
+    keys = np.array(keys, np.float64)
+    heading, elevation, distance, lift = (np.interp(fraction, keys[:, 0], keys[:, i]) for i in range(1, 5))
+
+    # turn the world around its vertical axis, then look along x with z up like the viewer does
+    trackball.rotation = quaternion_mul(quaternion_from_euler(90, 90 + elevation),
+                                        quaternion_from_axis_angle((0, 0, 1), heading))
+    trackball.distance = distance
+    trackball.pos2d[:] = (0, -lift)
+
+
+def summary(values):
+    """ distribution of per frame values """
+    values = np.asarray(values, np.float64)
+    return dict(mean=values.mean(), p50=np.percentile(values, 50), p90=np.percentile(values, 90),
+                p95=np.percentile(values, 95), p99=np.percentile(values, 99), max=values.max())
+
+
+def run_path(viewer, keys, frames, fps):
+    """ render frames along a camera path, returns the summary of every metric """
+    query, triangles = int(GL.glGenQueries(1)[0]), ctypes.c_uint()
+    samples = {name: [] for name in ('frame_ms', 'cpu_ms', 'triangles', 'uploaded_bytes') + COUNTERS}
+    for i in range(frames):
+        place_camera(viewer.trackball, keys, i / max(1, frames - 1))
+        start = time.perf_counter()
+        GL.glBeginQuery(GL.GL_PRIMITIVES_GENERATED, query)
+        viewer.draw_frame(i / fps, viewer.framebuffer.size)
+        GL.glEndQuery(GL.GL_PRIMITIVES_GENERATED)
+        samples['cpu_ms'].append((time.perf_counter() - start) * 1e3)
+        GL.glFinish()
+        samples['frame_ms'].append((time.perf_counter() - start) * 1e3)
+
+        GL.glGetQueryObjectuiv(query, GL.GL_QUERY_RESULT, ctypes.byref(triangles))
+        samples['triangles'].append(triangles.value)
+        for name in COUNTERS:
+            samples[name].append(viewer.frame.stats[name])
+        samples['uploaded_bytes'].append(sum(viewer.frame.stats[name] for name in
+                                             ('uniform_bytes', 'buffer_bytes', 'texture_bytes')))
+    GL.glDeleteQueries(1, [query])
+    return {name: summary(values) for name, values in samples.items()}
+
+
+def benchmark(params, size=(1280, 720), frames=300, fps=60, warmup=10, paths=CAMERA_PATHS):
+    """ build the scene with the given parameters in a headless viewer, then render every
+        camera path. Returns the run results: parameters, startup phases and path metrics """
+    phases = {}
+    start = time.perf_counter()
+    viewer = Viewer(*size, trackball=Trackball(), headless=True)
+    phases['context'] = time.perf_counter() - start
+    build_scene(viewer, phases=phases, **params)
+
+    # the first frames compile shader variants, fill caches and the render queue
+    start = time.perf_counter()
+    place_camera(viewer.trackball, paths[next(iter(paths))], 0)
+    viewer.draw_frame(0., viewer.framebuffer.size)
+    GL.glFinish()
+    phases['first_frame'] = time.perf_counter() - start
+    for i in range(warmup):
+        viewer.draw_frame(i / fps, viewer.framebuffer.size)
+    GL.glFinish()
+
+    results = dict(params={name: list(value) if isinstance(value, tuple) else value
+                           for name, value in params.items()},
+                   startup_ms={name: seconds * 1e3 for name, seconds in phases.items()}, paths={})
+    for name, keys in paths.items():
+        results['paths'][name] = run_path(viewer, keys, frames, fps)
+        print('%-8s frame p50 %7.2f ms, p95 %7.2f ms, %5d draw calls, %8d triangles' % (
+            name, results['paths'][name]['frame_ms']['p50'], results['paths'][name]['frame_ms']['p95'],
+            results['paths'][name]['draw_calls']['mean'], results['paths'][name]['triangles']['mean']))
+    results['gl'] = dict(renderer=GL.glGetString(GL.GL_RENDERER).decode(),
+                         version=GL.glGetString(GL.GL_VERSION).decode())
+    viewer.close()
+    return results
+
+
+def sweep(args, name, values):
+    """ run the benchmark for every value of a scene parameter, each in a new process """
+    runs = []
+    for value in values.split(','):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'run.json')
+            command = [sys.executable, os.path.abspath(__file__), 'run', '--output', output,
+                       '--frames', str(args.frames), '--fps', str(args.fps), '--warmup', str(args.warmup),
+                       '--size', *map(str, args.size), '--paths', *args.paths]
+            for parameter in PARAMETERS:
+                if parameter != name and getattr(args, parameter) is not None:
+                    command += ['--' + parameter.replace('_', '-'), getattr(args, parameter)]
+            command += ['--' + name.replace('_', '-'), value]
+            print('%s = %s' % (name, value))
+            subprocess.run(command, check=True)
+            with open(output) as file:
+                runs.extend(json.load(file)['runs'])
+    return runs
+
+
+def run(args):
+    """ run the benchmark, or a sweep of a parameter, and save the results """
+    if args.sweep:
+        name, values = args.sweep.split('=')
+        assert name in PARAMETERS, 'unknown scene parameter %s, not in %s' % (name, list(PARAMETERS))
+        runs = sweep(args, name, values)
+    else:
+        params = {name: default if getattr(args, name) is None else parse(getattr(args, name))
+                  for name, (default, parse) in PARAMETERS.items()}
+        paths = {name: CAMERA_PATHS[name] for name in args.paths}
+        runs = [benchmark(params, args.size, args.frames, args.fps, args.warmup, paths)]
+
+    results = dict(date=time.strftime('%Y-%m-%d %H:%M:%S'), python=platform.python_version(),
+                   machine=platform.platform(), size=args.size, frames=args.frames, fps=args.fps, runs=runs)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=1)
+    print('results saved to', args.output)
+
+
+def compare(args):
+    """ compare the runs of two result files with the same parameters, returns the exit status """
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+
+    regressions = 0
+    for new_run in new['runs']:
+        base_run = next((run for run in base['runs'] if run['params'] == new_run['params']), None)
+        print('--- %s' % ', '.join('%s=%s' % item for item in new_run['params'].items()))
+        if base_run is None:
+            print('no run with these parameters in', args.base)
+            continue
+        rows = [('startup', 'total ms', sum(base_run['startup_ms'].values()), sum(new_run['startup_ms'].values()))]
+        for path, metrics in new_run['paths'].items():
+            if path in base_run['paths']:
+                rows += [(path, '%s %s' % metric, base_run['paths'][path][metric[0]][metric[1]],
+                          metrics[metric[0]][metric[1]]) for metric in COMPARED]
+        for path, metric, old, value in rows:
+            change = (value - old) / old if old else (0. if value == old else np.inf)
+            regression = change > args.threshold
+            regressions += regression
+            print('%-8s %-20s %12.2f %12.2f %+8.1f%% %s' % (path, metric, old, value, 100 * change,
+                                                          'REGRESSION' if regression else ''))
+    print('%d regressions above %.0f%%' % (regressions, 100 * args.threshold))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='benchmark the scene')
+    run_parser.add_argument('--output', default='benchmark.json')
+    run_parser.add_argument('--frames', type=int, default=300, help='frames per camera path')
+    run_parser.add_argument('--fps', type=float, default=60, help='frame rate of the animation clock')
+    run_parser.add_argument('--warmup', type=int, default=10, help='frames drawn before measuring')
+    run_parser.add_argument('--size', type=int, nargs=2, default=(1280, 720), metavar=('WIDTH', 'HEIGHT'))
+    run_parser.add_argument('--paths', nargs='+', default=list(CAMERA_PATHS), choices=list(CAMERA_PATHS))
+    for name, (default, _) in PARAMETERS.items():
+        run_parser.add_argument('--' + name.replace('_', '-'), help='scene parameter, %s by default' % (
+            'set by the water mode' if default is None else default,))
+    run_parser.add_argument('--sweep', metavar='NAME=V1,V2,...', help='run every value of a scene parameter, '
+                            'water_size values of the projected water are given as WIDTHxHEIGHT')
+
+    compare_parser = commands.add_parser('compare', help='flag regressions between two result files')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='relative increase flagged')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+""" persistent, content-addressed on-disk cache of numpy arrays
+
+    Every entry is a directory named after the hash of the parameters that
+    produced its arrays, holding one .npy file per array. Entries are read
+    back as memory maps, so a warm start neither recomputes nor copies them.
+    The cache is capped in size, least recently used entries are evicted.
+
+    Usage: python cache.py {info,clear,warm,bake} [options]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache'))
+MAX_BYTES = 2 * 1024**3
+
+
+def cache_key(kind, **params):
+    """ content address of an entry: hash of its kind and generating parameters.
+        Numbers are compared by value, e.g. an amplitude of 20 or 20.0 gives the same key """
+    description = json.dumps(_normalized(dict(kind=kind, **params)), sort_keys=True)
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def _normalized(value):
+    # numbers (python or numpy, but not booleans) as floats, sequences as lists, recursively
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, float, np.number)):
+        return float(value)
+    if isinstance(value, dict):
+        return {key: _normalized(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_normalized(item) for item in value]
+    return value
+
+
+class ArrayCache:
+    """ Directory of entries, each entry a set of named arrays """
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """ dict of read-only memory mapped arrays of an entry, None if not cached """
+        path = self.path(key)
+        try:
+            arrays = {os.path.splitext(name)[0]: np.load(os.path.join(path, name), mmap_mode='r')
+                      for name in os.listdir(path) if name.endswith('.npy')}
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(path)  # entry modification time is its last use
+        return arrays
+
+    def put(self, key, **arrays):
+        """ store named arrays as a new entry, returns them memory mapped """
+        os.makedirs(self.directory, exist_ok=True)
+
+        # write to a temporary directory first so that readers never see half written entries
+        temp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        for name, array in arrays.items():
+            np.save(os.path.join(temp, name + '.npy'), array)
+        try:
+            os.rename(temp, self.path(key))
+        except OSError:  # another process stored the same entry in the meantime
+            shutil.rmtree(temp, ignore_errors=True)
+
+        self.evict(keep=key)
+        return self.get(key)
+
+    def get_or_create(self, key, create):
+        """ cached arrays of key, created by create() -> dict of arrays on a miss """
+        arrays = self.get(key)
+        if arrays is None:
+            arrays = self.put(key, **create())
+        return arrays
+
+    def entries(self):
+        """ list of (last use, size in bytes, key) of all entries, least recently used first """
+        entries = []
+        for key in os.listdir(self.directory) if os.path.isdir(self.directory) else ():
+            path = self.path(key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, key))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """ remove least recently used entries until the cache fits in max_bytes """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                shutil.rmtree(self.path(key), ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        for _, _, key in self.entries():
+            shutil.rmtree(self.path(key), ignore_errors=True)
+
+
+def main():
+    """ inspect, clear or pre-warm the cache from the command line """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--directory', default=CACHE_DIR)
+    parser.add_argument('--max-bytes', type=int, default=MAX_BYTES)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('info', help='list cached entries')
+    commands.add_parser('clear', help='remove all entries')
+    warm = commands.add_parser('warm', help='generate procedural ground maps ahead of time')
+    warm.add_argument('--grid-size', type=int, nargs='+', default=[1024])
+    warm.add_argument('--perlin-size', type=int, nargs=2, default=(16, 16))
+    warm.add_argument('--octaves', type=int, default=6)
+    warm.add_argument('--amplitude', type=float, default=20)
+    warm.add_argument('--seed', type=int, nargs='+', default=[0])
+    bake = commands.add_parser('bake', help='decode and mipmap the images of asset directories ahead of time')
+    bake.add_argument('directories', nargs='+')
+    args = parser.parse_args()
+
+    cache = ArrayCache(args.directory, args.max_bytes)
+    if args.command == 'info':
+        entries = cache.entries()
+        for _, size, key in entries:
+            print('%s %8.1f MiB' % (key, size / 1024**2))
+        print('%d entries, %.1f MiB' % (len(entries), sum(e[1] for e in entries) / 1024**2))
+    elif args.command == 'clear':
+        cache.clear()
+    elif args.command == 'warm':
+        from procedural import generate_ground_maps
+        for grid_size in args.grid_size:
+            for seed in args.seed:
+                generate_ground_maps(grid_size, tuple(args.perlin_size), args.amplitude,
+                                     octaves=args.octaves, seed=seed, cache=cache)
+                print('cached ground maps: grid size %d, seed %d' % (grid_size, seed))
+    elif args.command == 'bake':
+        from texture import IMAGE_EXTENSIONS, load_mipmaps
+        from utils import CUBE_FACES, load_cubemap_from_directory
+        for directory in args.directories:
+            for path, _, names in os.walk(directory, followlinks=True):
+                images = sorted(name for name in names if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+
+                # directories holding all the faces of a cube map, whose faces are no 2D textures
+                for extension in sorted({os.path.splitext(name)[1] for name in images}):
+                    faces = [face + extension for face in CUBE_FACES]
+                    if all(face in names for face in faces):
+                        load_cubemap_from_directory(path, format=extension[1:], cache=cache)
+                        print('cached cube map %s' % os.path.join(path, '*' + extension))
+                        images = [name for name in images if name not in faces]
+
+                for name in images:
+                    levels = load_mipmaps(os.path.join(path, name), cache=cache)
+                    print('cached texture %s: %dx%d, %d channels, %d levels' % (
+                        os.path.join(path, name), levels[0].shape[1], levels[0].shape[0],
+                        levels[0].shape[2], len(levels)))
+
+
+if __name__ == "__main__":
+    main()
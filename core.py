@@ -2,17 +2,28 @@
 
 # Python built-in modules
 import os                           # os function, i.e. checking file status
+import json                         # description of imported scenes
+import hashlib                      # content address of imported files
+import ctypes                       # raw pointer arrays for multi draw calls
 from itertools import cycle         # allows easy circular choice list
+from collections import Counter     # per frame statistics
 import atexit                       # launch a function at exit
 
 # External, non built-in modules
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
+from OpenGL import platform as gl_platform  # raw GL function pointers
 import glfw                         # lean window system wrapper for OpenGL
 import numpy as np                  # all matrix manipulations & OpenGL args
 import assimpcy                     # 3D resource loader
+from PIL import Image               # save headless renders
 
 # our transform functions
-from transform import Trackball, identity
+from transform import Trackball, Frustum, identity, bounding_box, transform_box, union_box
+from offscreen import create_context, Framebuffer
+from profiler import Profiler, count_upload, uploads
+from cache import ArrayCache, cache_key
+from assets import find_asset, shared_texture
+from texture import TEXTURE_UNITS
 
 # initialize and automatically terminate glfw on exit
 glfw.init()
@@ -58,85 +69,474 @@ class Shader:
         # get location, size & type for uniform variables using GL introspection
         self.uniforms = {}
         self.debug = debug
-        get_name = {int(k): str(k).split()[0] for k in self.GL_SETTERS.keys()}
         for var in range(GL.glGetProgramiv(self.glid, GL.GL_ACTIVE_UNIFORMS)):
             name, size, type_ = GL.glGetActiveUniform(self.glid, var)
             name = name.decode().split('[')[0]   # remove array characterization
-            args = [GL.glGetUniformLocation(self.glid, name), size]
-            # add transpose=True as argument for matrix types
-            if type_ in {GL.GL_FLOAT_MAT2, GL.GL_FLOAT_MAT3, GL.GL_FLOAT_MAT4}:
-                args.append(True)
+            location = GL.glGetUniformLocation(self.glid, name)
+            if location == -1:
+                continue    # member of a uniform block, set through its uniform buffer
+            self.uniforms[name] = Uniform(location, size, type_)
             if debug:
-                call = self.GL_SETTERS[type_].__name__
-                print(f'uniform {get_name[type_]} {name}: {call}{tuple(args)}')
-            self.uniforms[name] = (self.GL_SETTERS[type_], args)
-
-    def set_uniforms(self, uniforms):
-        """ set only uniform variables that are known to shader """
-        for name in uniforms.keys() & self.uniforms.keys():
-            set_uniform, args = self.uniforms[name]
-            set_uniform(*args, uniforms[name])
+                print(f'uniform {str(type_).split()[0]} {name}: '
+                      f'{self.uniforms[name].function}{(location, size)}')
+
+        # connect uniform blocks to the binding point of their shared uniform buffer
+        self.blocks = {}
+        for index in range(GL.glGetProgramiv(self.glid, GL.GL_ACTIVE_UNIFORM_BLOCKS)):
+            length, block_size = (ctypes.c_int(), ctypes.c_int())
+            GL.glGetActiveUniformBlockiv(self.glid, index, GL.GL_UNIFORM_BLOCK_NAME_LENGTH, length)
+            GL.glGetActiveUniformBlockiv(self.glid, index, GL.GL_UNIFORM_BLOCK_DATA_SIZE, block_size)
+            name = ctypes.create_string_buffer(length.value)
+            GL.glGetActiveUniformBlockName(self.glid, index, length.value, None, name)
+            name = name.value.decode()
+            binding, size = UNIFORM_BLOCKS[name][0], UniformBuffer.layout(name)[1]
+            assert block_size.value == size, 'uniform block %s does not match its std140 layout' % name
+            GL.glUniformBlockBinding(self.glid, index, binding)
+            self.blocks[name] = binding
+            if debug:
+                print(f'uniform block {name}: binding {binding}, {size} bytes')
+
+        # samplers start on the first unit of their texture target, see texture.TEXTURE_UNITS
+        program = GL.glGetIntegerv(GL.GL_CURRENT_PROGRAM)
+        GL.glUseProgram(self.glid)
+        for uniform in self.uniforms.values():
+            if uniform.type in SAMPLER_TARGETS:
+                uniform.set(TEXTURE_UNITS[SAMPLER_TARGETS[uniform.type]])
+        GL.glUseProgram(program)
+
+    def set_uniforms(self, uniforms, stats=None):
+        """ set only uniform variables that are known to shader, skipping the ones
+            whose value did not change. Uploads issued/skipped and bytes uploaded are counted in stats. """
+        issued = skipped = uploaded = 0
+        for name, value in uniforms.items():
+            uniform = self.uniforms.get(name)
+            if uniform is None:
+                continue
+            if uniform.set(value):
+                issued += 1
+                uploaded += len(uniform.value)
+            else:
+                skipped += 1
+        if stats is not None:
+            stats['uniforms_issued'] += issued
+            stats['uniforms_skipped'] += skipped
+            stats['uniform_bytes'] += uploaded
 
     def __del__(self):
         GL.glDeleteProgram(self.glid)  # object dies => destroy GL object
 
+
+class Uniform:
+    """ Uniform variable of a shader program. Keeps a shadow copy of the value last uploaded
+        to skip redundant uploads, and calls the GL setter through a raw function pointer with
+        a pointer to the array data, bypassing PyOpenGL's argument conversions.
+        The object last set is compared first, without converting it: like node transforms,
+        arrays must not be modified in place once set, a new array has to be set instead. """
+    def __init__(self, location, size, type_):
+        self.location, self.size, self.type = location, size, type_
+        self.function, self.dtype, self.components = self.GL_SETTERS[type_]
+        self.matrix = self.function.startswith('glUniformMatrix')
+        self.value = None   # bytes of the last uploaded value
+        self.source = None  # object the last uploaded value was set from
+
+        # matrices are given in row major order, hence the transpose argument
+        address = gl_platform.PLATFORM.getExtensionProcedure(self.function.encode())
+        arguments = (ctypes.c_int, ctypes.c_int) + ((ctypes.c_ubyte,) if self.matrix else ())
+        self.raw = ctypes.CFUNCTYPE(None, *arguments, ctypes.c_void_p)(address) if address else None
+
+    def set(self, value):
+        """ upload value unless it is the current one, returns whether it was uploaded """
+        if value is self.source:
+            return False
+        data = np.ascontiguousarray(value, self.dtype)
+        data_bytes = data.tobytes()
+        self.source = value
+        if data_bytes == self.value:
+            return False
+        self.value = data_bytes
+
+        # arrays may set fewer elements than declared, e.g. bone matrices
+        count = min(data.size // self.components, self.size)
+        arguments = (self.location, count) + ((True,) if self.matrix else ())
+        if self.raw is not None:
+            self.raw(*arguments, data.ctypes.data)
+        else:
+            getattr(GL, self.function)(*arguments, data)
+        return True
+
+    # setter function name, value type and number of values per element of every uniform type
     GL_SETTERS = {
-        GL.GL_UNSIGNED_INT:      GL.glUniform1uiv,
-        GL.GL_UNSIGNED_INT_VEC2: GL.glUniform2uiv,
-        GL.GL_UNSIGNED_INT_VEC3: GL.glUniform3uiv,
-        GL.GL_UNSIGNED_INT_VEC4: GL.glUniform4uiv,
-        GL.GL_FLOAT:      GL.glUniform1fv, GL.GL_FLOAT_VEC2:   GL.glUniform2fv,
-        GL.GL_FLOAT_VEC3: GL.glUniform3fv, GL.GL_FLOAT_VEC4:   GL.glUniform4fv,
-        GL.GL_INT:        GL.glUniform1iv, GL.GL_INT_VEC2:     GL.glUniform2iv,
-        GL.GL_INT_VEC3:   GL.glUniform3iv, GL.GL_INT_VEC4:     GL.glUniform4iv,
-        GL.GL_SAMPLER_1D: GL.glUniform1iv, GL.GL_SAMPLER_2D:   GL.glUniform1iv,
-        GL.GL_SAMPLER_3D: GL.glUniform1iv, GL.GL_SAMPLER_CUBE: GL.glUniform1iv,
-        GL.GL_FLOAT_MAT2: GL.glUniformMatrix2fv,
-        GL.GL_FLOAT_MAT3: GL.glUniformMatrix3fv,
-        GL.GL_FLOAT_MAT4: GL.glUniformMatrix4fv,
+        GL.GL_UNSIGNED_INT:      ('glUniform1uiv', np.uint32, 1),
+        GL.GL_UNSIGNED_INT_VEC2: ('glUniform2uiv', np.uint32, 2),
+        GL.GL_UNSIGNED_INT_VEC3: ('glUniform3uiv', np.uint32, 3),
+        GL.GL_UNSIGNED_INT_VEC4: ('glUniform4uiv', np.uint32, 4),
+        GL.GL_FLOAT:      ('glUniform1fv', np.float32, 1), GL.GL_FLOAT_VEC2: ('glUniform2fv', np.float32, 2),
+        GL.GL_FLOAT_VEC3: ('glUniform3fv', np.float32, 3), GL.GL_FLOAT_VEC4: ('glUniform4fv', np.float32, 4),
+        GL.GL_INT:        ('glUniform1iv', np.int32, 1),   GL.GL_INT_VEC2:   ('glUniform2iv', np.int32, 2),
+        GL.GL_INT_VEC3:   ('glUniform3iv', np.int32, 3),   GL.GL_INT_VEC4:   ('glUniform4iv', np.int32, 4),
+        GL.GL_SAMPLER_1D: ('glUniform1iv', np.int32, 1),   GL.GL_SAMPLER_2D: ('glUniform1iv', np.int32, 1),
+        GL.GL_SAMPLER_3D: ('glUniform1iv', np.int32, 1),   GL.GL_SAMPLER_CUBE: ('glUniform1iv', np.int32, 1),
+        GL.GL_SAMPLER_2D_ARRAY: ('glUniform1iv', np.int32, 1),
+        GL.GL_FLOAT_MAT2: ('glUniformMatrix2fv', np.float32, 4),
+        GL.GL_FLOAT_MAT3: ('glUniformMatrix3fv', np.float32, 9),
+        GL.GL_FLOAT_MAT4: ('glUniformMatrix4fv', np.float32, 16),
     }
 
 
+# texture target sampled by every sampler type
+SAMPLER_TARGETS = {GL.GL_SAMPLER_2D: GL.GL_TEXTURE_2D, GL.GL_SAMPLER_2D_ARRAY: GL.GL_TEXTURE_2D_ARRAY,
+                   GL.GL_SAMPLER_CUBE: GL.GL_TEXTURE_CUBE_MAP}
+
+# uniform blocks shared by all shader programs: name -> (binding point, member names and shapes).
+# FrameUniforms holds the camera and time of the frame. Shader stages reading any member of a block
+# declare all of it, with layout(std140, row_major) and the members in the same order.
+UNIFORM_BLOCKS = {
+    'FrameUniforms': (0, (('view', (4, 4)), ('rotation', (4, 4)), ('projection', (4, 4)),
+                          ('w_camera_position', (3,)), ('timer', ()))),
+}
+
+
+class UniformBuffer:
+    """ Uniform buffer object backing a std140 uniform block of UNIFORM_BLOCKS. Its values are
+        uploaded at once and bound to the block's binding point, where every shader program
+        declaring the block reads them, instead of setting them in each program separately. """
+    def __init__(self, name):
+        self.name = name
+        self.binding = UNIFORM_BLOCKS[name][0]
+        self.offsets, self.size = self.layout(name)
+        self.data = np.zeros(self.size // 4, np.float32)
+        self.glid = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.glid)
+        GL.glBufferData(GL.GL_UNIFORM_BUFFER, self.size, None, GL.GL_DYNAMIC_DRAW)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, 0)
+
+    @staticmethod
+    def layout(name):
+        """ std140 byte offsets and sizes of the (float) members of a block, and the block size:
+            scalars are 4 bytes, vec2 8, vec3 and vec4 are aligned on 16 bytes, mat4 are
+            stored as four vec4 rows (row_major) """
+        offsets, offset = {}, 0
+        for member, shape in UNIFORM_BLOCKS[name][1]:
+            size = 4 * int(np.prod(shape))
+            align = 16 if len(shape) == 2 or size > 8 else max(size, 4)
+            offset = -(-offset // align) * align
+            offsets[member] = (offset, size)
+            offset += size
+        return offsets, -(-offset // 16) * 16
+
+    def update(self, values):
+        """ upload the members found in values with a single call and bind the buffer """
+        for member, value in values.items():
+            if member in self.offsets:
+                offset, size = self.offsets[member]
+                self.data[offset // 4:(offset + size) // 4] = np.ravel(value)[:size // 4]
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, self.glid)
+        GL.glBufferSubData(GL.GL_UNIFORM_BUFFER, 0, self.size, self.data)
+        GL.glBindBuffer(GL.GL_UNIFORM_BUFFER, 0)
+        GL.glBindBufferBase(GL.GL_UNIFORM_BUFFER, self.binding, self.glid)
+
+    def __del__(self):
+        GL.glDeleteBuffers(1, [self.glid])
+
+
+class IndexBuffer:
+    """ Helper class to create and self destroy OpenGL index buffers.
+        Unlike the vertex buffers, an index buffer can be shared by several
+        vertex arrays, e.g. all grids of the same resolution. """
+    def __init__(self, index, restart=None, ranges=None, usage=GL.GL_STATIC_DRAW):
+        """ Index array of uint16 or (u)int32 values. restart is the optional
+            primitive restart index, ranges an optional list of
+            (count, base_vertex) pairs to draw the buffer several times. """
+        index = np.asarray(index)
+        if index.dtype != np.uint16:
+            # 16 bit indices when they fit, the largest value is left for primitive restart
+            small = restart is None and index.size and index.max() < np.iinfo(np.uint16).max
+            index = np.array(index, np.uint16 if small else np.uint32, copy=False)  # good format
+        self.type = {np.dtype(np.uint16): GL.GL_UNSIGNED_SHORT,
+                     np.dtype(np.uint32): GL.GL_UNSIGNED_INT}[index.dtype]
+        self.dtype = index.dtype
+        self.size = index.size
+        self.restart = restart
+        self.ranges = ranges or [(index.size, 0)]
+
+        # upload through the array target: binding an element buffer here
+        # would overwrite the index binding of whatever vertex array is bound
+        self.glid = GL.glGenBuffers(1)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.glid)
+        GL.glBufferData(GL.GL_ARRAY_BUFFER, index, usage)
+        count_upload('buffer', index.nbytes)
+
+        # arguments for a single glMultiDrawElementsBaseVertex call
+        counts, bases = zip(*self.ranges)
+        self.counts = np.array(counts, np.int32)
+        self.bases = np.array(bases, np.int32)
+        self.offsets = (ctypes.c_void_p * len(self.ranges))()
+
+    def read(self):
+        """ copy of the index array, read back from the GPU """
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.glid)
+        data = GL.glGetBufferSubData(GL.GL_ARRAY_BUFFER, 0, self.size * self.dtype.itemsize)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+        return np.frombuffer(data, self.dtype).copy()
+
+    def execute(self, primitive, instances=None, base_vertex=0):
+        """ draw the bound vertex array with this index buffer, optionally instanced,
+            with indices offset by base_vertex """
+        if self.restart is not None:
+            GL.glEnable(GL.GL_PRIMITIVE_RESTART)
+            GL.glPrimitiveRestartIndex(self.restart)
+        if instances is not None:
+            # there is no instanced multi draw, bands are drawn one after the other
+            for count, base in self.ranges:
+                GL.glDrawElementsInstancedBaseVertex(primitive, count, self.type, None, instances,
+                                                     base + base_vertex)
+        elif len(self.ranges) == 1 and self.ranges[0][1] + base_vertex == 0:
+            GL.glDrawElements(primitive, self.ranges[0][0], self.type, None)
+        else:
+            GL.glMultiDrawElementsBaseVertex(primitive, self.counts, self.type,
+                                             self.offsets, len(self.ranges),
+                                             self.bases + base_vertex)
+        if self.restart is not None:
+            GL.glDisable(GL.GL_PRIMITIVE_RESTART)
+
+    def __del__(self):  # object dies => kill GL buffer from GPU
+        GL.glDeleteBuffers(1, [self.glid])
+
+
+# vertex attribute formats: name -> (GL type, numpy type). Integer formats are read as integers
+# by the shader (glVertexAttribIPointer), int_2_10_10_10 packs up to 3 normalized components in 32 bits
+VERTEX_FORMATS = {
+    'float32': (GL.GL_FLOAT, np.float32),
+    'float16': (GL.GL_HALF_FLOAT, np.float16),
+    'int_2_10_10_10': (GL.GL_INT_2_10_10_10_REV, np.uint32),
+    'uint8': (GL.GL_UNSIGNED_BYTE, np.uint8),
+    'uint16': (GL.GL_UNSIGNED_SHORT, np.uint16),
+}
+INTEGER_ATTRIBUTES = {'bone_ids'}
+UNIT_ATTRIBUTES = {'normal', 'tangent'}
+
+
+def vertex_format(name, data, dynamic=False):
+    """ most compact format storing the values of attribute name exactly, except for
+        unit vectors which are packed in 32 bits. Values of dynamic attributes are
+        to be updated, so they are not known to fit in half floats. """
+    if name in INTEGER_ATTRIBUTES:
+        return 'uint8' if data.max(initial=0) < 2**8 else 'uint16'
+    if name in UNIT_ATTRIBUTES and data.shape[1] <= 3 and np.abs(data).max(initial=0) <= 1:
+        return 'int_2_10_10_10'
+    exact = not dynamic and np.array_equal(data.astype(np.float16), data)
+    return 'float16' if exact else 'float32'
+
+
+def encode_attribute(data, format_):
+    """ (vertices, bytes) uint8 array of the attribute values in the given format,
+        padded so that every attribute starts 4 bytes aligned """
+    if format_ == 'int_2_10_10_10':
+        components = np.round(np.clip(data, -1, 1) * 511).astype(np.int64) & 0x3FF
+        packed = sum(components[:, i] << (10 * i) for i in range(data.shape[1]))
+        return packed.astype(np.uint32).reshape(-1, 1).view(np.uint8)
+    data = np.ascontiguousarray(data, VERTEX_FORMATS[format_][1]).view(np.uint8)
+    return np.pad(data, ((0, 0), (0, -data.shape[1] % 4)))
+
+
+def decode_attribute(data, format_, components):
+    """ float32 (vertices, components) values of an attribute from its encoded bytes """
+    if format_ == 'int_2_10_10_10':
+        packed = np.ascontiguousarray(data[:, :4]).view(np.uint32)
+        values = (packed >> (10 * np.arange(components, dtype=np.uint32))) & 0x3FF
+        values = values.astype(np.int32) - np.where(values >= 512, 1024, 0)
+        return np.maximum(values / 511, -1).astype(np.float32)
+    dtype = VERTEX_FORMATS[format_][1]
+    values = np.ascontiguousarray(data[:, :components * np.dtype(dtype).itemsize]).view(dtype)
+    return values.astype(np.float32)
+
+
 class VertexArray:
-    """ helper class to create and self destroy OpenGL vertex array objects."""
-    def __init__(self, shader, attributes, index=None, usage=GL.GL_STATIC_DRAW):
+    """ helper class to create and self destroy OpenGL vertex array objects.
+        Attributes are stored in compact formats (see vertex_format), interleaved in one buffer
+        unless interleaved is False. Attributes given as a single value are constant: stored once
+        and read by every vertex.
+        Vertex arrays created with a GL_DYNAMIC_DRAW or GL_STREAM_DRAW usage keep a copy of their
+        buffers and can be updated, see update. With frames > 1, updates are streamed to a ring of
+        buffer segments, so that the GPU draws a frame while the next ones are written. """
+    def __init__(self, shader, attributes, index=None, usage=GL.GL_STATIC_DRAW,
+                 formats=None, interleaved=True, frames=1):
         """ Vertex array from attributes and optional index array. Vertex
-            Attributes should be list of arrays with one row per vertex. """
+            Attributes should be list of arrays with one row per vertex.
+            The index can also be an already uploaded, shared IndexBuffer.
+            formats optionally gives the format of some attributes, e.g. float16 if
+            the precision is good enough for them, see VERTEX_FORMATS. """
 
         # create vertex array object, bind it
         self.glid = GL.glGenVertexArrays(1)
         GL.glBindVertexArray(self.glid)
         self.buffers = []  # we will store buffers in a list
-        nb_primitives, size = 0, 0
-
-        # load buffer per vertex attribute (in list with index = shader layout)
+        self.layout = {}   # attribute name -> (buffer, format, components, offset, stride, constant)
+        self.nbytes = 0    # GPU memory used by the vertex buffers
+        self.usage = usage
+        self.shadows = {}  # buffer -> copy of its (vertices, stride) bytes, if dynamic
+        self.streamed = set()   # buffers holding a ring of segments
+        self.frames = frames if usage != GL.GL_STATIC_DRAW else 1
+        self.segment = 0   # ring segment drawn, with fences of the draws reading each segment
+        self.fences = [None] * self.frames
+        formats = formats or {}
+        nb_primitives = 0
+
+        # attributes used by the shader, constant ones are stored as a single vertex
+        vertices, constants = {}, {}
         for name, data in attributes.items():
             loc = GL.glGetAttribLocation(shader.glid, name)
             if loc >= 0:
-                # bind a new vbo, upload its data to GPU, declare size and type
-                self.buffers.append(GL.glGenBuffers(1))
-                data = np.array(data, np.float32, copy=False)  # ensure format
-                nb_primitives, size = data.shape
+                data = np.asarray(data)
+                if data.ndim == 1:
+                    constants[name] = (loc, data.reshape(1, -1))
+                else:
+                    vertices[name] = (loc, data)
+                    nb_primitives = len(data)
+        groups = [vertices] if interleaved else [{name: vertices[name]} for name in vertices]
+
+        # load buffer per group of attributes (one group per attribute if not interleaved)
+        for group in groups + [constants]:
+            if not group:
+                continue
+            columns, offset = [], 0
+            for name, (loc, data) in group.items():
+                format_ = formats.get(name) or vertex_format(name, data, usage != GL.GL_STATIC_DRAW)
+                columns.append(encode_attribute(data, format_))
+                self.layout[name] = [loc, format_, data.shape[1], offset, 0, group is constants]
+                offset += columns[-1].shape[1]
+
+            # bind a new vbo, upload its data to GPU (in the first segment of
+            # a ring of segments if streamed), declare size and type of its attributes
+            self.buffers.append(GL.glGenBuffers(1))
+            data = np.ascontiguousarray(np.concatenate(columns, axis=1))
+            segments = 1 if group is constants else self.frames
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[-1])
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, data.nbytes * segments, None, usage)
+            GL.glBufferSubData(GL.GL_ARRAY_BUFFER, 0, data)
+            count_upload('buffer', data.nbytes)
+            self.nbytes += data.nbytes * segments
+            if usage != GL.GL_STATIC_DRAW:
+                self.shadows[self.buffers[-1]] = data
+            if segments > 1:
+                self.streamed.add(self.buffers[-1])
+            for name in group:
+                loc, format_, components, offset, _, constant = self.layout[name]
+                gl_type, stride = VERTEX_FORMATS[format_][0], data.shape[1]
+                size = 4 if format_ == 'int_2_10_10_10' else components
                 GL.glEnableVertexAttribArray(loc)
-                GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.buffers[-1])
-                GL.glBufferData(GL.GL_ARRAY_BUFFER, data, usage)
-                GL.glVertexAttribPointer(loc, size, GL.GL_FLOAT, False, 0, None)
-
-        # optionally create and upload an index buffer for this object
-        self.draw_command = GL.glDrawArrays
+                if name in INTEGER_ATTRIBUTES:
+                    GL.glVertexAttribIPointer(loc, size, gl_type, stride, ctypes.c_void_p(offset))
+                else:
+                    normalized = format_ == 'int_2_10_10_10'
+                    GL.glVertexAttribPointer(loc, size, gl_type, normalized, stride, ctypes.c_void_p(offset))
+                if constant:
+                    # every vertex of every instance reads the first and only value
+                    GL.glVertexAttribDivisor(loc, 2**31 - 1)
+                self.layout[name] = (self.buffers[-1], format_, components, offset, stride, constant)
+
+        # optionally create and upload an index buffer for this object, the
+        # element buffer binding is recorded in the vertex array object
+        self.index = None
         self.arguments = (0, nb_primitives)
         if index is not None:
-            self.buffers += [GL.glGenBuffers(1)]
-            index_buffer = np.array(index, np.int32, copy=False)  # good format
-            GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, self.buffers[-1])
-            GL.glBufferData(GL.GL_ELEMENT_ARRAY_BUFFER, index_buffer, usage)
-            self.draw_command = GL.glDrawElements
-            self.arguments = (index_buffer.size, GL.GL_UNSIGNED_INT, None)
-
-    def execute(self, primitive):
-        """ draw a vertex array, either as direct array or indexed array """
-        GL.glBindVertexArray(self.glid)
-        self.draw_command(primitive, *self.arguments)
+            if not isinstance(index, IndexBuffer):
+                index = IndexBuffer(index, usage=usage)
+            GL.glBindBuffer(GL.GL_ELEMENT_ARRAY_BUFFER, index.glid)
+            self.index = index
+        GL.glBindVertexArray(0)
+
+    def read_attribute(self, name):
+        """ copy of the (vertices, components) data of an attribute, read back from the GPU """
+        buffer, format_, components, offset, stride, constant = self.layout[name]
+        vertices = 1 if constant else self.arguments[1]
+        data = self.shadows.get(buffer)
+        if data is None:
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
+            data = GL.glGetBufferSubData(GL.GL_ARRAY_BUFFER, 0, vertices * stride)
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+            data = np.frombuffer(data, np.uint8).reshape(vertices, stride)
+        data = data[:, offset:]
+        values = decode_attribute(data, format_, components)
+        return np.repeat(values, self.arguments[1], axis=0) if constant else values
+
+    def update(self, attributes, first=0, orphan=False):
+        """ Update the values of some attributes from vertex first on, given like in the constructor.
+            The new values are written in the copy of their buffer, then uploaded:
+            - by default, only the modified vertices with glBufferSubData,
+            - if orphan is set, the whole buffer after orphaning it, so that the driver gives
+              fresh storage instead of waiting for draws still reading the old one,
+            - with several frames, all vertex buffers to the next segment of their ring, mapped
+              without synchronization once the fence of the draws reading it has been passed """
+        assert self.shadows, 'static vertex array, create it with a dynamic or stream usage'
+        modified = {}
+        for name, data in attributes.items():
+            buffer, format_, components, offset, _, constant = self.layout[name]
+            data = np.asarray(data).reshape(-1, components)
+            rows = (0, 1) if constant else (first, first + len(data))
+            assert rows[1] <= len(self.shadows[buffer]), 'vertex array cannot grow'
+            encoded = encode_attribute(data, format_)
+            self.shadows[buffer][rows[0]:rows[1], offset:offset + encoded.shape[1]] = encoded
+            start, stop = modified.get(buffer, rows)
+            modified[buffer] = (min(start, rows[0]), max(stop, rows[1]))
+
+        if self.frames > 1:
+            self.segment = (self.segment + 1) % self.frames
+            self.wait(self.segment)
+
+        for buffer, shadow in self.shadows.items():
+            streamed = buffer in self.streamed
+            if buffer not in modified and not streamed:
+                continue
+            GL.glBindBuffer(GL.GL_ARRAY_BUFFER, buffer)
+            if streamed:
+                flags = GL.GL_MAP_WRITE_BIT | GL.GL_MAP_UNSYNCHRONIZED_BIT | GL.GL_MAP_INVALIDATE_RANGE_BIT
+                pointer = GL.glMapBufferRange(GL.GL_ARRAY_BUFFER, self.segment * shadow.nbytes,
+                                              shadow.nbytes, flags)
+                ctypes.memmove(pointer, shadow.ctypes.data, shadow.nbytes)
+                GL.glUnmapBuffer(GL.GL_ARRAY_BUFFER)
+                count_upload('buffer', shadow.nbytes)
+            elif orphan:
+                GL.glBufferData(GL.GL_ARRAY_BUFFER, shadow.nbytes, None, self.usage)
+                GL.glBufferSubData(GL.GL_ARRAY_BUFFER, 0, shadow)
+                count_upload('buffer', shadow.nbytes)
+            else:
+                start, stop = modified[buffer]
+                GL.glBufferSubData(GL.GL_ARRAY_BUFFER, start * shadow.shape[1], shadow[start:stop])
+                count_upload('buffer', shadow[start:stop].nbytes)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
+    def wait(self, segment):
+        """ wait until the GPU is done with the draws reading a ring segment """
+        fence = self.fences[segment]
+        if fence is not None:
+            while GL.glClientWaitSync(fence, GL.GL_SYNC_FLUSH_COMMANDS_BIT, 10**9) == GL.GL_TIMEOUT_EXPIRED:
+                pass
+            GL.glDeleteSync(fence)
+            self.fences[segment] = None
+
+    def execute(self, primitive, state=None, instances=None):
+        """ draw a vertex array, either as direct array or indexed array, drawing the given
+            number of instances if set. The vertex array is bound through the optional RenderState. """
+        if state is None:
+            GL.glBindVertexArray(self.glid)
+        else:
+            state.bind_vertex_array(self.glid)
+
+        # vertices of the current ring segment follow those of the previous segments
+        base_vertex = self.segment * self.arguments[1]
+        if self.index is not None:
+            self.index.execute(primitive, instances, base_vertex)
+        elif instances is not None:
+            GL.glDrawArraysInstanced(primitive, base_vertex, self.arguments[1], instances)
+        else:
+            GL.glDrawArrays(primitive, base_vertex, self.arguments[1])
+
+        # the segment is not written again before these draws are done
+        if self.frames > 1:
+            if self.fences[self.segment] is not None:
+                GL.glDeleteSync(self.fences[self.segment])
+            self.fences[self.segment] = GL.glFenceSync(GL.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
 
     def __del__(self):  # object dies => kill GL array and buffers from GPU
         GL.glDeleteVertexArrays(1, [self.glid])
@@ -146,34 +546,203 @@ class VertexArray:
 # ------------  Mesh is the core drawable -------------------------------------
 class Mesh:
     """ Basic mesh class, attributes and uniforms passed as arguments """
-    def __init__(self, shader, attributes, uniforms=None, index=None):
+    def __init__(self, shader, attributes, uniforms=None, index=None,
+                 primitives=GL.GL_TRIANGLES, formats=None, interleaved=True,
+                 usage=GL.GL_STATIC_DRAW, frames=1):
         self.shader = shader
         self.uniforms = uniforms or dict()
-        self.vertex_array = VertexArray(shader, attributes, index)
-
-    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
-        GL.glUseProgram(self.shader.glid)
-        self.shader.set_uniforms({**self.uniforms, **uniforms})
-        self.vertex_array.execute(primitives)
+        self.primitives = primitives    # default primitive, e.g. strips
+        self.vertex_array = VertexArray(shader, attributes, index, usage, formats, interleaved, frames)
+        self.static = usage == GL.GL_STATIC_DRAW    # updated vertices change the bounds
+
+        # object space bounding box used for culling, None if unbounded
+        position = attributes.get('position')
+        self.bounds = None if position is None else bounding_box(position)
+
+    def update(self, attributes, first=0, orphan=False):
+        """ update vertex attributes of a dynamic mesh, see VertexArray.update.
+            The bounds grow with partially updated positions, they are recomputed otherwise. """
+        self.vertex_array.update(attributes, first, orphan)
+        position = attributes.get('position')
+        if position is not None:
+            bounds = bounding_box(position)
+            if first > 0 or len(position) < self.vertex_array.arguments[1]:
+                bounds = union_box([self.bounds, bounds])
+            self.bounds = bounds
+
+    def draw(self, frame, model, primitives=None, instances=None, **uniforms):
+        """ draw with the frame uniforms, set once per frame for each shader, and own uniforms,
+            overridden by the model matrix then by uniforms given by decorators or the caller.
+            A number of instances is given by the Instanced decorator. """
+        profiler = frame.profiler
+        if profiler:
+            profiler.begin('set_uniforms')
+        frame.state.use_program(self.shader.glid)
+        frame.set_uniforms(self.shader)
+        self.shader.set_uniforms(self.uniforms, frame.stats)
+        uniforms['model'] = model
+        uniforms['use_instancing'] = int(instances is not None)
+        self.shader.set_uniforms(uniforms, frame.stats)
+        if profiler:
+            profiler.end()
+        self.vertex_array.execute(primitives or self.primitives, frame.state, instances)
+        frame.stats['draw_calls'] += 1
+        frame.stats['instances'] += 1 if instances is None else instances
 
 
 # ------------  Node is the core drawable for hierarchical scene graphs -------
 class Node:
     """ Scene graph transform and parameter broadcast node """
+    static = True   # bounds only depend on the world transform, unlike e.g. skinned meshes
+    structure_version = 0   # incremented whenever children of any node change, see RenderQueue
+
     def __init__(self, children=(), transform=identity()):
         self.transform = transform
         self.world_transform = identity()
+        self.parent_transform = None    # parent world transform that world_transform was computed with
         self.children = list(iter(children))
+        self.cached_bounds = None   # (world transform, world bounds) of a static subtree
+        self.cached_leaves = None   # (world transform, children, world bounds of static drawables)
+        self.static_subtree = None  # (structure version, whether the whole subtree is static)
+        self.render_items = None    # render queue item of each drawable child, see RenderQueue
+
+    @property
+    def transform(self):
+        return self._transform
+
+    @transform.setter
+    def transform(self, transform):
+        """ a new local transform marks the world transform dirty, transforms must not be modified in place """
+        self._transform = transform
+        self.parent_transform = None
 
     def add(self, *drawables):
         """ Add drawables to this node, simply updating children list """
         self.children.extend(drawables)
+        self.cached_bounds, self.cached_leaves, self.static_subtree = None, None, None
+        Node.structure_changed()
 
-    def draw(self, model=identity(), **other_uniforms):
-        """ Recursive draw, passing down updated model matrix. """
-        self.world_transform = model @ self.transform
+    def replace(self, old, new):
+        """ Replace child old by new, e.g. a subtree by its static batch """
+        self.children[self.children.index(old)] = new
+        self.cached_bounds, self.cached_leaves, self.static_subtree = None, None, None
+        Node.structure_changed()
+
+    @staticmethod
+    def structure_changed():
+        """ to be called when the children of a node are changed other than with add """
+        Node.structure_version += 1
+
+    def update_world(self, model=identity()):
+        """ World transform for the parent world transform model, only recomputed if the local
+            transform changed or the parent world transform is a new one. Unchanged subtrees thus
+            keep the same world transform objects, so that their children skip the update too. """
+        if model is not self.parent_transform:
+            self.world_transform = model @ self.transform
+            self.parent_transform = model
+        return self.world_transform
+
+    def update_subtree(self, frame, model=identity()):
+        """ Recursively update world transforms of the subtree without drawing it """
+        world_transform = self.update_world(model)
         for child in self.children:
-            child.draw(model=self.world_transform, **other_uniforms)
+            if isinstance(child, Node):
+                child.update_subtree(frame, world_transform)
+
+    def world_bounds(self, model=identity()):
+        """ World space bounding box of the subtree for a given parent model matrix,
+            None if unbounded. Kept as long as the world transform of static subtrees
+            does not change, the subtree itself is assumed not to change once drawn. """
+        world_transform = self.update_world(model)
+        if self.cached_bounds is not None and self.cached_bounds[0] is world_transform:
+            return self.cached_bounds[1]
+
+        bounds = union_box(self.children_bounds(world_transform))
+        if self.is_static():
+            self.cached_bounds = (world_transform, bounds)
+        return bounds
+
+    def children_bounds(self, world_transform):
+        """ world space bounding box of every child, None for unbounded ones.
+            Boxes of static drawables are kept as long as the world transform is the same. """
+        cached = self.cached_leaves
+        if cached is None or cached[0] is not world_transform or cached[1] is not self.children:
+            self.cached_leaves = (world_transform, self.children, [
+                None if isinstance(child, Node) or not getattr(child, 'static', True)
+                else child_bounds(child, world_transform) for child in self.children])
+
+        for child, bounds in zip(self.children, self.cached_leaves[2]):
+            if isinstance(child, Node) or not getattr(child, 'static', True):
+                bounds = child_bounds(child, world_transform)
+            yield bounds
+
+    def is_static(self):
+        """ whether the whole subtree is static, computed again once the structure of any node
+            changed, e.g. when a subtree below stops being a placeholder (see loader.Deferred) """
+        if self.static_subtree is None or self.static_subtree[0] != Node.structure_version:
+            self.static_subtree = (Node.structure_version, self.static and all(
+                child.is_static() if isinstance(child, Node) else getattr(child, 'static', True)
+                for child in self.children))
+        return self.static_subtree[1]
+
+    def close(self):
+        """ Recursively release what the subtree keeps running besides GL objects, e.g. worker threads """
+        for child in self.children:
+            if isinstance(child, Node):
+                child.close()
+
+    def draw(self, frame, model=identity()):
+        """ Recursive draw, passing down the frame context and updated model matrix """
+        def draw_child(node, index, world_transform, bounds):
+            node.children[index].draw(frame, world_transform)
+        self.traverse(frame, draw_child, model)
+
+    def traverse(self, frame, visit, model=identity()):
+        """ Update world transforms and call visit(node, index, world transform, world bounds)
+            for every drawable child of the subtree, in scene graph order. Children outside of the
+            view frustum of the frame, if any, are skipped. """
+        profiler = frame.profiler
+        if profiler:
+            profiler.begin(type(self).__name__)
+        world_transform = self.update_world(model)
+        frustum = frame.frustum
+        if frustum is None:
+            for index, child in enumerate(self.children):
+                if isinstance(child, Node):
+                    child.traverse(frame, visit, world_transform)
+                else:
+                    visit(self, index, world_transform, None)
+            if profiler:
+                profiler.end()
+            return
+
+        for index, (child, bounds) in enumerate(zip(self.children, self.children_bounds(world_transform))):
+            visibility = frustum.classify(bounds)
+
+            # culled: only keep world transforms up to date, e.g. for bones of skinned meshes
+            if visibility < 0:
+                if isinstance(child, Node):
+                    frame.stats['culled_nodes'] += 1
+                    frame.stats['culled_draws'] += child.count_draws()
+                    child.update_subtree(frame, world_transform)
+                else:
+                    frame.stats['culled_draws'] += 1
+                continue
+
+            # entirely inside the frustum, there is nothing to cull in the subtree
+            if visibility > 0:
+                frame.frustum = None
+            if isinstance(child, Node):
+                child.traverse(frame, visit, world_transform)
+            else:
+                visit(self, index, world_transform, bounds)
+            frame.frustum = frustum
+        if profiler:
+            profiler.end()
+
+    def count_draws(self):
+        """ number of drawables in the subtree """
+        return sum(child.count_draws() if isinstance(child, Node) else 1 for child in self.children)
 
     def key_handler(self, key):
         """ Dispatch keyboard events to children with key handler """
@@ -181,8 +750,163 @@ class Node:
             child.key_handler(key)
 
 
+def child_bounds(child, model):
+    """ world space bounding box of a scene graph child drawn with model matrix, None if unbounded.
+        Drawables give their object space box as bounds, or compute it with world_bounds(model). """
+    if hasattr(child, 'world_bounds'):
+        return child.world_bounds(model)
+    bounds = getattr(child, 'bounds', None)
+    return None if bounds is None else transform_box(model, bounds)
+
+
+class FrameContext:
+    """ State of one frame shared by the whole scene graph traversal instead of keyword arguments:
+        uniforms common to all shaders (view, projection, camera position, timer...), animation time,
+        optional view frustum for culling and counters of what has been drawn or culled """
+    def __init__(self, time=0., frustum=None, **uniforms):
+        self.time = time
+        self.frustum = frustum
+        self.uniforms = uniforms
+        self.stats = Counter()
+        self.state = RenderState(self.stats)
+        self.profiler = None    # set while profiling, see profiler.py
+        self.shaders = set()    # shaders whose frame uniforms are set, see set_uniforms
+
+    def set_uniforms(self, shader):
+        """ set the frame uniforms of shader, unless done for an earlier draw of the frame.
+            The shader program must be in use """
+        if shader not in self.shaders:
+            shader.set_uniforms(self.uniforms, self.stats)
+            self.shaders.add(shader)
+
+
+class RenderState:
+    """ Shadow of the bound program, vertex array and textures, so that binding what is
+        already bound is skipped. Counts issued and skipped state changes in stats. """
+    def __init__(self, stats):
+        self.stats = stats
+        self.program = None
+        self.vertex_array = None
+        self.active_unit = None
+        self.textures = {}      # texture unit -> texture glid
+
+    def use_program(self, glid):
+        if glid == self.program:
+            self.stats['program_binds_skipped'] += 1
+            return
+        GL.glUseProgram(glid)
+        self.program = glid
+        self.stats['program_binds'] += 1
+
+    def bind_vertex_array(self, glid):
+        if glid == self.vertex_array:
+            self.stats['vertex_array_binds_skipped'] += 1
+            return
+        GL.glBindVertexArray(glid)
+        self.vertex_array = glid
+        self.stats['vertex_array_binds'] += 1
+
+    def bind_texture(self, unit, texture):
+        if self.textures.get(unit) == texture.glid:
+            self.stats['texture_binds_skipped'] += 1
+            return
+        if unit != self.active_unit:
+            GL.glActiveTexture(GL.GL_TEXTURE0 + unit)
+            self.active_unit = unit
+        GL.glBindTexture(texture.type, texture.glid)
+        self.textures[unit] = texture.glid
+        self.stats['texture_binds'] += 1
+
+
+# ------------  Render queue: flattened scene graph, sorted by render state ---
+def drawable_state(drawable):
+    """ (shader glid, texture glids) used by a drawable, looked up through its decorators """
+    shader, textures = None, ()
+    while drawable is not None:
+        textures = textures or tuple(texture.glid for texture in getattr(drawable, 'textures', {}).values())
+        shader = shader or getattr(drawable, 'shader', None)
+        drawable = getattr(drawable, 'drawable', getattr(drawable, 'mesh', None))
+    return (shader.glid if shader else 0), textures
+
+
+def drawable_label(drawable):
+    """ class names of a drawable and its decorators, e.g. 'Skinned/Textured/Mesh' """
+    names = []
+    while drawable is not None:
+        names.append(type(drawable).__name__)
+        drawable = getattr(drawable, 'drawable', getattr(drawable, 'mesh', None))
+    return '/'.join(names)
+
+
+class RenderItem:
+    """ Drawable of the render queue with its sort key parts: render order (background -1,
+        opaque 0, transparent 1, from the drawable's render_order), render state and depth """
+    def __init__(self, drawable):
+        self.drawable = drawable
+        self.order = getattr(drawable, 'render_order', 0)
+        self.state = drawable_state(drawable)
+        self.label = drawable_label(drawable)
+        self.frame, self.model, self.depth = None, None, 0.
+
+    def sort_key(self):
+        """ opaque items are grouped by state then drawn front to back,
+            transparent items are drawn back to front """
+        if self.order > 0:
+            return self.order, (), -self.depth
+        return self.order, self.state, self.depth
+
+
+class RenderQueue:
+    """ Drawables of a scene graph flattened into a list of render items. Every frame, the graph
+        traversal (transforms, culling) marks the visible items, which are then sorted and drawn,
+        so that consecutive draws share as much render state as possible.
+        The queue must be rebuilt when Node.structure_version changes. """
+    def __init__(self, root):
+        self.version = Node.structure_version
+        self.items = []
+        self.add_items(root)
+
+    def add_items(self, node):
+        node.render_items = [None if isinstance(child, Node) else RenderItem(child) for child in node.children]
+        self.items.extend(item for item in node.render_items if item is not None)
+        for child in node.children:
+            if isinstance(child, Node):
+                self.add_items(child)
+
+    def show(self, frame, node, index, world_transform, bounds):
+        """ mark a drawable child of node visible in frame, to be drawn with world_transform """
+        if node.render_items is None or index >= len(node.render_items):
+            return  # added during this frame, drawn from the next one on
+        item = node.render_items[index]
+        item.frame, item.model = frame, world_transform
+
+        # view space depth of the center of the item
+        center = world_transform[:3, 3] if bounds is None else (bounds[0] + bounds[1]) / 2
+        view = frame.uniforms.get('view')
+        item.depth = 0. if view is None else -(view[2, :3] @ center + view[2, 3])
+
+    def render(self, frame, root, model=identity()):
+        """ traverse the graph of root to find the visible items, then draw them sorted.
+            When profiling, each draw is timed on the CPU and the GPU. """
+        root.traverse(frame, lambda *args: self.show(frame, *args), model)
+        visible = [item for item in self.items if item.frame is frame]
+        visible.sort(key=RenderItem.sort_key)
+        profiler = frame.profiler
+        for item in visible:
+            if profiler:
+                profiler.begin('draw ' + item.label)
+                profiler.begin_gpu(item.label)
+                item.drawable.draw(frame, item.model)
+                profiler.end_gpu()
+                profiler.end()
+            else:
+                item.drawable.draw(frame, item.model)
+
+
 # -------------- 3D resource loader -------------------------------------------
-MAX_BONES = 128
+MAX_BONES = 128         # bones of a skinned mesh, size of the shader bone palette
+MAX_VERTEX_BONES = 4    # bones influencing a vertex
+SCENE_FORMAT = 2        # version of the imported scene layout, part of the cache key
 
 # optionally load texture module
 try:
@@ -197,86 +921,128 @@ except ImportError:
     KeyFrameControlNode, Skinned = None, None
 
 
-def load(file, shader, tex_file=None, **params):
-    """load resources from file using assimp, return node hierarchy """
+def import_flags():
+    """ assimp post processing steps applied to imported files """
+    pp = assimpcy.aiPostProcessSteps
+    flags = pp.aiProcess_JoinIdenticalVertices | pp.aiProcess_FlipUVs
+    flags |= pp.aiProcess_OptimizeMeshes | pp.aiProcess_Triangulate
+    flags |= pp.aiProcess_GenSmoothNormals
+    flags |= pp.aiProcess_ImproveCacheLocality
+    flags |= pp.aiProcess_RemoveRedundantMaterials
+    return flags
+
+
+def vertex_weights(bone):
+    """ (vertex ids, weights) arrays of the vertices influenced by an assimp bone """
+    count = len(bone.mWeights)
+    return (np.fromiter((entry.mVertexId for entry in bone.mWeights), np.int64, count),
+            np.fromiter((entry.mWeight for entry in bone.mWeights), np.float32, count))
+
+
+def skin_weights(num_vertices, weights, count=MAX_VERTEX_BONES):
+    """ Per vertex bone ids and weights, (num_vertices, count) arrays, from the (vertex ids,
+        weights) arrays of every bone. The count highest weights of a vertex are kept and
+        renormalized to sum to one. Vertices without weights keep zero weights. """
+    vertex = np.concatenate([ids for ids, _ in weights])
+    weight = np.concatenate([values for _, values in weights])
+    bone = np.repeat(np.arange(len(weights), dtype=np.uint32), [len(ids) for ids, _ in weights])
+
+    # entries sorted by vertex then decreasing weight, ranked within their vertex
+    order = np.lexsort((-weight, vertex))
+    vertex, weight, bone = vertex[order], weight[order], bone[order]
+    rank = np.arange(len(vertex)) - np.searchsorted(vertex, vertex)
+    kept = rank < count
+
+    bone_ids = np.zeros((num_vertices, count), np.uint32)
+    bone_weights = np.zeros((num_vertices, count), np.float32)
+    bone_ids[vertex[kept], rank[kept]] = bone[kept]
+    bone_weights[vertex[kept], rank[kept]] = weight[kept]
+    total = bone_weights.sum(axis=1, keepdims=True)
+    np.divide(bone_weights, total, out=bone_weights, where=total > 0)
+    return bone_ids, bone_weights
+
+
+def bone_palettes(faces, bone_ids, bone_weights, max_bones=MAX_BONES):
+    """ Split triangles (faces, in order) into consecutive runs whose vertices are influenced
+        by at most max_bones bones in all. Returns (faces, palette) per run, the palette being
+        the sorted ids of the bones of the run. """
+    used = np.where(bone_weights[faces] > 0, bone_ids[faces].astype(np.int64), -1).reshape(len(faces), -1)
+    palettes, palette, start = [], set(), 0
+    for face, face_bones in enumerate(used.tolist()):
+        face_bones = set(face_bones)
+        face_bones.discard(-1)
+        if len(palette | face_bones) > max_bones:
+            palettes.append((faces[start:face], sorted(palette)))
+            palette, start = set(), face
+        palette |= face_bones
+    palettes.append((faces[start:], sorted(palette)))
+    return palettes
+
+
+def import_scene(file, tex_file=None):
+    """ Import a file with assimp into plain data: a dict of named arrays, one of them ('scene')
+        holding the JSON description of nodes, meshes, materials and keyframe channels that
+        refer to the others. None if assimp cannot import the file. """
     try:
-        pp = assimpcy.aiPostProcessSteps
-        flags = pp.aiProcess_JoinIdenticalVertices | pp.aiProcess_FlipUVs
-        flags |= pp.aiProcess_OptimizeMeshes | pp.aiProcess_Triangulate
-        flags |= pp.aiProcess_GenSmoothNormals
-        flags |= pp.aiProcess_ImproveCacheLocality
-        flags |= pp.aiProcess_RemoveRedundantMaterials
-        scene = assimpcy.aiImportFile(file, flags)
+        scene = assimpcy.aiImportFile(file, import_flags())
     except assimpcy.all.AssimpError as exception:
         print('ERROR loading', file + ': ', exception.args[0].decode())
-        return []
+        return None
+    arrays = {}
 
-    # ----- Pre-load textures; embedded textures not supported at the moment
+    # ----- resolve texture files; embedded textures not supported at the moment
     path = os.path.dirname(file) if os.path.dirname(file) != '' else './'
+    materials = []
     for mat in scene.mMaterials:
+        texture_file = tex_file
         if not tex_file and 'TEXTURE_BASE' in mat.properties:  # texture token
             name = mat.properties['TEXTURE_BASE'].split('/')[-1].split('\\')[-1]
             # search texture in file's whole subdir since path often screwed up
-            paths = os.walk(path, followlinks=True)
-            file = next((os.path.join(d, f) for d, _, n in paths for f in n
-                     if name.startswith(f) or f.startswith(name)), None)
-            assert file, 'Cannot find texture %s in %s subtree' % (name, path)
-        if Texture is not None and file:
-            mat.properties['diffuse_map'] = Texture(tex_file=file)
-
-    # ----- load animations
-    def conv(assimp_keys, ticks_per_second):
-        """ Conversion from assimp key struct to our dict representation """
-        return {key.mTime / ticks_per_second: key.mValue for key in assimp_keys}
-
-    # load first animation in scene file (could be a loop over all animations)
-    transform_keyframes = {}
+            texture_file = find_asset(path, name)
+            assert texture_file, 'Cannot find texture %s in %s subtree' % (name, path)
+        materials.append(dict(
+            k_d=np.asarray(mat.properties.get('COLOR_DIFFUSE', (1, 1, 1))).tolist(),
+            k_s=np.asarray(mat.properties.get('COLOR_SPECULAR', (1, 1, 1))).tolist(),
+            k_a=np.asarray(mat.properties.get('COLOR_AMBIENT', (0, 0, 0))).tolist(),
+            s=float(mat.properties.get('SHININESS', 16.)),
+            diffuse_map=texture_file))
+
+    # ----- first animation in scene file (could be a loop over all animations): per animated
+    # node, its keys times (in seconds) and values are slices of one array per kind of key
+    channels = []
     if scene.HasAnimations:
         anim = scene.mAnimations[0]
+        keys = dict(translate=[], rotate=[], scale=[])
         for channel in anim.mChannels:
-            # for each animation bone, store TRS dict with {times: transforms}
-            transform_keyframes[channel.mNodeName] = (
-                conv(channel.mPositionKeys, anim.mTicksPerSecond),
-                conv(channel.mRotationKeys, anim.mTicksPerSecond),
-                conv(channel.mScalingKeys, anim.mTicksPerSecond)
-            )
-
-    # ---- prepare scene graph nodes
-    nodes = {}                                       # nodes name -> node lookup
-    nodes_per_mesh_id = [[] for _ in scene.mMeshes]  # nodes holding a mesh_id
-
-    def make_nodes(assimp_node):
-        """ Recursively builds nodes for our graph, matching assimp nodes """
-        keyframes = transform_keyframes.get(assimp_node.mName, None)
-        if keyframes and KeyFrameControlNode:
-            node = KeyFrameControlNode(*keyframes, assimp_node.mTransformation)
-        else:
-            node = Node(transform=assimp_node.mTransformation)
-        nodes[assimp_node.mName] = node
-        for mesh_index in assimp_node.mMeshes:
-            nodes_per_mesh_id[mesh_index] += [node]
-        node.add(*(make_nodes(child) for child in assimp_node.mChildren))
-        return node
-
-    root_node = make_nodes(scene.mRootNode)
-
-    # ---- create optionally decorated (Skinned, Textured) Mesh objects
+            description = dict(node=channel.mNodeName)
+            for kind, channel_keys in (('translate', channel.mPositionKeys), ('rotate', channel.mRotationKeys),
+                                       ('scale', channel.mScalingKeys)):
+                start = len(keys[kind])
+                keys[kind].extend((key.mTime / anim.mTicksPerSecond, key.mValue) for key in channel_keys)
+                description[kind] = (start, len(keys[kind]))
+            channels.append(description)
+        for kind, pairs in keys.items():
+            arrays[kind + '_times'] = np.array([time for time, _ in pairs], np.float64)
+            arrays[kind + '_values'] = np.array([value for _, value in pairs])
+
+    # ----- node hierarchy, flattened depth first with children given by index
+    nodes, transforms = [], []
+
+    def flatten(assimp_node):
+        index = len(nodes)
+        nodes.append(dict(name=assimp_node.mName, meshes=[int(i) for i in assimp_node.mMeshes], children=[]))
+        transforms.append(assimp_node.mTransformation)
+        for child in assimp_node.mChildren:
+            nodes[index]['children'].append(flatten(child))
+        return index
+
+    flatten(scene.mRootNode)
+    arrays['node_transforms'] = np.array(transforms)
+
+    # ----- mesh vertex attributes, index and skinning data
+    meshes, mesh_parts = [], [[] for _ in scene.mMeshes]
     for mesh_id, mesh in enumerate(scene.mMeshes):
-        # retrieve materials associated to this mesh
-        mat = scene.mMaterials[mesh.mMaterialIndex].properties
-
-        # initialize mesh with args from file, merge and override with params
-        index = mesh.mFaces
-        uniforms = dict(
-            k_d=mat.get('COLOR_DIFFUSE', (1, 1, 1)),
-            k_s=mat.get('COLOR_SPECULAR', (1, 1, 1)),
-            k_a=mat.get('COLOR_AMBIENT', (0, 0, 0)),
-            s=mat.get('SHININESS', 16.),
-        )
-        attributes = dict(
-            position=mesh.mVertices,
-            normal=mesh.mNormals,
-        )
+        attributes = dict(position=mesh.mVertices, normal=mesh.mNormals)
 
         # ---- optionally add texture coordinates attribute if present
         if mesh.HasTextureCoords[0]:
@@ -287,60 +1053,189 @@ def load(file, shader, tex_file=None, **params):
             attributes.update(color=mesh.mColors[0])
 
         # ---- compute and add optional skinning vertex attributes
+        bones, index = [], np.asarray(mesh.mFaces)
         if mesh.HasBones:
             # skinned mesh: weights given per bone => convert per vertex for GPU
-            # first, populate an array with MAX_BONES entries per vertex
-            vbone = np.array([[(0, 0)] * MAX_BONES] * mesh.mNumVertices,
-                             dtype=[('weight', 'f4'), ('id', 'u4')])
-            for bone_id, bone in enumerate(mesh.mBones[:MAX_BONES]):
-                for entry in bone.mWeights:  # need weight,id pairs for sorting
-                    vbone[entry.mVertexId][bone_id] = (entry.mWeight, bone_id)
+            bone_ids, bone_weights = skin_weights(mesh.mNumVertices, [vertex_weights(bone) for bone in mesh.mBones])
+            attributes.update(bone_ids=bone_ids, bone_weights=bone_weights)
+            bones = [bone.mName for bone in mesh.mBones]
+            bone_offsets = np.array([bone.mOffsetMatrix for bone in mesh.mBones])
+
+        # ---- meshes with more bones than the shader palette are split in parts with fewer bones,
+        # given by their vertices, index, faces count and bones (palette of original bone ids)
+        parts = [(slice(None), index, mesh.mNumFaces, list(range(len(bones))))]
+        if len(bones) > MAX_BONES:
+            parts = []
+            for faces, palette in bone_palettes(index.reshape(-1, 3), bone_ids, bone_weights):
+                vertices, part_index = np.unique(faces, return_inverse=True)
+                parts.append((vertices, part_index.reshape(faces.shape).astype(np.uint32), len(faces), palette))
+
+        for vertices, part_index, faces, palette in parts:
+            prefix = 'mesh%d_' % len(meshes)
+            for name, data in attributes.items():
+                arrays[prefix + name] = np.ascontiguousarray(np.asarray(data)[vertices])
+            if bones:
+                # bone ids index the palette of the part
+                local_ids = np.zeros(len(bones), np.uint32)
+                local_ids[palette] = np.arange(len(palette))
+                arrays[prefix + 'bone_ids'] = local_ids[arrays[prefix + 'bone_ids']]
+                arrays[prefix + 'bone_offsets'] = bone_offsets[palette]
+            arrays[prefix + 'index'] = np.ascontiguousarray(part_index)
+            mesh_parts[mesh_id].append(len(meshes))
+            meshes.append(dict(material=mesh.mMaterialIndex, attributes=list(attributes),
+                               bones=[bones[bone] for bone in palette], faces=faces))
+
+    # nodes refer to the parts of their meshes
+    for node in nodes:
+        node['meshes'] = [part for mesh_index in node['meshes'] for part in mesh_parts[mesh_index]]
+
+    description = dict(file=file, nodes=nodes, meshes=meshes, materials=materials, channels=channels,
+                       animations=scene.mNumAnimations)
+    # names may come as bytes and numbers as numpy scalars
+    default = lambda value: value.decode() if isinstance(value, bytes) else np.asarray(value).tolist()
+    arrays['scene'] = np.frombuffer(json.dumps(description, default=default).encode(), np.uint8)
+    return arrays
+
+
+def load_scene(file, tex_file=None, cache=None):
+    """ Imported data of a file (see import_scene), kept in the on-disk cache (default ArrayCache
+        unless cache is False). Entries are addressed by the content of the file and the import
+        flags, so a warm start memory maps the arrays without running assimp. None on errors. """
+    if cache is False:
+        return import_scene(file, tex_file)
+    if not os.path.exists(file):
+        print('ERROR loading', file + ': file not found')
+        return None
+
+    cache = cache or ArrayCache()
+    with open(file, 'rb') as source:
+        digest = hashlib.sha1(source.read()).hexdigest()
+    # texture paths are found in the directory of the file, so entries are also specific to it
+    key = cache_key('scene', source=digest, flags=int(import_flags()), tex_file=tex_file,
+                    directory=os.path.abspath(os.path.dirname(file)), format=SCENE_FORMAT)
+    scene = cache.get(key)
+    if scene is None:
+        scene = import_scene(file, tex_file)
+        if scene is not None:
+            scene = cache.put(key, **scene)
+    return scene
+
+
+def scene_textures(scene):
+    """ texture files of the materials of imported data (see import_scene) """
+    description = json.loads(bytes(scene['scene']))
+    return [mat['diffuse_map'] for mat in description['materials'] if mat['diffuse_map']]
+
+
+def build_nodes(scene, shader, **params):
+    """ node hierarchy of imported data (see import_scene), without any call to assimp """
+    description = json.loads(bytes(scene['scene']))
+
+    # ----- load animations: for each animated node, TRS dicts of {times: values}
+    transform_keyframes = {}
+    for channel in description['channels']:
+        transform_keyframes[channel['node']] = tuple(
+            dict(zip(scene[kind + '_times'][start:stop].tolist(), np.array(scene[kind + '_values'][start:stop])))
+            for kind, (start, stop) in ((kind, channel[kind]) for kind in ('translate', 'rotate', 'scale')))
 
-            vbone.sort(order='weight')   # sort rows, high weights last
-            vbone = vbone[:, -4:]        # limit bone size, keep highest 4
+    # ---- prepare scene graph nodes
+    nodes = {}                                                  # nodes name -> node lookup
+    nodes_per_mesh_id = [[] for _ in description['meshes']]    # nodes holding a mesh_id
+    transforms = scene['node_transforms']
+
+    def make_nodes(index):
+        """ Recursively builds nodes for our graph, matching imported nodes """
+        node_description = description['nodes'][index]
+        transform = np.array(transforms[index])
+        keyframes = transform_keyframes.get(node_description['name'], None)
+        if keyframes and KeyFrameControlNode:
+            node = KeyFrameControlNode(*keyframes, transform)
+        else:
+            node = Node(transform=transform)
+        nodes[node_description['name']] = node
+        for mesh_index in node_description['meshes']:
+            nodes_per_mesh_id[mesh_index] += [node]
+        node.add(*(make_nodes(child) for child in node_description['children']))
+        return node
+
+    root_node = make_nodes(0)
 
-            attributes.update(bone_ids=vbone['id'],
-                              bone_weights=vbone['weight'])
+    # ----- textures of the materials, shared by their meshes and with other loaded models
+    textures = [shared_texture(mat['diffuse_map']) if Texture is not None and mat['diffuse_map'] else None
+                for mat in description['materials']]
 
+    # ---- create optionally decorated (Skinned, Textured) Mesh objects
+    for mesh_id, mesh in enumerate(description['meshes']):
+        # retrieve materials associated to this mesh
+        mat = description['materials'][mesh['material']]
+
+        # initialize mesh with args from file, merge and override with params
+        uniforms = dict(k_d=mat['k_d'], k_s=mat['k_s'], k_a=mat['k_a'], s=mat['s'])
+        attributes = {name: scene['mesh%d_%s' % (mesh_id, name)] for name in mesh['attributes']}
         new_mesh = Mesh(shader=shader, attributes=attributes,
-                        uniforms={**uniforms, **params}, index=index)
+                        uniforms={**uniforms, **params}, index=scene['mesh%d_index' % mesh_id])
 
-        if Textured is not None and 'diffuse_map' in mat:
-            new_mesh = Textured(new_mesh, diffuse_map=mat['diffuse_map'])
-        if Skinned and mesh.HasBones:
+        if Textured is not None and textures[mesh['material']] is not None:
+            new_mesh = Textured(new_mesh, diffuse_map=textures[mesh['material']])
+        if Skinned and mesh['bones']:
             # make bone lookup array & offset matrix, indexed by bone index (id)
-            bone_nodes = [nodes[bone.mName] for bone in mesh.mBones]
-            bone_offsets = [bone.mOffsetMatrix for bone in mesh.mBones]
+            bone_nodes = [nodes[name] for name in mesh['bones']]
+            bone_offsets = scene['mesh%d_bone_offsets' % mesh_id]
             new_mesh = Skinned(new_mesh, bone_nodes, bone_offsets)
         for node_to_populate in nodes_per_mesh_id[mesh_id]:
             node_to_populate.add(new_mesh)
+    return [root_node]
 
-    nb_triangles = sum((mesh.mNumFaces for mesh in scene.mMeshes))
+
+def load(file, shader, tex_file=None, cache=None, **params):
+    """load resources from file using assimp, or from the cache of an earlier import,
+        return node hierarchy """
+    scene = load_scene(file, tex_file, cache)
+    if scene is None:
+        return []
+    nodes = build_nodes(scene, shader, **params)
+
+    description = json.loads(bytes(scene['scene']))
+    nb_triangles = sum(mesh['faces'] for mesh in description['meshes'])
     print('Loaded', file, '\t(%d meshes, %d faces, %d nodes, %d animations)' %
-          (scene.mNumMeshes, nb_triangles, len(nodes), scene.mNumAnimations))
-    return [root_node]
+          (len(description['meshes']), nb_triangles, len(description['nodes']), description['animations']))
+    return nodes
 
 
 # ------------  Viewer class & window management ------------------------------
 class Viewer(Node):
     """ GLFW viewer window, with classic initialization & graphics loop
         modified to enable blending for transparency, pass some more uniforms to all shaders,
-        and bind the environment cube map to all shaders
+        and bind the environment cube map to all shaders.
+        A headless viewer has no window: it renders offscreen, see render.
     """
 
-    def __init__(self, width=640, height=480, trackball=None):
+    def __init__(self, width=640, height=480, trackball=None, headless=False):
         super().__init__()
 
-        # version hints: create GL window with >= OpenGL 3.3 and core profile
-        glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
-        glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
-        glfw.window_hint(glfw.OPENGL_FORWARD_COMPAT, GL.GL_TRUE)
-        glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
-        glfw.window_hint(glfw.RESIZABLE, True)
-        self.win = glfw.create_window(width, height, 'Viewer', None, None)
-
-        # make win's OpenGL context current; no OpenGL calls can happen before
-        glfw.make_context_current(self.win)
+        self.headless = headless
+        if headless:
+            # no window: offscreen context rendering into a framebuffer object, see offscreen.py
+            self.win = None
+            self.context = create_context()
+            self.framebuffer = Framebuffer(width, height)
+        else:
+            # version hints: create GL window with >= OpenGL 3.3 and core profile
+            glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
+            glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
+            glfw.window_hint(glfw.OPENGL_FORWARD_COMPAT, GL.GL_TRUE)
+            glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+            glfw.window_hint(glfw.RESIZABLE, True)
+            self.win = glfw.create_window(width, height, 'Viewer', None, None)
+
+            # make win's OpenGL context current; no OpenGL calls can happen before
+            glfw.make_context_current(self.win)
+
+            # register event handlers
+            glfw.set_key_callback(self.win, self.on_key)
+            glfw.set_cursor_pos_callback(self.win, self.on_mouse_move)
+            glfw.set_scroll_callback(self.win, self.on_scroll)
+            glfw.set_window_size_callback(self.win, self.on_size)
 
         # initialize trackball
         if not trackball:
@@ -348,12 +1243,11 @@ class Viewer(Node):
 
         self.trackball = trackball
         self.mouse = (0, 0)
-
-        # register event handlers
-        glfw.set_key_callback(self.win, self.on_key)
-        glfw.set_cursor_pos_callback(self.win, self.on_mouse_move)
-        glfw.set_scroll_callback(self.win, self.on_scroll)
-        glfw.set_window_size_callback(self.win, self.on_size)
+        self.frame = FrameContext()     # context of the last frame, with its statistics
+        self.queue = None               # render queue of the scene, rebuilt when it changes
+        self.frame_uniforms = UniformBuffer('FrameUniforms')    # camera and time of the frame
+        self.profiler = Profiler()      # toggled with P, see profiler.py
+        self.loader = None              # resources loaded in the background, see loader.py
 
         # useful message to check OpenGL renderer characteristics
         print('OpenGL', GL.glGetString(GL.GL_VERSION).decode() + ', GLSL',
@@ -378,35 +1272,92 @@ class Viewer(Node):
         
 
     def run(self):
-        """ Main render loop for this OpenGL window """
-        while not glfw.window_should_close(self.win):
-            # clear draw buffer and depth buffer (<-TP2)
-            GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
-
-            win_size = glfw.get_window_size(self.win)
-
-            # draw our scene objects
-            cam_pos = np.linalg.inv(self.trackball.view_matrix())[:, 3]
-
-            # bind environment cube map
-            self.environment.bind(GL.GL_TEXTURE20)
-
-            # added some uniforms like timer and rotation matrix
-            self.draw(
-                view=self.trackball.view_matrix(),
-                rotation=self.trackball.matrix(),
-                projection=self.trackball.projection_matrix(win_size),
-                model=identity(),
-                w_camera_position=cam_pos,
-                timer=glfw.get_time(),
-                environment_map=20
-            )
-
-            # flush render commands, and swap draw buffers
-            glfw.swap_buffers(self.win)
-
-            # Poll for and process events
-            glfw.poll_events()
+        """ Main render loop for this OpenGL window, the scene is closed once the window is """
+        try:
+            while not glfw.window_should_close(self.win):
+                self.draw_frame(glfw.get_time(), glfw.get_window_size(self.win))
+
+                # flush render commands, and swap draw buffers
+                glfw.swap_buffers(self.win)
+
+                # Poll for and process events
+                glfw.poll_events()
+        finally:
+            self.close()
+
+    def render(self, frames, fps=60, start=0., output=None):
+        """ Headless render loop: draw a number of frames with a fixed clock, advancing by 1/fps
+            per frame from time start whatever the time spent drawing, so that runs are
+            reproducible. Frames are saved to output, a file name pattern like 'frames/%04d.png',
+            otherwise returned as a list of (height, width, 3) RGB images """
+        assert self.headless, 'only headless viewers render a fixed number of frames'
+        if output and os.path.dirname(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+        images = []
+        for i in range(frames):
+            self.draw_frame(start + i / fps, self.framebuffer.size)
+            image = self.framebuffer.read()
+            if output:
+                Image.fromarray(image).save(output % i)
+            else:
+                images.append(image)
+        return images
+
+    def draw_frame(self, time, win_size):
+        """ draw the scene at the given time, seen by the trackball in a window of the given size """
+        profiler = self.profiler if self.profiler.enabled else None
+        if profiler:
+            profiler.begin_frame(time)
+
+        # upload the resources loaded since the last frame, within the loader time budget
+        if self.loader:
+            if profiler:
+                profiler.begin('uploads')
+            self.loader.pump()
+            if profiler:
+                profiler.end()
+
+        # clear draw buffer and depth buffer (<-TP2)
+        GL.glClear(GL.GL_COLOR_BUFFER_BIT | GL.GL_DEPTH_BUFFER_BIT)
+
+        # draw our scene objects
+        cam_pos = np.linalg.inv(self.trackball.view_matrix())[:, 3]
+
+        # bind environment cube map
+        self.environment.bind(GL.GL_TEXTURE0 + TEXTURE_UNITS[GL.GL_TEXTURE_CUBE_MAP])
+
+        # objects outside of the view frustum are culled
+        view = self.trackball.view_matrix()
+        projection = self.trackball.projection_matrix(win_size)
+
+        # added some uniforms like timer and rotation matrix, shared by all drawables
+        # through the frame context. Those of the FrameUniforms block are uploaded once
+        # per frame into its uniform buffer, which every shader program reads from
+        self.frame = FrameContext(
+            time, Frustum(projection @ view),
+            view=view,
+            rotation=self.trackball.matrix(),
+            projection=projection,
+            w_camera_position=cam_pos,
+            timer=time,
+            environment_map=TEXTURE_UNITS[GL.GL_TEXTURE_CUBE_MAP]
+        )
+        self.frame.profiler = profiler
+        self.frame_uniforms.update(self.frame.uniforms)
+        self.frame.stats['uniform_bytes'] += self.frame_uniforms.size
+        if self.queue is None or self.queue.version != Node.structure_version:
+            self.queue = RenderQueue(self)
+        self.queue.render(self.frame, self)
+
+        # buffers and textures uploaded while loading and drawing the frame
+        self.frame.stats.update(uploads)
+        uploads.clear()
+
+        # rolling breakdown of the profiled frames, every few seconds at 60 fps
+        if profiler:
+            profiler.end_frame()
+            if profiler.index % 300 == 0:
+                print(profiler.report())
 
     def on_key(self, _win, key, _scancode, action, _mods):
         """ 'Q' or 'Escape' quits """
@@ -417,6 +1368,26 @@ class Viewer(Node):
                 GL.glPolygonMode(GL.GL_FRONT_AND_BACK, next(self.fill_modes))
             if key == glfw.KEY_SPACE:
                 glfw.set_time(0.0)
+            if key == glfw.KEY_C:
+                stats = self.frame.stats
+                print('%d draw calls, culled %d nodes and %d draw calls' %
+                      (stats['draw_calls'], stats['culled_nodes'], stats['culled_draws']))
+                for state in ('program', 'vertex_array', 'texture'):
+                    print('%s binds: %d, skipped %d' %
+                          (state, stats[state + '_binds'], stats[state + '_binds_skipped']))
+                print('uniform uploads: %d (%d bytes), skipped %d' %
+                      (stats['uniforms_issued'], stats['uniform_bytes'], stats['uniforms_skipped']))
+                print('uploaded %d bytes of buffers and %d bytes of textures' %
+                      (stats['buffer_bytes'], stats['texture_bytes']))
+            if key == glfw.KEY_P:
+                if self.profiler.enabled:
+                    self.profiler.stop()
+                    self.profiler.save('profile.json')
+                    print(self.profiler.report())
+                    print('profile of the last frames saved to profile.json')
+                else:
+                    self.profiler.start()
+                    print('profiling...')
 
             # call Node.key_handler which calls key_handlers for all drawables
             self.key_handler(key)
@@ -0,0 +1,100 @@
+""" grid mesh factory shared by the procedural ground and water
+
+    Positions, coordinates and indices of regular vertex grids are generated
+    with pure numpy. Vertex (x, y) of a grid with n_x columns has index
+    x + y * n_x, i.e. rows are stored one after the other.
+"""
+
+import weakref
+
+import numpy as np
+
+from core import IndexBuffer
+
+# one GPU index buffer per (n_x, n_y, strip, compact) grid, shared between all
+# grids of the same resolution and freed once no grid references it anymore
+_index_buffers = weakref.WeakValueDictionary()
+
+
+def grid_positions(n_x, n_y, spacing=1.0, centered=True):
+    """ (n_x * n_y, 3) float32 positions of a grid in the z=0 plane, either
+        centered around the origin like the original procedural meshes, or
+        starting at the origin """
+    xx = np.arange(n_x, dtype=np.float32) * spacing
+    yy = np.arange(n_y, dtype=np.float32) * spacing
+    if centered:
+        xx -= n_x * spacing / 2
+        yy -= n_y * spacing / 2
+
+    positions = np.zeros((n_y, n_x, 3), dtype=np.float32)
+    positions[:, :, 0] = xx[None, :]
+    positions[:, :, 1] = yy[:, None]
+    return positions.reshape(-1, 3)
+
+
+def grid_coords(n_x, n_y):
+    """ (n_x * n_y, 2) float32 coordinates in [0, 1), vertex i maps to i/n """
+    coords = np.empty((n_y, n_x, 2), dtype=np.float32)
+    coords[:, :, 0] = np.arange(n_x, dtype=np.float32)[None, :] / n_x
+    coords[:, :, 1] = np.arange(n_y, dtype=np.float32)[:, None] / n_y
+    return coords.reshape(-1, 2)
+
+
+def grid_indices(n_x, n_y, dtype=np.uint32):
+    """ index array with two counter clockwise triangles per grid cell,
+        ordered row by row """
+    corner = np.arange(n_x - 1)[None, :] + np.arange(n_y - 1)[:, None] * n_x
+    corner = corner.reshape(-1, 1)
+
+    # triangles (x, y), (x+1, y+1), (x, y+1) and (x, y), (x+1, y), (x+1, y+1)
+    offsets = np.array([0, n_x + 1, n_x, 0, 1, n_x + 1])
+    return (corner + offsets).astype(dtype).reshape(-1)
+
+
+def grid_strip_indices(n_x, n_y, dtype=np.uint32):
+    """ index array of one triangle strip per row of cells, separated by the
+        primitive restart index (the maximum value of dtype) """
+    restart = np.iinfo(dtype).max
+
+    # strip of row y alternates between row y+1 and row y, then restarts
+    strip = np.empty((n_y - 1, 2 * n_x + 1), dtype=np.int64)
+    rows = np.arange(n_y - 1)[:, None] * n_x
+    strip[:, 0:-1:2] = rows + n_x + np.arange(n_x)
+    strip[:, 1:-1:2] = rows + np.arange(n_x)
+    strip[:, -1] = restart
+    return strip.astype(dtype).reshape(-1)
+
+
+def grid_index_buffer(n_x, n_y, strip=False, compact=False):
+    """ Shared IndexBuffer for a n_x * n_y grid, drawn as GL_TRIANGLES or as
+        GL_TRIANGLE_STRIP with primitive restart if strip is set.
+        If compact is set, the grid is split in bands of rows small enough to
+        be indexed with uint16, all bands share the same index array and are
+        drawn with a different base vertex. """
+    key = (n_x, n_y, strip, compact)
+    index_buffer = _index_buffers.get(key)
+    if index_buffer is not None:
+        return index_buffer
+
+    dtype = np.uint16 if compact else np.uint32
+    make_indices = grid_strip_indices if strip else grid_indices
+    restart = np.iinfo(dtype).max if strip else None
+
+    # number of rows per band, so that the restart index is never a vertex
+    rows = n_y
+    if compact:
+        rows = min(n_y, (np.iinfo(np.uint16).max - 1) // n_x)
+        assert rows >= 2, 'grid too wide for 16 bit indices: %d' % n_x
+    index = make_indices(n_x, rows, dtype)
+
+    # consecutive bands share one row of vertices, row-major indices mean
+    # that smaller (last) bands simply draw a prefix of the index array
+    ranges = None
+    if rows < n_y:
+        per_row = index.size // (rows - 1)
+        ranges = [(per_row * (min(rows, n_y - first) - 1), first * n_x)
+                  for first in range(0, n_y - 1, rows - 1)]
+
+    index_buffer = IndexBuffer(index, restart=restart, ranges=ranges)
+    _index_buffers[key] = index_buffer
+    return index_buffer
@@ -0,0 +1,99 @@
+""" hardware instancing: many copies of a drawable in a single draw call
+
+    The Instanced decorator adds per instance vertex attributes to the vertex
+    array of the decorated mesh: a model matrix and a tint color, read once per
+    instance (attribute divisor 1) by texture.vert. All copies share the mesh,
+    its textures, uniforms and, for skinned meshes, the current pose.
+"""
+
+import ctypes
+
+import OpenGL.GL as GL
+import numpy as np
+
+from core import child_bounds
+from profiler import count_upload
+from transform import union_box, transform_box
+
+# floats per instance: model matrix columns, then tint
+INSTANCE_FLOATS = 16 + 4
+
+
+def find_mesh(drawable):
+    """ innermost drawable owning a vertex array, looked up through the decorators """
+    while not hasattr(drawable, 'vertex_array'):
+        drawable = getattr(drawable, 'drawable', getattr(drawable, 'mesh', None))
+        assert drawable is not None, 'no mesh to instance'
+    return drawable
+
+
+class Instanced:
+    """ Drawable decorator drawing instances of a (decorated) mesh with one instanced draw call.
+        Instance transforms are applied on top of the world transform of the drawable: its node
+        places and scales the asset, the instances move copies of it around the world.
+        The instance buffer can be updated every frame. """
+    static = False  # bounds follow the instances
+
+    def __init__(self, drawable, transforms, tints=None, usage=GL.GL_DYNAMIC_DRAW):
+        self.drawable = drawable
+        self.mesh = find_mesh(drawable)
+        self.usage = usage
+        self.capacity = 0
+        self.glid = GL.glGenBuffers(1)
+
+        # per instance attributes in one interleaved buffer, a mat4 attribute uses 4 locations
+        shader = self.mesh.shader.glid
+        model = GL.glGetAttribLocation(shader, 'instance_model')
+        tint = GL.glGetAttribLocation(shader, 'instance_tint')
+        assert model >= 0, 'shader does not support instancing'
+        stride = INSTANCE_FLOATS * 4
+        GL.glBindVertexArray(self.mesh.vertex_array.glid)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.glid)
+        for location, offset in [(model + column, 16 * column) for column in range(4)] + [(tint, 64)]:
+            if location >= 0:
+                GL.glEnableVertexAttribArray(location)
+                GL.glVertexAttribPointer(location, 4, GL.GL_FLOAT, False, stride, ctypes.c_void_p(offset))
+                GL.glVertexAttribDivisor(location, 1)
+        GL.glBindVertexArray(0)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
+        self.transforms = None
+        self.update(transforms, tints)
+
+    def update(self, transforms, tints=None):
+        """ upload (n, 4, 4) instance transforms and optional (n, 3 or 4) tints, white by default.
+            The buffer grows if needed, otherwise it is orphaned before the upload, so that the
+            driver gives a fresh buffer instead of waiting for draws still reading the old one """
+        self.transforms = np.asarray(transforms, np.float32).reshape(-1, 4, 4)
+        count = len(self.transforms)
+        data = np.ones((count, INSTANCE_FLOATS), np.float32)
+        data[:, :16] = self.transforms.transpose(0, 2, 1).reshape(count, 16)
+        if tints is not None:
+            tints = np.asarray(tints, np.float32).reshape(count, -1)
+            data[:, 16:16 + tints.shape[1]] = tints
+
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, self.glid)
+        if count > self.capacity:
+            self.capacity = count
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, data, self.usage)
+        elif count:
+            GL.glBufferData(GL.GL_ARRAY_BUFFER, self.capacity * data.itemsize * INSTANCE_FLOATS,
+                            None, self.usage)
+            GL.glBufferSubData(GL.GL_ARRAY_BUFFER, 0, data)
+        count_upload('buffer', data.nbytes)
+        GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
+
+    def world_bounds(self, model):
+        """ union of the bounds of the drawable moved by every instance transform """
+        bounds = child_bounds(self.drawable, model)
+        if bounds is None or not len(self.transforms):
+            return None
+        return union_box(transform_box(self.transforms, bounds))
+
+    def draw(self, frame, model, primitives=None, **uniforms):
+        if not len(self.transforms):
+            return
+        self.drawable.draw(frame, model, primitives=primitives, instances=len(self.transforms), **uniforms)
+
+    def __del__(self):
+        GL.glDeleteBuffers(1, [self.glid])
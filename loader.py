@@ -0,0 +1,111 @@
+""" asynchronous resource loading: CPU work on worker threads, GL uploads within a frame budget
+
+    Reading and decoding files, importing models and generating noise maps only
+    produce numpy arrays, which is done by a pool of workers while the viewer
+    already draws. OpenGL objects can only be created on the thread of the GL
+    context, so the results are handed back to it: every frame, pump calls the
+    upload functions of finished work until its time budget is spent.
+
+        node = Deferred()
+        loader.submit(decode_textures, lambda maps: node.resolve(Bridge(shader, *maps)), *bridge_maps)
+        ...
+        loader.pump()       # once per frame, on the GL thread
+
+    Subtrees being loaded are Deferred nodes, which draw an optional placeholder
+    until their loaded children arrive. An upload function may also be a generator,
+    e.g. uploading one texture per step: pump resumes it where it stopped, so that
+    large uploads are spread over several frames.
+"""
+
+import time
+import types
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from core import Node
+from transform import identity
+
+
+class Deferred(Node):
+    """ Node standing in for a subtree still being loaded, see Loader. It draws its
+        placeholder children, if any, until resolve replaces them by the loaded ones. """
+    static = False  # children change once loaded, bounds of the subtree are only kept after that
+
+    def __init__(self, placeholder=(), transform=identity()):
+        super().__init__(placeholder, transform)
+        self.loaded = False
+
+    def resolve(self, *children):
+        """ replace the placeholder by the loaded children """
+        self.children = list(children)
+        self.cached_bounds, self.cached_leaves, self.static_subtree = None, None, None
+        self.loaded = True
+        self.static = True  # static like the loaded subtree, see Node.is_static
+        Node.structure_changed()
+
+
+def load_now(work, upload, *args):
+    """ run work then upload right away on the calling thread, instead of with a Loader """
+    result = upload(work(*args))
+    if isinstance(result, types.GeneratorType):
+        for _ in result:
+            pass
+
+
+class Loader:
+    """ Runs work functions on an executor (a thread pool by default), then their upload
+        functions on the GL thread from pump, within budget seconds per call. """
+    def __init__(self, executor=None, budget=0.004):
+        self.executor = executor or ThreadPoolExecutor()
+        self.budget = budget
+        self.pending = []           # (future, upload) of submitted work
+        self.uploading = deque()    # upload generators started but not finished
+        self.start = None           # time of the first submission not loaded yet
+
+    def submit(self, work, upload, *args):
+        """ run work(*args) on a worker, then upload(result) on the GL thread during a later pump """
+        if self.start is None:
+            self.start = time.perf_counter()
+        future = self.executor.submit(work, *args)
+        self.pending.append((future, upload))
+        return future
+
+    @property
+    def busy(self):
+        return bool(self.pending or self.uploading)
+
+    def pump(self, budget=None):
+        """ upload finished work, in the order it finishes, until budget seconds (default the
+            loader budget) are spent. At least one upload step is done if one is ready, so that
+            loading always progresses. Work errors are raised here. Returns the steps done. """
+        deadline = time.perf_counter() + (self.budget if budget is None else budget)
+        steps = 0
+        while self.busy and (not steps or time.perf_counter() < deadline):
+            if not self.uploading:
+                done = next(((future, upload) for future, upload in self.pending if future.done()), None)
+                if done is None:
+                    break
+                self.pending.remove(done)
+                future, upload = done
+                result = upload(future.result())
+                if isinstance(result, types.GeneratorType):
+                    self.uploading.append(result)
+                steps += 1
+                continue
+            try:
+                next(self.uploading[0])
+            except StopIteration:
+                self.uploading.popleft()
+            steps += 1
+
+        if self.start is not None and not self.busy:
+            print('Loaded resources in %.2f s' % (time.perf_counter() - self.start))
+            self.start = None
+        return steps
+
+    def finish(self):
+        """ wait for all submitted work and upload it, e.g. before rendering a fixed sequence """
+        while self.busy:
+            if not self.uploading and not any(future.done() for future, _ in self.pending):
+                wait([future for future, _ in self.pending], return_when=FIRST_COMPLETED)
+            self.pump(float('inf'))
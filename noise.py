@@ -0,0 +1,190 @@
+""" noise functions complementing perlin_numpy
+
+    perlin_numpy draws random gradients for a finite lattice, so two maps
+    generated separately never fit together. The tileable noise below hashes
+    the integer lattice coordinates instead: it can be evaluated anywhere, and
+    maps generated for neighbouring tiles are seamless across their borders.
+
+    The parallel fractal noise reproduces perlin_numpy's fractal noise
+    exactly, but evaluates bands of rows on a process pool.
+"""
+
+import multiprocessing
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def _hash(ix, iy, seed):
+    """ well mixed uint64 hash of integer lattice coordinates and a seed """
+    with np.errstate(over='ignore'):
+        h = ix.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        h ^= iy.astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)
+        h ^= np.uint64(seed) * np.uint64(0x165667B19E3779F9)
+
+        # murmur3 finalizer
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xFF51AFD7ED558CCD)
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xC4CEB9FE1A85EC53)
+        h ^= h >> np.uint64(33)
+    return h
+
+
+def lattice_gradients(ix, iy, seed=0):
+    """ unit gradient vectors (..., 2) at integer lattice coordinates """
+    angles = (_hash(ix, iy, seed) >> np.uint64(11)) * (2 * np.pi / 2**53)
+    return np.stack((np.cos(angles), np.sin(angles)), axis=-1)
+
+
+def interpolant(t):
+    """ same fade curve as perlin_numpy """
+    return t*t*t*(t*(t*6 - 15) + 10)
+
+
+def perlin_noise_2d(x, y, seed=0):
+    """ perlin noise evaluated at arbitrary coordinates (arrays of same shape),
+        with one lattice cell per unit. Scaled like perlin_numpy's noise. """
+    x0, y0 = np.floor(x), np.floor(y)
+    fx, fy = x - x0, y - y0
+    ix, iy = x0.astype(np.int64), y0.astype(np.int64)
+
+    # ramps from the four surrounding lattice gradients
+    def ramp(dx, dy):
+        gradient = lattice_gradients(ix + dx, iy + dy, seed)
+        return (fx - dx) * gradient[..., 0] + (fy - dy) * gradient[..., 1]
+
+    # interpolation
+    tx, ty = interpolant(fx), interpolant(fy)
+    n0 = ramp(0, 0) * (1 - tx) + tx * ramp(1, 0)
+    n1 = ramp(0, 1) * (1 - tx) + tx * ramp(1, 1)
+    return np.sqrt(2) * ((1 - ty) * n0 + ty * n1)
+
+
+def fractal_noise_2d(x, y, period=64, octaves=1, persistence=0.5, lacunarity=2, seed=0):
+    """ fractal noise at arbitrary coordinates, summing octaves of perlin noise.
+        The first octave has one lattice cell per period units. """
+    noise = np.zeros(np.shape(x))
+    frequency = 1 / period
+    amplitude = 1
+    for octave in range(octaves):
+        noise += amplitude * perlin_noise_2d(x * frequency, y * frequency, seed=seed + octave)
+        frequency *= lacunarity
+        amplitude *= persistence
+    return noise
+
+
+# -------------- parallel version of perlin_numpy's fractal noise ------------
+def fractal_gradients(res, octaves=1, lacunarity=2, random=np.random):
+    """ random gradients of every octave, drawn from random (np.random or a RandomState)
+        in the same order as perlin_numpy """
+    gradients = []
+    frequency = 1
+    for _ in range(octaves):
+        angles = 2*np.pi*random.rand(frequency*res[0] + 1, frequency*res[1] + 1)
+        gradients.append(np.dstack((np.cos(angles), np.sin(angles))))
+        frequency *= lacunarity
+    return gradients
+
+
+def fractal_noise_rows(rows, shape, res, gradients, persistence=0.5, lacunarity=2):
+    """ rows[0]:rows[1] of perlin_numpy's fractal noise for the given gradients, computed with
+        exactly the same floating point operations as perlin_numpy for bit identical results """
+    noise = np.zeros((rows[1] - rows[0], shape[1]))
+    frequency = 1
+    amplitude = 1
+    for octave_gradients in gradients:
+        octave_res = (frequency*res[0], frequency*res[1])
+        delta = (octave_res[0] / shape[0], octave_res[1] / shape[1])
+        d = (shape[0] // octave_res[0], shape[1] // octave_res[1])
+
+        # same grid values as np.mgrid[0:res[0]:delta[0], 0:res[1]:delta[1]] % 1
+        i, j = np.arange(*rows), np.arange(shape[1])
+        grid_x = (i.astype(float)[:, None]*delta[0] + np.zeros(shape[1])) % 1
+        grid_y = (np.zeros((len(i), 1)) + j.astype(float)*delta[1]) % 1
+
+        # gradients of the surrounding lattice points, like the repeated gradient arrays
+        ci, cj = (i // d[0])[:, None], (j // d[1])[None, :]
+
+        def ramp(di, dj):
+            g = octave_gradients[ci + di, cj + dj]
+            return (grid_x - di) * g[..., 0] + (grid_y - dj) * g[..., 1]
+
+        n00, n10, n01, n11 = ramp(0, 0), ramp(1, 0), ramp(0, 1), ramp(1, 1)
+        t_x, t_y = interpolant(grid_x), interpolant(grid_y)
+        n0 = n00*(1-t_x) + t_x*n10
+        n1 = n01*(1-t_x) + t_x*n11
+        noise += amplitude * (np.sqrt(2)*((1-t_y)*n0 + t_y*n1))
+
+        frequency *= lacunarity
+        amplitude *= persistence
+    return noise
+
+
+_pools = {}     # number of workers -> pool of worker processes shared by all calls, see _worker_pool
+_pools_lock = threading.Lock()
+
+
+@contextmanager
+def _light_main():
+    """ spawned processes first import the main module of the parent, e.g. viewer.py with its
+        GL and window imports. Started in this block, they import this module instead """
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = sys.modules[__name__]
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+
+def _worker_pool(workers):
+    """ pool of worker processes, started on first use and kept for later calls. The processes
+        are spawned rather than forked, as callers may be threads of a process holding a GL context """
+    with _pools_lock:
+        if workers not in _pools:
+            # all processes of a pool are started by its constructor
+            with _light_main():
+                _pools[workers] = multiprocessing.get_context('spawn').Pool(workers)
+        return _pools[workers]
+
+
+def _noise_bands(name, shape, res, gradients, bands):
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        out = np.ndarray(shape, np.float64, memory.buf)
+        for rows in bands:
+            out[rows[0]:rows[1]] = fractal_noise_rows(rows, shape, res, gradients)
+        del out
+    finally:
+        memory.close()
+
+
+def parallel_fractal_noise_2d(shape, res, octaves=1, workers=None, band_rows=64, random=np.random):
+    """ same result as perlin_numpy's generate_fractal_noise_2d(shape, res, octaves), bit for bit
+        for the same state of random (np.random or a RandomState, e.g. seeded without touching the
+        global state), computed in bands of rows on a pool of processes which write directly into
+        a shared memory output buffer. The pool is started by the first call (all cores by default) """
+    gradients = fractal_gradients(res, octaves, random=random)
+    workers = workers or os.cpu_count()
+    bands = [(row, min(row + band_rows, shape[0])) for row in range(0, shape[0], band_rows)]
+
+    if workers == 1:
+        return np.concatenate([fractal_noise_rows(rows, shape, res, gradients) for rows in bands])
+
+    # every worker gets interleaved bands, so that the gradients are sent once per worker
+    memory = shared_memory.SharedMemory(create=True, size=shape[0] * shape[1] * 8)
+    try:
+        _worker_pool(workers).starmap(_noise_bands, [(memory.name, shape, res, gradients, bands[i::workers])
+                                                     for i in range(workers)])
+        return np.ndarray(shape, np.float64, memory.buf).copy()
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,123 @@
+""" offscreen OpenGL contexts and framebuffers, to render without a window, a display or a GPU
+
+    PyOpenGL loads GL functions through a platform (GLX, EGL, OSMesa...) chosen once, when
+    OpenGL is first imported. Headless rendering needs the EGL or OSMesa platform, which must
+    be selected before core or OpenGL are imported, e.g. with Mesa's software rasteriser:
+
+        PYOPENGL_PLATFORM=egl LIBGL_ALWAYS_SOFTWARE=1 python viewer.py --headless
+
+    The context has no default framebuffer, the scene is rendered into a Framebuffer object.
+"""
+
+import ctypes
+import os
+
+import OpenGL.GL as GL
+from OpenGL import platform as gl_platform
+import numpy as np
+
+
+class EGLContext:
+    """ OpenGL 3.3 core context on an EGL display, without any surface """
+    def __init__(self):
+        from OpenGL import EGL
+
+        # Mesa picks the X11 or Wayland display if one is set, the surfaceless platform needs none
+        os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+        self.egl = EGL
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise RuntimeError('cannot initialize an EGL display')
+
+        attributes = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                      EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE]
+        config, count = EGL.EGLConfig(), EGL.EGLint()
+        EGL.eglChooseConfig(self.display, (EGL.EGLint * len(attributes))(*attributes),
+                            ctypes.pointer(config), 1, ctypes.pointer(count))
+        if not count.value:
+            raise RuntimeError('no EGL configuration supports desktop OpenGL')
+
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        attributes = [EGL.EGL_CONTEXT_MAJOR_VERSION, 3, EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+                      EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+                      EGL.EGL_NONE]
+        self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT,
+                                            (EGL.EGLint * len(attributes))(*attributes))
+        if not self.context:
+            raise RuntimeError('cannot create an OpenGL 3.3 core context with EGL')
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, self.context)
+
+    def close(self):
+        EGL = self.egl
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroyContext(self.display, self.context)
+        EGL.eglTerminate(self.display)
+
+
+class OSMesaContext:
+    """ OpenGL 3.3 core context of Mesa's off screen interface, rendering in a client side
+        buffer. It is only made current with a small buffer, the scene goes to a Framebuffer. """
+    def __init__(self):
+        from OpenGL import osmesa
+
+        self.osmesa = osmesa
+        attributes = [osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA, osmesa.OSMESA_DEPTH_BITS, 24,
+                      osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+                      osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 3, osmesa.OSMESA_CONTEXT_MINOR_VERSION, 3, 0]
+        self.context = osmesa.OSMesaCreateContextAttribs((ctypes.c_int * len(attributes))(*attributes), None)
+        if not self.context:
+            raise RuntimeError('cannot create an OpenGL 3.3 core context with OSMesa')
+        self.buffer = (ctypes.c_ubyte * (16 * 16 * 4))()
+        if not osmesa.OSMesaMakeCurrent(self.context, self.buffer, GL.GL_UNSIGNED_BYTE, 16, 16):
+            raise RuntimeError('cannot make the OSMesa context current')
+
+    def close(self):
+        self.osmesa.OSMesaDestroyContext(self.context)
+
+
+def create_context():
+    """ offscreen context of the platform PyOpenGL was imported with, made current """
+    platform = type(gl_platform.PLATFORM).__name__
+    if platform == 'EGLPlatform':
+        return EGLContext()
+    if platform == 'OSMesaPlatform':
+        return OSMesaContext()
+    raise RuntimeError('offscreen rendering needs PYOPENGL_PLATFORM=egl or osmesa to be set '
+                       'before OpenGL is imported, PyOpenGL uses %s' % platform)
+
+
+class Framebuffer:
+    """ Framebuffer object with color and depth render buffers, rendered to instead of a window """
+    def __init__(self, width, height):
+        self.size = (width, height)
+        self.glid = GL.glGenFramebuffers(1)
+        self.renderbuffers = GL.glGenRenderbuffers(2)
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.glid)
+        for renderbuffer, internal_format, attachment in zip(
+                self.renderbuffers, (GL.GL_RGBA8, GL.GL_DEPTH_COMPONENT24),
+                (GL.GL_COLOR_ATTACHMENT0, GL.GL_DEPTH_ATTACHMENT)):
+            GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, renderbuffer)
+            GL.glRenderbufferStorage(GL.GL_RENDERBUFFER, internal_format, width, height)
+            GL.glFramebufferRenderbuffer(GL.GL_FRAMEBUFFER, attachment, GL.GL_RENDERBUFFER, renderbuffer)
+        GL.glBindRenderbuffer(GL.GL_RENDERBUFFER, 0)
+        status = GL.glCheckFramebufferStatus(GL.GL_FRAMEBUFFER)
+        assert status == GL.GL_FRAMEBUFFER_COMPLETE, 'incomplete framebuffer %#x' % status
+        self.bind()
+
+    def bind(self):
+        """ render to this framebuffer, on all of it """
+        GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, self.glid)
+        GL.glViewport(0, 0, *self.size)
+
+    def read(self):
+        """ rendered (height, width, 3) RGB image, top row first """
+        width, height = self.size
+        GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, self.glid)
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        data = GL.glReadPixels(0, 0, width, height, GL.GL_RGB, GL.GL_UNSIGNED_BYTE)
+        return np.frombuffer(data, np.uint8).reshape(height, width, 3)[::-1].copy()
+
+    def __del__(self):
+        GL.glDeleteFramebuffers(1, [self.glid])
+        GL.glDeleteRenderbuffers(2, self.renderbuffers)
@@ -4,13 +4,15 @@ import OpenGL.GL as GL
 import numpy as np
 
 from core import Mesh
-from texture import Textured, Texture
+from texture import Textured
+from assets import shared_texture
 
 class Skybox(Mesh):
     """ Mesh for the skybox. Basically just a centered inverted cube that is drawn without depth mask.
         The real magic happens in the vertex shader, where the translation component of the modelview matrix
         is removed.
     """
+    render_order = -1   # drawn first, behind everything else
     def __init__(self, shader):
         # unit cube. 8 vertices is enough since position is the only attribute
         vertices = np.array([
@@ -33,10 +35,13 @@ class Skybox(Mesh):
 
         super().__init__(shader, {"position": vertices}, index=index)
 
-    def draw(self, **uniforms):
+        # the skybox surrounds the camera, it is never culled
+        self.bounds = None
+
+    def draw(self, frame, model, **uniforms):
         """ draw without depth mask to have everything else appear in front of the skybox """
         GL.glDepthMask(GL.GL_FALSE)
-        super().draw(**uniforms)
+        super().draw(frame, model, **uniforms)
         GL.glDepthMask(GL.GL_TRUE)
 
 class Bridge(Textured):
@@ -120,12 +125,13 @@ class Bridge(Textured):
             "map_coord": tex_coords,
             "normal": normals,
             "tangent": tangents
-        }, uniforms={"apply_displacement": 0, "reflectiveness": 1, "k_s": (1, 1, 1), "s": 20}, index=index)
+        }, uniforms={"apply_displacement": 0, "apply_clipmap": 0, "apply_skinning": 0, "use_separate_map_coords": 0,
+                     "reflectiveness": 1, "k_s": (1, 1, 1), "s": 20}, index=index)
 
         # ... and textures
-        diffuse_map = Texture(diffuse_map)
-        normal_map = Texture(normal_map)
-        specular_map = Texture(specular_map)
+        diffuse_map = shared_texture(diffuse_map)
+        normal_map = shared_texture(normal_map)
+        specular_map = shared_texture(specular_map)
 
         # and finally construct parent Textured object
         super().__init__(mesh, diffuse_map=diffuse_map, normal_map=normal_map, specular_map=specular_map)
@@ -3,70 +3,90 @@
 import OpenGL.GL as GL
 import numpy as np
 import matplotlib.pyplot as plt
-from perlin_numpy import generate_perlin_noise_2d, generate_fractal_noise_2d
 
-from texture import Textured, Texture
+from texture import Textured, Texture, TextureArray
+from assets import shared_texture
+from cache import ArrayCache, cache_key
 from core import Mesh
+from transform import transform_box
+from grid import grid_positions, grid_index_buffer
+from noise import parallel_fractal_noise_2d
 from utils import displacement_to_normal_map
 
 class ProceduralWaterGPU(Textured):
     """ Procedural water is a mesh grid.
         Translation according to some wave function can be applied in the vertex shader.
     """
-    def __init__(self, shader, size, n_vertices, amplitude=1):
-        # possible values for coordinates
-        arange = np.arange(0, n_vertices, dtype=np.float32) * size/n_vertices - size/2
+    render_order = 1    # semi-transparent, drawn after the opaque objects
+    def __init__(self, shader, size, n_vertices, amplitude=1, strip=True, compact=True):
+        # vertices of a n_vertices x n_vertices grid in the z=0 plane, centered around the origin
+        vertices = grid_positions(n_vertices, n_vertices, spacing=size/n_vertices)
 
-        # meshgrid returns all possible combinations of coordinates in a slightly weird format
-        # --> 2-tuple of 2D arrays
-        xx, yy = np.meshgrid(arange, arange)
+        # index buffer shared with all other grids of the same resolution,
+        # by default drawn as triangle strips with 16 bit indices
+        index = grid_index_buffer(n_vertices, n_vertices, strip=strip, compact=compact)
+        primitives = GL.GL_TRIANGLE_STRIP if strip else GL.GL_TRIANGLES
 
-        # z component is always 0
-        zz = np.zeros(xx.shape, dtype=np.float32)
+        # create mesh, pass amplitude as uniform to the shaders
+        mesh = Mesh(shader,{
+            "position": vertices
+        }, uniforms={"amplitude": amplitude}, index=index, primitives=primitives)
 
-        # reshape into (n_vertices, 3)
-        vertices = np.stack([xx, yy, zz]).reshape(3, -1).T
+        # waves move the vertices up and down by at most the amplitude
+        mesh.bounds[:, 2] += (-amplitude, amplitude)
 
-        # create index array by adding 2 triangles per vertex except those that lie on the top/right border
-        index_list = []
-        for x in range(n_vertices - 1):
-            for y in range(n_vertices - 1):
-                index_list.extend((x + y*n_vertices, (x+1) + (y+1) * n_vertices, x + (y+1) * n_vertices))
-                index_list.extend((x + y*n_vertices, (x+1) + y * n_vertices, (x+1) + (y+1) * n_vertices))
+        super().__init__(mesh)
 
-        index = np.array(index_list, dtype=np.int32)
 
-        # create mesh, pass amplitude as uniform to the shaders
-        mesh = Mesh(shader,{
+class ProjectedWaterGPU(Textured):
+    """ Level of detail version of the procedural water: a fixed grid in screen space is projected
+        onto the water plane (z=0 plane of the model frame) every frame in the vertex shader
+        (shaders/water_projected.vert), so the vertex density follows the screen pixels and the cost
+        is the same however large the water surface is. The surface ends at max_distance.
+    """
+    render_order = 1    # semi-transparent, drawn after the opaque objects
+    def __init__(self, shader, n_x=320, n_y=180, amplitude=1, max_distance=1000, margin=0.1,
+                 strip=True, compact=True):
+        # grid in normalized device coordinates, a bit larger than the screen so that
+        # the waves never pull the border of the surface into view
+        vertices = grid_positions(n_x, n_y, centered=False)
+        vertices[:, 0] = (vertices[:, 0] / (n_x - 1) * 2 - 1) * (1 + margin)
+        vertices[:, 1] = (vertices[:, 1] / (n_y - 1) * 2 - 1) * (1 + margin)
+
+        index = grid_index_buffer(n_x, n_y, strip=strip, compact=compact)
+        primitives = GL.GL_TRIANGLE_STRIP if strip else GL.GL_TRIANGLES
+
+        mesh = Mesh(shader, {
             "position": vertices
-        }, uniforms={"amplitude": amplitude}, index=index)
+        }, uniforms={"amplitude": amplitude, "max_distance": max_distance}, index=index, primitives=primitives)
+
+        # the surface follows the camera, it is never culled
+        mesh.bounds = None
 
         super().__init__(mesh)
 
+    def draw(self, frame, model, primitives=None, **uniforms):
+        # view rays start at the camera, so the translation of the view matrix is left out
+        rotation = np.array(frame.uniforms['view'])
+        rotation[:3, 3] = 0
+        uniforms['screen_to_ray'] = np.linalg.inv(frame.uniforms['projection'] @ rotation)
+        super().draw(frame, model, primitives, **uniforms)
+
 
 class ProceduralGroundGPU(Textured):
     """ Similar to procedural water, except that displacement is given by a texture of perlin noise.
         Normals are also given by a precomputed texture.
     """
-    def __init__(self, shader, tex_file, grid_size=100, perlin_size=(5, 5), amplitude=1):
+    def __init__(self, shader, tex_file, grid_size=100, perlin_size=(5, 5), amplitude=1,
+                 strip=True, compact=True, seed=None, cache=None, octahedral=False, maps=None):
         # position array (called grid here) similar to the procedural water
-        xx, yy = list(np.meshgrid(np.arange(grid_size, dtype=np.float32), np.arange(grid_size, dtype=np.float32)))
-
-        xx -= grid_size / 2
-        yy -= grid_size / 2
-
-        zz = np.zeros(xx.shape)
-
-        grid = np.stack((xx, yy, zz)).reshape(3, -1).T
-        grid = grid.astype(np.float32)
+        grid = grid_positions(grid_size, grid_size)
 
-        # placeholder normals (real normals given by texture, see below)
-        normals = np.zeros(grid.shape, dtype=np.float32)
-        normals[:, 2] = 1
+        # placeholder normals (real normals given by texture, see below), constant for all vertices
+        normals = np.array((0, 0, 1), dtype=np.float32)
 
         # tangents are required so that we can apply a normal map correctly
-        tangents = np.zeros(grid.shape, dtype=np.float32)
-        tangents[:, 0] = 1
+        tangents = np.array((1, 0, 0), dtype=np.float32)
 
         # texture coordinates are different for displacement/normal map (map_coords)
         # and diffuse map (tex_coords)
@@ -75,28 +95,14 @@ class ProceduralGroundGPU(Textured):
 
         tex_coords = map_coords * 50
 
-        # index array creation similar to procedural water
-        index_list = []
-        for x in range(grid_size-1):
-            for z in range(grid_size-1):
-                index_list.extend((x + z*grid_size, (x+1) + (z+1) * grid_size, x + (z+1) * grid_size))
-                index_list.extend((x + z*grid_size, (x+1) + z * grid_size, (x+1) + (z+1) * grid_size))
-
-        index = np.array(index_list, dtype=np.int32)
-
-        # displacement map 2x the size of the vertex grid for more accurate normals
-        #displacement_map = generate_perlin_noise_2d((grid_size*2, grid_size*2), perlin_size).astype(np.float32) * amplitude
-        displacement_map = generate_fractal_noise_2d((grid_size*2, grid_size*2), perlin_size, 6).astype(np.float32) * amplitude
-        
-        # compute normals from displacement map
-        normal_map = displacement_to_normal_map(displacement_map, scale=2)
-
-        # uncomment below for a plot of the displacement/normal maps
-        # fig, axs = plt.subplots(1, 2, dpi=200)
-        # axs[0].imshow(displacement, cmap="gray")
-        # axs[1].imshow(normals)
-        # plt.show()
-        
+        # index buffer creation similar to procedural water
+        index = grid_index_buffer(grid_size, grid_size, strip=strip, compact=compact)
+        primitives = GL.GL_TRIANGLE_STRIP if strip else GL.GL_TRIANGLES
+
+        # displacement and normal maps, see generate_ground_maps, unless generated ahead of time
+        displacement_map, normal_map = maps or generate_ground_maps(grid_size, perlin_size, amplitude,
+                                                                    seed=seed, cache=cache, octahedral=octahedral)
+
         # generate mesh
         mesh = Mesh(shader, attributes={
             "position": grid,
@@ -109,18 +115,210 @@ class ProceduralGroundGPU(Textured):
             "reflectiveness": 0, 
             "k_s": (0, 0, 0), 
             "apply_skinning": 0,
+            "apply_clipmap": 0,
             "use_separate_map_coords": 1
-        }, index=index)
+        }, index=index, primitives=primitives)
+
+        # displacement moves the vertices up and down in the vertex shader
+        mesh.bounds[:, 2] += (displacement_map.min(), displacement_map.max())
 
         # generate textures
-        # note that the displacement map is passed as float, which required some modification to the texture class
-        diffuse_map = Texture(tex_file, GL.GL_REPEAT, GL.GL_NEAREST, GL.GL_NEAREST)
-        displacement_map = Texture(displacement_map, GL.GL_REPEAT, GL.GL_LINEAR, GL.GL_LINEAR, 
-            internal_format=GL.GL_R32F, format=GL.GL_RED, data_type=GL.GL_FLOAT)
-        normal_map = Texture(normal_map, GL.GL_REPEAT, GL.GL_LINEAR, GL.GL_LINEAR,
-            internal_format=GL.GL_RGB, format=GL.GL_RGB, data_type=GL.GL_UNSIGNED_BYTE)
-
-        super().__init__(mesh, diffuse_map=diffuse_map, displacement_map=displacement_map, normal_map=normal_map)
+        textures = ground_textures(tex_file, displacement_map, normal_map)
+
+        super().__init__(mesh, **textures)
+
+
+class Clipmap:
+    """ Geometry clipmap: nested square rings of fixed-size grid blocks centered on the camera,
+        each ring having half the vertex density of the previous one.
+        Vertex positions are given in block units, the vertex shader (apply_clipmap) scales and moves
+        them into place and samples displacement/normal maps at the resulting ground position.
+
+        Per axis, a ring of m x m vertex blocks is laid out as block, block, fixup (2 cells), block, block,
+        leaving a hole of 2m cells of its own level. The finer level inside the hole is one cell smaller,
+        the remaining L-shaped gap is filled by trim strips on the side the finer level moved away from.
+        Vertices close to the outer border of a level are morphed onto the coarser grid to avoid cracks.
+        The rings are limited to the (low, high) ground coordinates of extent along both axes: pieces
+        outside of it are skipped and vertices past its border are clamped onto it by the vertex shader.
+    """
+    def __init__(self, shader, block_size=32, levels=4, spacing=1, uniforms=None, heights=(0, 0),
+                 extent=(-np.inf, np.inf)):
+        m = self.block_size = block_size
+        self.shader = shader
+        self.levels = levels
+        self.spacing = spacing
+        self.extent = extent
+        uniforms = dict(uniforms or {}, clipmap_extent=extent)
+
+        def piece(n_x, n_y):
+            # all pieces are grids with their first vertex at (0, 0) and a spacing of one cell
+            index = grid_index_buffer(n_x, n_y, strip=True, compact=True)
+            mesh = Mesh(shader, {"position": grid_positions(n_x, n_y, centered=False)},
+                        uniforms=uniforms, index=index, primitives=GL.GL_TRIANGLE_STRIP)
+
+            # bounds in cells, one more cell below since vertices are morphed towards lower coordinates,
+            # heights are the (min, max) displacement of the ground
+            mesh.bounds[0, :2] -= 1
+            mesh.bounds[:, 2] = heights
+            return mesh
+
+        self.block = piece(m, m)
+        self.fixup_x, self.fixup_y = piece(3, m), piece(m, 3)
+        self.trim_x, self.trim_y = piece(2, 2*m + 1), piece(2*m, 2)
+        self.center = piece(2*m + 1, 2*m + 1)
+
+        # pieces of one ring, with cell offsets inside the level:
+        # 12 blocks and 4 fixups around the 3x3 central slots
+        starts = (0, m - 1, 2*m - 2, 2*m, 3*m - 1)
+        self.ring = []
+        for i, x in enumerate(starts):
+            for j, y in enumerate(starts):
+                if 1 <= i <= 3 and 1 <= j <= 3:
+                    continue
+                mesh = self.fixup_x if i == 2 else self.fixup_y if j == 2 else self.block
+                self.ring.append((mesh, np.array((x, y), np.float32)))
+
+        # morph to the coarser grid over the last cells of each level
+        width = max(2, m // 4)
+        self.morph = np.array((2*m - 1 - width, width - 1), np.float32)
+
+    def origins(self, camera):
+        """ lower left corner of every level, coarsest level snapped to its own double spacing,
+            finer levels placed in the hole of the next coarser one, as centered on camera as possible """
+        m, origins = self.block_size, [None] * self.levels
+        for level in reversed(range(self.levels)):
+            cell = self.spacing * 2**level
+            wanted = camera - (2*m - 1) * cell
+            if level == self.levels - 1:
+                origins[level] = np.floor(wanted / (2*cell)) * 2*cell
+            else:
+                hole = origins[level + 1] + (m - 1) * 2*cell
+                origins[level] = hole + 2*cell * (wanted >= hole + cell)
+        return origins
+
+    def pieces(self, camera):
+        """ generator of (mesh, offset, cell size, level center) for all pieces around camera """
+        m = self.block_size
+        origins = self.origins(camera)
+        for level, origin in enumerate(origins):
+            cell = self.spacing * 2**level
+            center = origin + (2*m - 1) * cell
+            for mesh, start in self.ring:
+                yield mesh, origin + start * cell, cell, center
+
+            if level == 0:
+                yield self.center, origin + (m - 1) * cell, cell, center
+                continue
+
+            # trims fill the cells of the hole not covered by the finer level
+            trim = np.where(origins[level - 1] == origin + (m - 1) * cell, 3*m - 2, m - 1)
+            trim_y_start = m if trim[0] == m - 1 else m - 1
+            yield self.trim_x, origin + np.array((trim[0], m - 1)) * cell, cell, center
+            yield self.trim_y, origin + np.array((trim_y_start, trim[1])) * cell, cell, center
+
+    def draw(self, frame, model, primitives=None, **uniforms):
+        """ draw all pieces, the rings are centered on the camera position in ground coordinates.
+            Pieces outside of the view frustum of the frame, if any, are skipped """
+        camera = (np.linalg.inv(model) @ frame.uniforms.get('w_camera_position', (0, 0, 0, 1)))[:2]
+        low, high = self.extent
+        for mesh, offset, cell, center in self.pieces(camera):
+            bounds = mesh.bounds * (cell, cell, 1) + (*offset, 0)
+            if (bounds[1, :2] < low).any() or (bounds[0, :2] > high).any():
+                continue
+            if frame.frustum is not None:
+                if not frame.frustum.intersects(transform_box(model, bounds)):
+                    frame.stats['culled_draws'] += 1
+                    continue
+            mesh.draw(frame, model, primitives,
+                      clipmap_offset=offset, clipmap_scale=cell, clipmap_center=center,
+                      clipmap_morph=self.morph, **uniforms)
+
+
+class ClipmapGroundGPU(Textured):
+    """ Level of detail version of the procedural ground, drawn as a geometry clipmap.
+        The number of triangles only depends on block_size and levels, not on grid_size,
+        and vertices next to the camera keep the density of the full resolution ground.
+        The rings end where the full resolution ground does, rather than repeat its maps.
+    """
+    def __init__(self, shader, tex_file, grid_size=100, perlin_size=(5, 5), amplitude=1,
+                 block_size=32, levels=None, seed=None, cache=None, octahedral=False, maps=None):
+        # by default, enough levels so that the coarsest ring covers the whole ground
+        if levels is None:
+            levels = 1 + max(0, int(np.ceil(np.log2(grid_size / (4*block_size - 2)))))
+
+        # same maps and textures as the full resolution ground, unless generated ahead of time
+        displacement_map, normal_map = maps or generate_ground_maps(grid_size, perlin_size, amplitude,
+                                                                    seed=seed, cache=cache, octahedral=octahedral)
+        textures = ground_textures(tex_file, displacement_map, normal_map)
+        heights = (displacement_map.min(), displacement_map.max())
+
+        # same square as the vertices of the full resolution ground, see grid_positions
+        extent = (-grid_size / 2, grid_size / 2 - 1)
+        clipmap = Clipmap(shader, block_size, levels, heights=heights, extent=extent, uniforms={
+            "apply_clipmap": 1,
+            "map_size": grid_size,
+            "tex_scale": 50,
+            "apply_displacement": 1,
+            "reflectiveness": 0,
+            "k_s": (0, 0, 0),
+            "apply_skinning": 0,
+            "use_separate_map_coords": 1
+        })
+
+        super().__init__(clipmap, **textures)
+
+
+def generate_ground_maps(grid_size, perlin_size=(5, 5), amplitude=1, octaves=6, seed=None, cache=None,
+                         workers=None, octahedral=False):
+    """ displacement map (float32) of fractal perlin noise and the normal map (uint8) computed from it,
+        with two channels of octahedral encoded normals instead of three if octahedral is set.
+        With a seed, the maps are reproducible and stored in the on-disk cache (default ArrayCache
+        unless cache is False), so later runs memory map them instead of generating them again.
+    """
+    if seed is None or cache is False:
+        return _generate_ground_maps(grid_size, perlin_size, amplitude, octaves, seed, workers, octahedral)
+
+    cache = cache or ArrayCache()
+    key = cache_key('ground-maps', grid_size=grid_size, perlin_size=perlin_size,
+                    octaves=octaves, amplitude=amplitude, seed=seed, octahedral=octahedral)
+    maps = cache.get_or_create(key, lambda: dict(zip(('displacement', 'normal'), _generate_ground_maps(
+        grid_size, perlin_size, amplitude, octaves, seed, workers, octahedral))))
+    return maps['displacement'], maps['normal']
+
+
+def _generate_ground_maps(grid_size, perlin_size, amplitude, octaves, seed, workers, octahedral=False):
+    # gradients are drawn from a random state of our own, the maps may be generated by a loader thread.
+    # it gives the same numbers as np.random seeded with seed, so maps are those perlin_numpy made
+    random = np.random.RandomState(seed)
+
+    # displacement map 2x the size of the vertex grid for more accurate normals
+    #displacement_map = generate_perlin_noise_2d((grid_size*2, grid_size*2), perlin_size).astype(np.float32) * amplitude
+    displacement_map = parallel_fractal_noise_2d((grid_size*2, grid_size*2), perlin_size, octaves,
+                                                 workers=workers, random=random).astype(np.float32) * amplitude
+
+    # compute normals from displacement map
+    normal_map = displacement_to_normal_map(displacement_map, scale=2, octahedral=octahedral)
+
+    # uncomment below for a plot of the displacement/normal maps
+    # fig, axs = plt.subplots(1, 2, dpi=200)
+    # axs[0].imshow(displacement, cmap="gray")
+    # axs[1].imshow(normals)
+    # plt.show()
+
+    return displacement_map, normal_map
+
+
+def ground_textures(tex_file, displacement_map, normal_map):
+    """ diffuse, displacement and normal map textures of the procedural ground """
+    # note that the displacement map is passed as float, which required some modification to the texture class
+    diffuse_map = shared_texture(tex_file, wrap_mode=GL.GL_REPEAT, mag_filter=GL.GL_NEAREST, min_filter=GL.GL_NEAREST)
+    displacement_map = Texture(displacement_map, GL.GL_REPEAT, GL.GL_LINEAR, GL.GL_LINEAR,
+        internal_format=GL.GL_R32F, format=GL.GL_RED, data_type=GL.GL_FLOAT)
+    # normal maps are sampled from texture arrays like those of the other materials.
+    # two channel maps hold octahedral encoded normals, see displacement_to_normal_map
+    normal_map = TextureArray(GL.GL_REPEAT, GL.GL_LINEAR, GL.GL_LINEAR).add(normal_map)
+
+    return dict(diffuse_map=diffuse_map, displacement_map=displacement_map, normal_map=normal_map)
 
 if __name__ == "__main__":
     pass
@@ -0,0 +1,167 @@
+""" frame profiler: GPU time of every draw and CPU time of the scene graph traversal
+
+    The GPU time of each draw of the render queue is measured with a GL_TIME_ELAPSED
+    query, read back a few frames later so that the CPU never waits for the GPU.
+    CPU time is measured in nested scopes: node subtrees, draws, uniform uploads and
+    keyframe evaluation. Instrumented code reads the profiler from the frame context,
+    None unless profiling, and does nothing more when it is not set:
+
+        profiler = frame.profiler
+        if profiler:
+            profiler.begin('keyframes')
+        ...
+        if profiler:
+            profiler.end()
+
+    Every frame gives a breakdown of the CPU (self time of the scopes) and GPU time
+    per name. The last frames are kept for a rolling average (report) and can be saved
+    as a Chrome trace (save), to be opened in chrome://tracing or ui.perfetto.dev.
+
+    Data uploaded to the GPU is counted whether profiling or not, see count_upload.
+"""
+
+import ctypes
+import json
+import time
+from collections import Counter, deque, defaultdict
+
+import OpenGL.GL as GL
+
+# bytes uploaded since the last frame, by counter name. The viewer adds them to the statistics
+# of the frame being drawn, including the uploads of the loader before the frame starts
+uploads = Counter()
+
+
+def count_upload(kind, nbytes):
+    """ count nbytes of buffer or texture data uploaded to the GPU, kind being 'buffer' or 'texture' """
+    uploads[kind + '_bytes'] += int(nbytes)
+
+
+class Profiler:
+    """ Collects CPU scopes and GPU draw queries frame by frame, see the module documentation.
+        GPU results are read latency frames after being issued, or later if not yet available.
+        The breakdowns and trace events of the last history frames are kept. """
+    def __init__(self, history=300, latency=3):
+        self.enabled = False
+        self.latency = latency
+        self.origin = time.perf_counter()
+        self.frames = deque(maxlen=history)     # per frame breakdowns, GPU part filled in later
+        self.events = deque(maxlen=history)     # per frame Chrome trace events
+        self.pending = deque()                  # (breakdown, events, [(name, query)]) not read back yet
+        self.free_queries = []
+        self.index = 0
+        self.record = None
+
+    def start(self):
+        self.enabled = True
+
+    def stop(self):
+        """ stop profiling, dropping the GPU results that were not read back yet """
+        self.enabled = False
+        for _, _, queries in self.pending:
+            self.free_queries.extend(query for _, query in queries)
+        self.pending.clear()
+
+    def timestamp(self):
+        """ microseconds since the profiler was created, the time unit of Chrome traces """
+        return (time.perf_counter() - self.origin) * 1e6
+
+    # ------------ per frame
+    def begin_frame(self, frame_time=0.):
+        """ start recording a frame, frame_time being the animation time it is drawn at """
+        self.record = dict(frame=self.index, time=frame_time, cpu=defaultdict(float), gpu=None)
+        self.stack = []         # [name, start, time spent in nested scopes] of open scopes
+        self.frame_events = []
+        self.queries = []
+        self.begin('frame')
+
+    def end_frame(self):
+        """ finish the frame, then read back the GPU results of earlier frames that are available """
+        self.end()
+        record = self.record
+        record['cpu'] = dict(record['cpu'])
+        record['cpu_ms'] = self.frame_events[-1]['dur'] / 1e3
+        self.frames.append(record)
+        self.events.append(self.frame_events)
+        self.pending.append((record, self.frame_events, self.queries))
+        self.index += 1
+        self.record = None
+        self.read_queries()
+
+    # ------------ CPU scopes
+    def begin(self, name):
+        self.stack.append([name, self.timestamp(), 0.])
+
+    def end(self):
+        """ close the innermost scope, its self time excludes the time of nested scopes """
+        name, start, nested = self.stack.pop()
+        duration = self.timestamp() - start
+        if self.stack:
+            self.stack[-1][2] += duration
+        self.record['cpu'][name] += (duration - nested) / 1e3
+        self.frame_events.append(dict(name=name, cat='cpu', ph='X', ts=start, dur=duration, pid=0, tid=0))
+
+    # ------------ GPU queries, which cannot be nested
+    def begin_gpu(self, name):
+        query = self.free_queries.pop() if self.free_queries else int(GL.glGenQueries(1)[0])
+        GL.glBeginQuery(GL.GL_TIME_ELAPSED, query)
+        self.queries.append((name, query))
+
+    def end_gpu(self):
+        GL.glEndQuery(GL.GL_TIME_ELAPSED)
+
+    def read_queries(self):
+        """ breakdown of GPU time of the oldest frames whose queries are all available. Queries of
+            a frame end in order, the last one being available means all of them are """
+        available = ctypes.c_int()
+        elapsed = ctypes.c_uint64()
+        while self.pending and self.pending[0][0]['frame'] <= self.index - self.latency:
+            record, events, queries = self.pending[0]
+            if queries:
+                GL.glGetQueryObjectiv(queries[-1][1], GL.GL_QUERY_RESULT_AVAILABLE, ctypes.byref(available))
+                if not available.value:
+                    return
+            self.pending.popleft()
+
+            # GPU time stamps are not known, draws are shown one after the other from the frame start
+            gpu, start = defaultdict(float), events[-1]['ts']
+            for name, query in queries:
+                GL.glGetQueryObjectui64v(query, GL.GL_QUERY_RESULT, ctypes.byref(elapsed))
+                duration = elapsed.value / 1e3
+                gpu[name] += duration / 1e3
+                events.append(dict(name=name, cat='gpu', ph='X', ts=start, dur=duration, pid=0, tid=1))
+                start += duration
+                self.free_queries.append(query)
+            record['gpu'] = dict(gpu)
+            record['gpu_ms'] = sum(gpu.values())
+
+    # ------------ results
+    def report(self, frames=60, top=8):
+        """ text breakdown of the mean time per frame over the last frames with GPU results """
+        records = [record for record in self.frames if record['gpu'] is not None][-frames:]
+        if not records:
+            return 'no profiled frame yet'
+        lines = ['%d frames: CPU %.2f ms, GPU %.2f ms per frame' % (
+            len(records), sum(r['cpu_ms'] for r in records) / len(records),
+            sum(r['gpu_ms'] for r in records) / len(records))]
+        for part in ('cpu', 'gpu'):
+            totals = defaultdict(float)
+            for record in records:
+                for name, duration in record[part].items():
+                    totals[name] += duration / len(records)
+            for name, duration in sorted(totals.items(), key=lambda item: -item[1])[:top]:
+                lines.append('  %s %8.3f ms  %s' % (part.upper(), duration, name))
+        return '\n'.join(lines)
+
+    def save(self, file):
+        """ save the kept frames as a Chrome trace, with their breakdowns under 'frames' """
+        metadata = [dict(name='thread_name', ph='M', pid=0, tid=tid, args=dict(name=name))
+                    for tid, name in ((0, 'CPU'), (1, 'GPU (draws laid out from the frame start)'))]
+        events = [event for frame_events in self.events for event in frame_events]
+        with open(file, 'w') as output:
+            json.dump(dict(traceEvents=metadata + events, frames=list(self.frames)), output)
+
+    def __del__(self):
+        queries = self.free_queries + [query for _, _, queries in self.pending for _, query in queries]
+        if queries:
+            GL.glDeleteQueries(len(queries), queries)
@@ -1,8 +1,13 @@
 #version 330 core
 
 uniform mat4 model;
-uniform mat4 view;
-uniform mat4 projection;
+layout(std140, row_major) uniform FrameUniforms {
+    mat4 view;
+    mat4 rotation;
+    mat4 projection;
+    vec3 w_camera_position;
+    float timer;
+};
 in vec3 position;
 in vec3 color;
 
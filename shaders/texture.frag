@@ -2,35 +2,53 @@
 
 #version 330 core
 
-uniform sampler2D diffuse_map;
-uniform sampler2D normal_map;
-uniform sampler2D specular_map;
+// material maps are layers of texture arrays (texture.TextureArray), shared by several materials
+uniform sampler2DArray diffuse_map;
+uniform sampler2DArray normal_map;
+uniform sampler2DArray specular_map;
+uniform int diffuse_map_layer;
+uniform int normal_map_layer;
+uniform int specular_map_layer;
 
 uniform samplerCube environment_map;
 
-uniform mat4 view;
-uniform vec3 w_camera_position;
-uniform float timer;
+layout(std140, row_major) uniform FrameUniforms {
+    mat4 view;
+    mat4 rotation;
+    mat4 projection;
+    vec3 w_camera_position;
+    float timer;
+};
 uniform float reflectiveness;
 uniform vec3 k_s;
 uniform float s;
+uniform int octahedral_normals;
 
 in vec3 w_position, w_normal, w_tangent, w_bitangent;
 in vec2 frag_tex_coords;
 in vec2 frag_map_coords;
 
 in mat3 TBN;
+in vec4 frag_tint;
 
 out vec4 out_color;
 
+// function to decode a normal stored in two channels with the octahedral encoding
+vec3 octahedralDecode(vec2 e) {
+    vec3 n = vec3(e, 1 - abs(e.x) - abs(e.y));
+    float t = max(-n.z, 0);
+    n.xy += vec2(n.x >= 0 ? -t : t, n.y >= 0 ? -t : t);
+    return normalize(n);
+}
+
 // function to calculate fog based on distance to camera
 float exponentialFog(float dist, float density) {
     return clamp(1 - exp(-pow(density * dist, 2)), 0, 1);
 }
 
 void main() {
-    // diffuse color is given by diffuse map
-    vec3 k_d = texture(diffuse_map, frag_tex_coords).xyz;
+    // diffuse color is given by diffuse map, tinted per instance
+    vec3 k_d = texture(diffuse_map, vec3(frag_tex_coords, diffuse_map_layer)).xyz * frag_tint.rgb;
     
     // some fraction of that is the ambient color
     vec3 k_a = k_d * 0.25;
@@ -40,7 +58,10 @@ void main() {
     vec3 light_dir = normalize(vec3(cos(timer), sin(timer), 1));
 
     // read normal from normal map and re-scale to [-1, 1]
-    vec3 n = 2 * texture(normal_map, frag_map_coords).xyz - 1;
+    vec3 n = 2 * texture(normal_map, vec3(frag_map_coords, normal_map_layer)).xyz - 1;
+    if (octahedral_normals == 1) {
+        n = octahedralDecode(n.xy);
+    }
 
     // transform into tangent space so that vertex normals are taken into account
     n = normalize(TBN * n);
@@ -52,7 +73,7 @@ void main() {
     vec3 v = normalize(w_position - w_camera_position);
 
     // get reflectiveness from specular map
-    float actual_reflectiveness = reflectiveness * texture(specular_map, frag_map_coords).r;
+    float actual_reflectiveness = reflectiveness * texture(specular_map, vec3(frag_map_coords, specular_map_layer)).r;
 
     // specular term for phong shading
     vec3 spec = actual_reflectiveness * k_s * max(0, pow(dot(r, -v), s));
@@ -6,11 +6,16 @@ const int MAX_BONES=128;
 const int MAX_VERTEX_BONES=4;
 
 uniform sampler2D displacement_map;
-uniform sampler2D normal_map;
+uniform sampler2DArray normal_map;
 
 uniform mat4 model;
-uniform mat4 view;
-uniform mat4 projection;
+layout(std140, row_major) uniform FrameUniforms {
+    mat4 view;
+    mat4 rotation;
+    mat4 projection;
+    vec3 w_camera_position;
+    float timer;
+};
 
 uniform mat4 bone_matrix[MAX_BONES];
 
@@ -19,19 +24,36 @@ uniform mat4 bone_matrix[MAX_BONES];
 uniform int apply_displacement;
 uniform int apply_skinning;
 uniform int use_separate_map_coords;
+uniform int use_instancing;
+
+// geometry clipmap: positions are given in cells of a block, which is scaled and moved into place.
+// vertices near the outer border of a level are morphed onto the grid of the next coarser level
+uniform int apply_clipmap;
+uniform vec2 clipmap_offset;
+uniform float clipmap_scale;
+uniform vec2 clipmap_center;
+uniform vec2 clipmap_morph;     // (start, length) of the morph region, in cells from the level center
+uniform vec2 clipmap_extent;    // (low, high) ground coordinates covered along both axes
+uniform float map_size;         // ground units covered by the displacement/normal maps
+uniform float tex_scale;        // diffuse texture repetitions per map
 
 in vec3 position;
 in vec3 normal;
 in vec3 tangent;
 in vec2 tex_coord;
 in vec2 map_coord;
-in vec4 bone_ids;
+in uvec4 bone_ids;
 in vec4 bone_weights;
 
+// per instance attributes of instanced meshes (instancing.py): world transform and tint
+in mat4 instance_model;
+in vec4 instance_tint;
+
 out vec2 frag_tex_coords;
 out vec2 frag_map_coords;
 out vec3 w_position, w_normal, w_tangent, w_bitangent;
 out mat3 TBN;
+out vec4 frag_tint;
 
 void main() {
     // if skinning is not enabled, just use model matrix
@@ -46,23 +68,56 @@ void main() {
         }
     }
 
+    // instances are copies of the mesh moved around the world
+    frag_tint = vec4(1);
+    if (use_instancing > 0) {
+        skin_matrix = instance_model * skin_matrix;
+        frag_tint = instance_tint;
+    }
+
+    vec3 vertex_position = position;
+    vec2 vertex_tex_coord = tex_coord;
+    vec2 vertex_map_coord = map_coord;
+    vec3 vertex_normal = normal;
+    vec3 vertex_tangent = tangent;
+
+    if (apply_clipmap > 0) {
+        // ground position of the vertex, then morph odd vertices onto their even neighbour
+        vec2 ground = position.xy * clipmap_scale + clipmap_offset;
+        vec2 cells = abs(ground - clipmap_center) / clipmap_scale;
+        float morph = clamp((max(cells.x, cells.y) - clipmap_morph.x) / clipmap_morph.y, 0, 1);
+        ground -= mod(ground / clipmap_scale, 2.0) * clipmap_scale * morph;
+
+        // vertices past the end of the ground collapse onto its border
+        ground = clamp(ground, clipmap_extent.x, clipmap_extent.y);
+
+        // coordinates are derived from the ground position, like for the full resolution ground
+        vertex_position = vec3(ground, 0);
+        vertex_map_coord = ground / map_size - 0.5;
+        vertex_tex_coord = vertex_map_coord * tex_scale;
+
+        // flat ground, real normals are given by the normal map
+        vertex_normal = vec3(0, 0, 1);
+        vertex_tangent = vec3(1, 0, 0);
+    }
+
     // displacement mapping, only applied when corresponding flag is true
-    float displacement = texture(displacement_map, map_coord).r;
+    float displacement = texture(displacement_map, vertex_map_coord).r;
     vec3 displacement_vector = (apply_displacement > 0) ? vec3(0, 0, displacement) : vec3(0);
 
     // map to camera space
-    gl_Position = projection * view * skin_matrix * (vec4(position + displacement_vector, 1));
+    gl_Position = projection * view * skin_matrix * (vec4(vertex_position + displacement_vector, 1));
 
     // if model uses separate sets of texture coordinates, pass the correct ones here
-    frag_tex_coords = tex_coord;
-    frag_map_coords = (use_separate_map_coords == 1) ? map_coord : tex_coord;
+    frag_tex_coords = vertex_tex_coord;
+    frag_map_coords = (use_separate_map_coords == 1) ? vertex_map_coord : vertex_tex_coord;
 
     // world position, normal, tangent and bitangent are passed to the fragment shader
-    vec4 w_position4 = view * skin_matrix * vec4(position, 1);
+    vec4 w_position4 = view * skin_matrix * vec4(vertex_position, 1);
     w_position = vec3(w_position4) / w_position4.w;
 
-    w_normal = (transpose(inverse(mat3(skin_matrix)))) * normal;
-    w_tangent = mat3(skin_matrix) * tangent;
+    w_normal = (transpose(inverse(mat3(skin_matrix)))) * vertex_normal;
+    w_tangent = mat3(skin_matrix) * vertex_tangent;
     w_bitangent = cross(w_normal, w_tangent);
     
     // for convenience also pass TBN matrix
@@ -4,8 +4,13 @@
 
 uniform samplerCube environment_map;
 
-uniform float timer;
-uniform vec3 w_camera_position;
+layout(std140, row_major) uniform FrameUniforms {
+    mat4 view;
+    mat4 rotation;
+    mat4 projection;
+    vec3 w_camera_position;
+    float timer;
+};
 
 in vec3 w_position;
 
@@ -4,8 +4,14 @@
 #version 330 core
 
 uniform float amplitude;
-uniform float timer;
-uniform mat4 projection, view, model;
+uniform mat4 model;
+layout(std140, row_major) uniform FrameUniforms {
+    mat4 view;
+    mat4 rotation;
+    mat4 projection;
+    vec3 w_camera_position;
+    float timer;
+};
 
 in vec3 position;
 
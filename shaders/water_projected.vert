@@ -0,0 +1,47 @@
+// projected grid water vertex shader: the grid is given in screen space (normalized device coordinates),
+// every vertex is moved along its view ray onto the water plane, then displaced like in water.vert
+// normals are calculated in the fragment shader (water.frag)
+
+#version 330 core
+
+uniform float amplitude;
+uniform float max_distance;
+uniform mat4 model;
+layout(std140, row_major) uniform FrameUniforms {
+    mat4 view;
+    mat4 rotation;
+    mat4 projection;
+    vec3 w_camera_position;
+    float timer;
+};
+
+// maps screen coordinates to view ray directions in world space
+uniform mat4 screen_to_ray;
+
+in vec3 position;
+
+out vec3 w_position;
+
+void main() {
+    // the water plane is the z=0 plane of the model frame
+    vec3 origin = vec3(model * vec4(0, 0, 0, 1));
+    vec3 normal = normalize(cross(vec3(model[0]), vec3(model[1])));
+
+    // view ray through the grid vertex
+    vec3 ray = normalize(vec3(screen_to_ray * vec4(position.xy, 1, 1)));
+
+    // intersection of the ray with the plane
+    float height = dot(w_camera_position - origin, normal);
+    float t = -height / dot(ray, normal);
+    w_position = w_camera_position + t * ray;
+
+    // rays that miss the plane or hit it too far away end on the horizon, at max_distance from the camera
+    vec3 horizontal = ray - dot(ray, normal) * normal;
+    if (t < 0 || t * length(horizontal) > max_distance) {
+        w_position = w_camera_position - height * normal + normalize(horizontal) * max_distance;
+    }
+
+    w_position.z += (sin(1 * w_position.x + timer) * cos(0.8 * w_position.y + timer) * amplitude);
+
+    gl_Position = projection * view * vec4(w_position, 1);
+}
@@ -0,0 +1,164 @@
+""" infinite ground streamed in square tiles around the camera """
+
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import OpenGL.GL as GL
+import numpy as np
+
+from core import Mesh, Node
+from grid import grid_positions, grid_coords, grid_index_buffer
+from noise import fractal_noise_2d
+from texture import Textured, Texture, TextureArray
+from assets import shared_texture
+from transform import translate, identity
+from utils import displacement_to_normal_map
+
+
+def generate_tile_maps(tile, tile_size, resolution, period, octaves, amplitude, seed):
+    """ displacement (float32) and normal (uint8) maps of one tile.
+        Samples lie on a world-space lattice, border samples are shared with
+        neighbouring tiles and the normals are computed with a one sample halo,
+        so both maps are seamless across tile borders. """
+    step = tile_size / (resolution - 1)
+    samples = np.arange(-1, resolution + 1) * step
+    xx, yy = np.meshgrid(tile[0] * tile_size + samples, tile[1] * tile_size + samples)
+
+    displacement = fractal_noise_2d(xx, yy, period, octaves, seed=seed).astype(np.float32) * amplitude
+    normals = displacement_to_normal_map(displacement, scale=1 / step)
+    return np.ascontiguousarray(displacement[1:-1, 1:-1]), np.ascontiguousarray(normals[1:-1, 1:-1])
+
+
+class StreamingGroundGPU(Node):
+    """ Infinite procedural ground: the world is split in square tiles of tileable fractal noise.
+        Tiles around the camera are generated by a worker pool, finished maps are handed over to the
+        GL thread through a queue and uploaded a few per frame. Uploaded tiles are kept in a bounded
+        LRU cache, least recently drawn tiles are evicted so memory stays flat on long runs.
+    """
+    static = False  # tiles come and go with the camera
+
+    def __init__(self, shader, tex_file, tile_size=128, resolution=129, radius=2, prefetch=1,
+                 cache_size=None, period=64, octaves=6, amplitude=20, seed=0,
+                 uploads_per_frame=2, executor=None):
+        super().__init__()
+        self.tile_size = tile_size
+        self.radius, self.prefetch = radius, prefetch
+        self.params = (tile_size, resolution, period, octaves, amplitude, seed)
+        self.uploads_per_frame = uploads_per_frame
+
+        # the cache must at least hold all tiles that are drawn at the same time
+        self.cache_size = cache_size or (2 * (radius + prefetch) + 1)**2
+        assert self.cache_size >= (2*radius + 1)**2, 'cache smaller than visible tiles'
+
+        # one mesh shared by all tiles, vertices one unit apart like the full resolution ground
+        n_vertices = tile_size + 1
+        positions = grid_positions(n_vertices, n_vertices, centered=False)
+
+        # map coordinates hit the texel centers of the tile maps, diffuse coordinates repeat an integer
+        # number of times per tile (roughly as often as on the original ground) to be continuous
+        coords = grid_coords(n_vertices, n_vertices) * n_vertices / tile_size
+        map_coords = (coords * (resolution - 1) + 0.5) / resolution
+        tex_coords = coords * max(1, round(tile_size * 50 / 1024))
+
+        # flat constant normals and tangents, real normals are given by the normal maps
+        normals = np.array((0, 0, 1), dtype=np.float32)
+        tangents = np.array((1, 0, 0), dtype=np.float32)
+
+        self.mesh = Mesh(shader, attributes={
+            "position": positions,
+            "tex_coord": tex_coords,
+            "map_coord": map_coords,
+            "normal": normals,
+            "tangent": tangents
+        }, uniforms={
+            "apply_displacement": 1,
+            "reflectiveness": 0,
+            "k_s": (0, 0, 0),
+            "apply_skinning": 0,
+            "apply_clipmap": 0,
+            "use_separate_map_coords": 1
+        }, index=grid_index_buffer(n_vertices, n_vertices, strip=True, compact=True),
+            primitives=GL.GL_TRIANGLE_STRIP)
+
+        # octaves of noise in [-1, 1] with halving amplitudes never add up to more than twice the amplitude
+        self.mesh.bounds[:, 2] = (-2 * amplitude, 2 * amplitude)
+        self.diffuse_map = shared_texture(tex_file, wrap_mode=GL.GL_REPEAT, mag_filter=GL.GL_NEAREST,
+                                          min_filter=GL.GL_NEAREST)
+        # normal maps of all tiles are layers of one texture array, evicted tiles release theirs
+        self.normal_maps = TextureArray(GL.GL_CLAMP_TO_EDGE, GL.GL_LINEAR, GL.GL_LINEAR)
+
+        self.executor = executor or ThreadPoolExecutor()
+        self.pending = {}               # tile -> future of tiles submitted to the workers
+        self.ready = queue.Queue()      # (tile, future) pairs of finished tiles
+        self.tiles = OrderedDict()      # LRU cache of uploaded tile nodes
+
+    def request(self, tile):
+        """ generate a tile in the background, unless it is cached or on its way """
+        if tile in self.tiles or tile in self.pending:
+            return
+        future = self.executor.submit(generate_tile_maps, tile, *self.params)
+        future.add_done_callback(lambda future, tile=tile: self.ready.put((tile, future)))
+        self.pending[tile] = future
+
+    def upload(self, tile, displacement, normals):
+        """ on the GL thread: create the textures and node of a generated tile """
+        displacement_map = Texture(displacement, GL.GL_CLAMP_TO_EDGE, GL.GL_LINEAR, GL.GL_LINEAR,
+            internal_format=GL.GL_R32F, format=GL.GL_RED, data_type=GL.GL_FLOAT)
+        normal_map = self.normal_maps.add(normals)
+        drawable = Textured(self.mesh, diffuse_map=self.diffuse_map,
+                            displacement_map=displacement_map, normal_map=normal_map)
+        offset = np.array(tile, np.float32) * self.tile_size
+        return Node([drawable], transform=translate(*offset, 0))
+
+    def update(self, camera):
+        """ request tiles around camera (ground coordinates), upload finished ones, evict old ones """
+        center = np.floor(np.asarray(camera[:2]) / self.tile_size).astype(int)
+        reach = self.radius + self.prefetch
+        around = sorted(((x, y) for x in range(center[0] - reach, center[0] + reach + 1)
+                                for y in range(center[1] - reach, center[1] + reach + 1)),
+                        key=lambda tile: max(abs(tile[0] - center[0]), abs(tile[1] - center[1])))
+        for tile in around:
+            self.request(tile)
+
+        # the camera moved on before these tiles were started, drop them
+        for tile in self.pending.keys() - set(around):
+            if self.pending[tile].cancel():
+                del self.pending[tile]
+
+        # a limited number of uploads per frame keeps the frame time smooth
+        for _ in range(self.uploads_per_frame):
+            try:
+                tile, future = self.ready.get_nowait()
+            except queue.Empty:
+                break
+            # cancelled tiles are no longer pending, and may have been requested again since
+            if self.pending.get(tile) is future:
+                del self.pending[tile]
+            if not future.cancelled():
+                self.tiles[tile] = self.upload(tile, *future.result())
+
+        # drawn tiles are the most recently used ones, evict the least recently used
+        visible = [tile for tile in around if tile in self.tiles
+                   and max(abs(tile[0] - center[0]), abs(tile[1] - center[1])) <= self.radius]
+        for tile in visible:
+            self.tiles.move_to_end(tile)
+        while len(self.tiles) > self.cache_size:
+            self.tiles.popitem(last=False)
+
+        children = [self.tiles[tile] for tile in visible]
+        if children != self.children:
+            self.children = children
+            Node.structure_changed()
+
+    def traverse(self, frame, visit, model=identity()):
+        """ stream tiles around the camera, then visit the visible ones """
+        camera = frame.uniforms.get('w_camera_position', (0, 0, 0, 1))
+        self.update(np.linalg.inv(self.update_world(model)) @ camera)
+        super().traverse(frame, visit, model)
+
+    def close(self):
+        """ stop the workers, dropping tiles that have not been generated yet, so that they do
+            not keep the process alive at exit. Called by Viewer.run once the window is closed """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        super().close()
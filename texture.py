@@ -1,15 +1,107 @@
 """ Taken from the TPs, but with additions/modifications """
 
+import hashlib                      # content address of image files
+
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
 from PIL import Image               # load texture maps
 import numpy as np
 
+from cache import ArrayCache, cache_key
+from profiler import count_upload
+
+MIPMAP_FORMAT = 1   # version of the cached mip levels, part of the cache key
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tga', '.bmp')
+
+# channels of cached images -> (internal format, format) of their textures,
+# two channels being octahedral normal maps, which are generated rather than read from files
+IMAGE_FORMATS = {1: (GL.GL_R8, GL.GL_RED), 2: (GL.GL_RG8, GL.GL_RG),
+                 3: (GL.GL_RGB8, GL.GL_RGB), 4: (GL.GL_RGBA8, GL.GL_RGBA)}
+
+# filters that sample mip levels
+MIPMAP_FILTERS = (GL.GL_NEAREST_MIPMAP_NEAREST, GL.GL_LINEAR_MIPMAP_NEAREST,
+                  GL.GL_NEAREST_MIPMAP_LINEAR, GL.GL_LINEAR_MIPMAP_LINEAR)
+
+# first texture unit of every texture target. Samplers of different types must never refer to the
+# same unit, even those a draw does not use and leaves on the unit of an earlier one, so every target
+# gets its own units and shader samplers start on the first unit of their target (see core.Shader)
+TEXTURE_UNITS = {GL.GL_TEXTURE_2D_ARRAY: 0, GL.GL_TEXTURE_2D: 8, GL.GL_TEXTURE_CUBE_MAP: 20}
+
+
+# -------------- Image decoding and texture cache -----------------------------
+def load_image(tex_file):
+    """ decoded (height, width, 4) RGBA array of an image file, needs no GL context """
+    return np.asarray(Image.open(tex_file).convert('RGBA'))
+
+
+def minimal_channels(image):
+    """ RGBA image with as few channels as sample the same: grey (1 channel, read as RGB
+        by the texture swizzle) and/or without alpha if it is fully opaque (3 channels) """
+    opaque = (image[..., 3] == 255).all()
+    grey = (image[..., 0] == image[..., 1]).all() and (image[..., 1] == image[..., 2]).all()
+    if opaque:
+        return image[..., :1] if grey else image[..., :3]
+    return image
+
+
+def halve(image, axis):
+    """ float image with half as many texels (rounded down) along axis, each the area weighted
+        mean of the texels it covers: two of them, or up to three for odd sizes """
+    size = image.shape[axis]
+    if size == 1:
+        return image
+    count = size // 2
+    if size % 2 == 0:
+        return (np.take(image, np.arange(0, size, 2), axis) + np.take(image, np.arange(1, size, 2), axis)) / 2
+
+    # texel i covers [i * ratio, (i + 1) * ratio) of the image, ratio being a bit more than 2
+    ratio = size / count
+    start = np.arange(count) * ratio
+    first = np.floor(start).astype(np.int64)
+    shape = [1] * image.ndim
+    shape[axis] = count
+    result = 0
+    for offset in range(3):
+        overlap = np.minimum(start + ratio, first + offset + 1) - np.maximum(start, first + offset)
+        weight = np.clip(overlap, 0, None) / ratio
+        result = result + np.take(image, np.minimum(first + offset, size - 1), axis) * weight.reshape(shape)
+    return result
+
+
+def mipmap_chain(image):
+    """ mip levels of a (height, width, channels) uint8 image down to 1x1, every level being
+        box filtered from the previous one, halving its size rounded down like OpenGL """
+    levels = [np.ascontiguousarray(image)]
+    while max(image.shape[:2]) > 1:
+        image = halve(halve(image.astype(np.float32), 0), 1)
+        image = np.floor(image + 0.5).astype(np.uint8)
+        levels.append(image)
+    return levels
+
+
+def load_mipmaps(tex_file, cache=None):
+    """ Mip levels of an image file in its minimal channel format, kept in the on-disk cache
+        (default ArrayCache unless cache is False) once decoded and filtered. Entries are
+        addressed by the content of the file, warm starts memory map the levels. """
+    if cache is False:
+        return mipmap_chain(minimal_channels(load_image(tex_file)))
+
+    cache = cache or ArrayCache()
+    with open(tex_file, 'rb') as file:
+        key = cache_key('texture', source=hashlib.sha1(file.read()).hexdigest(), format=MIPMAP_FORMAT)
+    levels = cache.get_or_create(key, lambda: {'level%02d' % i: level for i, level in
+                                               enumerate(mipmap_chain(minimal_channels(load_image(tex_file))))})
+    return [levels['level%02d' % i] for i in range(len(levels))]
+
 
 # -------------- OpenGL Texture Wrapper ---------------------------------------
+
+
 class Texture:
     """ Helper class to create and automatically destroy textures
         Modified to allow loading Texture from numpy array,
-        as well as textures of any internal format (e.g. single-channel textures)
+        as well as textures of any internal format (e.g. single-channel textures).
+        Image files are uploaded from the texture cache (see load_mipmaps), as are the
+        mip levels of one given as a list, in their own format rather than the given one.
     """
     def __init__(self, tex_file, wrap_mode=GL.GL_REPEAT,
                  mag_filter=GL.GL_LINEAR, min_filter=GL.GL_LINEAR_MIPMAP_LINEAR,
@@ -17,32 +109,47 @@ class Texture:
                  data_type=GL.GL_UNSIGNED_BYTE):
         self.glid = GL.glGenTextures(1)
         self.type = tex_type
+        self.format = format
 
-        if type(tex_file) is np.ndarray:
-            tex_bytes = tex_file.tobytes()
+        if isinstance(tex_file, np.ndarray):
+            # arrays (e.g. memory mapped from the cache) are uploaded without an intermediate copy
+            levels = [np.ascontiguousarray(tex_file)]
             tex_string = str(type(tex_file))
 
-            height, width = tex_file.shape[:2]
-
         else:
             try:
-                # imports image as a numpy array in exactly right format
-                tex = Image.open(tex_file).convert('RGBA')
-                tex_bytes = tex.tobytes()
-                tex_string = tex_file
-
-                width, height = tex.width, tex.height
+                # images are decoded and their mip levels computed once, then memory mapped
+                levels = tex_file if isinstance(tex_file, list) else load_mipmaps(tex_file)
+                tex_string = '%d mip levels' % len(levels) if isinstance(tex_file, list) else tex_file
             except FileNotFoundError:
                 print("ERROR: unable to load texture file %s" % tex_file)
+            internal_format, format = IMAGE_FORMATS[levels[0].shape[2]]
+            data_type = GL.GL_UNSIGNED_BYTE
+            self.format = format
+
+            # only the levels sampled by the filter are uploaded
+            if min_filter not in MIPMAP_FILTERS:
+                levels = levels[:1]
 
+        height, width = levels[0].shape[:2]
         GL.glBindTexture(tex_type, self.glid)
-        GL.glTexImage2D(tex_type, 0, internal_format, width, height,
-                        0, format, data_type, tex_bytes)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)  # rows of any width, e.g. odd sized RGB maps
+        for level, data in enumerate(levels):
+            GL.glTexImage2D(tex_type, level, internal_format, data.shape[1], data.shape[0],
+                            0, format, data_type, np.ascontiguousarray(data))
+            count_upload('texture', data.nbytes)
         GL.glTexParameteri(tex_type, GL.GL_TEXTURE_WRAP_S, wrap_mode)
         GL.glTexParameteri(tex_type, GL.GL_TEXTURE_WRAP_T, wrap_mode)
         GL.glTexParameteri(tex_type, GL.GL_TEXTURE_MIN_FILTER, min_filter)
         GL.glTexParameteri(tex_type, GL.GL_TEXTURE_MAG_FILTER, mag_filter)
-        GL.glGenerateMipmap(tex_type)
+        if isinstance(tex_file, np.ndarray):
+            GL.glGenerateMipmap(tex_type)
+        else:
+            GL.glTexParameteri(tex_type, GL.GL_TEXTURE_MAX_LEVEL, len(levels) - 1)
+            if format == GL.GL_RED:
+                # grey images are sampled as RGB like they were before dropping channels
+                GL.glTexParameteriv(tex_type, GL.GL_TEXTURE_SWIZZLE_RGBA,
+                                    np.array([GL.GL_RED, GL.GL_RED, GL.GL_RED, GL.GL_ONE], np.int32))
         print(f'Loaded texture {tex_string} ({width}x{height}'
                 f' wrap={str(wrap_mode).split()[0]}'
                 f' min={str(min_filter).split()[0]}'
@@ -72,7 +179,8 @@ class CubeMap:
         for i, face in enumerate(cube):
             width, height = face.shape[:2]
             GL.glTexImage2D(GL.GL_TEXTURE_CUBE_MAP_POSITIVE_X + i, 0, GL.GL_RGB, width, height, 0,
-                GL.GL_RGB, GL.GL_UNSIGNED_BYTE, face.tobytes())
+                GL.GL_RGB, GL.GL_UNSIGNED_BYTE, np.ascontiguousarray(face))
+            count_upload('texture', face.nbytes)
 
         GL.glTexParameteri(tex_type, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP_TO_EDGE)
         GL.glTexParameteri(tex_type, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP_TO_EDGE)
@@ -93,6 +201,130 @@ class CubeMap:
         GL.glDeleteTextures(self.glid)
 
 
+# -------------- Texture arrays -----------------------------------------------
+def copy_layers(source, target, sizes, count):
+    """ copy the first count layers of every mip level, of (width, height) sizes, from one texture
+        array to another on the GPU: with glCopyImageSubData (OpenGL 4.3 or ARB_copy_image), or
+        else by blitting every layer between framebuffers, restoring the bound framebuffers """
+    if bool(GL.glCopyImageSubData):
+        for level, (width, height) in enumerate(sizes):
+            GL.glCopyImageSubData(source, GL.GL_TEXTURE_2D_ARRAY, level, 0, 0, 0,
+                                  target, GL.GL_TEXTURE_2D_ARRAY, level, 0, 0, 0, width, height, count)
+        return
+
+    bound = [GL.glGetIntegerv(binding) for binding in (GL.GL_READ_FRAMEBUFFER_BINDING, GL.GL_DRAW_FRAMEBUFFER_BINDING)]
+    framebuffers = GL.glGenFramebuffers(2)
+    GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, framebuffers[0])
+    GL.glBindFramebuffer(GL.GL_DRAW_FRAMEBUFFER, framebuffers[1])
+    for level, (width, height) in enumerate(sizes):
+        for layer in range(count):
+            GL.glFramebufferTextureLayer(GL.GL_READ_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0, source, level, layer)
+            GL.glFramebufferTextureLayer(GL.GL_DRAW_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0, target, level, layer)
+            GL.glBlitFramebuffer(0, 0, width, height, 0, 0, width, height, GL.GL_COLOR_BUFFER_BIT, GL.GL_NEAREST)
+    GL.glBindFramebuffer(GL.GL_READ_FRAMEBUFFER, bound[0])
+    GL.glBindFramebuffer(GL.GL_DRAW_FRAMEBUFFER, bound[1])
+    GL.glDeleteFramebuffers(2, framebuffers)
+
+
+class TextureArray:
+    """ Images of the same size and format stored as the layers of one GL_TEXTURE_2D_ARRAY,
+        e.g. the diffuse, normal and specular maps of several materials: drawing them binds
+        a single texture, every map being selected by a layer index uniform (see Textured).
+        Layers are added as mip level lists (see load_mipmaps) or uint8 arrays, whose mip
+        levels are computed if the filter samples them, and only live on the GPU once added.
+        The storage grows as needed, keeping its glid, and the slots of released layers are reused.
+    """
+    def __init__(self, wrap_mode=GL.GL_REPEAT, mag_filter=GL.GL_LINEAR,
+                 min_filter=GL.GL_LINEAR_MIPMAP_LINEAR, capacity=1):
+        self.glid = GL.glGenTextures(1)
+        self.type = GL.GL_TEXTURE_2D_ARRAY
+        self.min_filter = min_filter
+        self.capacity = capacity
+        self.used = []          # whether every layer slot holds an image
+        self.shape, self.format, self.sizes = None, None, None
+
+        GL.glBindTexture(self.type, self.glid)
+        GL.glTexParameteri(self.type, GL.GL_TEXTURE_WRAP_S, wrap_mode)
+        GL.glTexParameteri(self.type, GL.GL_TEXTURE_WRAP_T, wrap_mode)
+        GL.glTexParameteri(self.type, GL.GL_TEXTURE_MIN_FILTER, min_filter)
+        GL.glTexParameteri(self.type, GL.GL_TEXTURE_MAG_FILTER, mag_filter)
+
+    def add(self, image):
+        """ upload an image as a new layer, returns its TextureLayer """
+        mipmaps = self.min_filter in MIPMAP_FILTERS
+        if isinstance(image, np.ndarray):
+            image = mipmap_chain(image) if mipmaps else [image]
+        levels = image if mipmaps else image[:1]
+        if self.shape is None:
+            self.shape = levels[0].shape
+            self.sizes = [(level.shape[1], level.shape[0]) for level in levels]
+            self.allocate(self.capacity)
+        assert levels[0].shape == self.shape, 'layer of shape %s in an array of %s' % (levels[0].shape, self.shape)
+
+        layer = next((i for i, used in enumerate(self.used) if not used), len(self.used))
+        if layer >= self.capacity:
+            self.allocate(2 * self.capacity)
+        self.used[layer:layer + 1] = [True]
+        self.upload(layer, levels)
+        return TextureLayer(self, layer)
+
+    def allocate(self, capacity):
+        """ create storage for capacity layers. Layers already uploaded are copied to a temporary
+            array and back into the new storage on the GPU, so that the glid stays the same """
+        count, self.capacity = min(len(self.used), self.capacity), capacity
+        internal_format, self.format = IMAGE_FORMATS[self.shape[2]]
+        if count:
+            copy = GL.glGenTextures(1)
+            self.storage(copy, internal_format, count)
+            copy_layers(self.glid, copy, self.sizes, count)
+        self.storage(self.glid, internal_format, capacity)
+        if count:
+            copy_layers(copy, self.glid, self.sizes, count)
+            GL.glDeleteTextures([copy])
+
+        GL.glBindTexture(self.type, self.glid)
+        GL.glTexParameteri(self.type, GL.GL_TEXTURE_MAX_LEVEL, len(self.sizes) - 1)
+        if self.format == GL.GL_RED:
+            # grey images are sampled as RGB, like single textures
+            GL.glTexParameteriv(self.type, GL.GL_TEXTURE_SWIZZLE_RGBA,
+                                np.array([GL.GL_RED, GL.GL_RED, GL.GL_RED, GL.GL_ONE], np.int32))
+        print('Allocated texture array of %d %dx%d layers, %d levels' % (capacity, *self.sizes[0], len(self.sizes)))
+
+    def storage(self, glid, internal_format, capacity):
+        """ (re)define every mip level of texture glid for capacity layers """
+        GL.glBindTexture(self.type, glid)
+        for level, (width, height) in enumerate(self.sizes):
+            GL.glTexImage3D(self.type, level, internal_format, width, height, capacity,
+                            0, self.format, GL.GL_UNSIGNED_BYTE, None)
+        GL.glTexParameteri(self.type, GL.GL_TEXTURE_MAX_LEVEL, len(self.sizes) - 1)
+
+    def upload(self, layer, levels):
+        GL.glBindTexture(self.type, self.glid)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        for level, data in enumerate(levels):
+            GL.glTexSubImage3D(self.type, level, 0, 0, layer, data.shape[1], data.shape[0], 1,
+                               self.format, GL.GL_UNSIGNED_BYTE, np.ascontiguousarray(data))
+            count_upload('texture', data.nbytes)
+
+    def release(self, layer):
+        """ free the slot of a layer for the next one added """
+        self.used[layer] = False
+
+    def __del__(self):
+        GL.glDeleteTextures(self.glid)
+
+
+class TextureLayer:
+    """ Layer of a TextureArray, used like a texture: binding it binds its array, whose
+        layer index Textured passes to the shader. Its slot is released with it. """
+    def __init__(self, array, layer):
+        self.array, self.layer = array, layer
+        self.glid, self.type, self.format = array.glid, array.type, array.format
+
+    def __del__(self):
+        self.array.release(self.layer)
+
+
 # -------------- Textured mesh decorator --------------------------------------
 class Textured:
     """ Drawable mesh decorator that activates and binds OpenGL textures """
@@ -100,9 +332,33 @@ class Textured:
         self.drawable = drawable
         self.textures = textures
 
-    def draw(self, primitives=GL.GL_TRIANGLES, **uniforms):
-        for index, (name, texture) in enumerate(self.textures.items()):
-            GL.glActiveTexture(GL.GL_TEXTURE0 + index)
-            GL.glBindTexture(texture.type, texture.glid)
-            uniforms[name] = index
-        self.drawable.draw(primitives=primitives, **uniforms)
+        # two channel normal maps hold octahedral encoded normals
+        normal_map = textures.get('normal_map')
+        self.octahedral_normals = int(getattr(normal_map, 'format', None) == GL.GL_RG)
+
+    def draw(self, frame, model, primitives=None, **uniforms):
+        # every texture is bound once, to the next unit of its target. The samplers of the maps it
+        # holds (layers of one array) refer to that unit, with the layer of theirs as <name>_layer
+        units, counts = {}, {}
+        for name, texture in self.textures.items():
+            unit = units.get(texture.glid)
+            if unit is None:
+                count = counts.get(texture.type, 0)
+                unit = units[texture.glid] = TEXTURE_UNITS[texture.type] + count
+                counts[texture.type] = count + 1
+                frame.state.bind_texture(unit, texture)
+            uniforms[name] = unit
+            if isinstance(texture, TextureLayer):
+                uniforms[name + '_layer'] = texture.layer
+        uniforms['octahedral_normals'] = self.octahedral_normals
+        self.drawable.draw(frame, model, primitives, **uniforms)
+
+    @property
+    def bounds(self):
+        """ bounding box of the decorated drawable """
+        return getattr(self.drawable, 'bounds', None)
+
+    @property
+    def static(self):
+        """ whether the decorated drawable never changes, see Node.is_static """
+        return getattr(self.drawable, 'static', True)
@@ -117,6 +117,68 @@ def lookat(eye, target, up):
     return rotation @ translate(-eye)
 
 
+# Axis aligned bounding boxes and view frustum culling -----------------------
+# a box is a 2x3 array (min corner, max corner), None stands for unbounded
+def bounding_box(points):
+    """ bounding box of an array of 2d or 3d points, missing coordinates are 0 """
+    points = np.asarray(points, 'f')
+    points = points.reshape(-1, points.shape[-1])
+    box = np.zeros((2, 3), 'f')
+    box[:, :points.shape[1]] = points.min(axis=0), points.max(axis=0)
+    return box
+
+
+def transform_box(matrix, box):
+    """ bounding box of 'box' transformed by an affine 4x4 matrix,
+        or (..., 2, 3) boxes for a stack of (..., 4, 4) matrices """
+    center, extent = (box[0] + box[1]) / 2, (box[1] - box[0]) / 2
+    center = matrix[..., :3, :3] @ center + matrix[..., :3, 3]
+    extent = np.abs(matrix[..., :3, :3]) @ extent
+    return np.stack((center - extent, center + extent), axis=-2)
+
+
+def union_box(boxes):
+    """ bounding box of several boxes, None if one of them is unbounded """
+    boxes = list(boxes)
+    if not boxes or any(box is None for box in boxes):
+        return None
+    boxes = np.array(boxes).reshape(-1, 2, 3)
+    return np.array((boxes[:, 0].min(axis=0), boxes[:, 1].max(axis=0)))
+
+
+class Frustum:
+    """ View frustum planes of a projection @ view matrix, used to cull boxes
+        given in world coordinates """
+    def __init__(self, matrix):
+        rows = np.asarray(matrix, 'd')
+        planes = np.array([rows[3] + rows[0], rows[3] - rows[0],    # left, right
+                           rows[3] + rows[1], rows[3] - rows[1],    # bottom, top
+                           rows[3] + rows[2], rows[3] - rows[2]])   # near, far
+
+        # far plane vanishes in float precision when far/near is huge, it is then ignored
+        norms = np.linalg.norm(planes[:, :3], axis=1)
+        planes = planes[norms > 0] / norms[norms > 0, None]
+        self.normals, self.offsets = planes[:, :3], planes[:, 3]
+        self.abs_normals = np.abs(self.normals)
+
+    def classify(self, box):
+        """ -1 if box is entirely outside of the frustum, 1 if it is entirely inside,
+            0 if it intersects the frustum border or is unbounded """
+        if box is None:
+            return 0
+
+        # signed distances of the box center to the planes, against the box extent along the normals
+        distances = self.normals @ ((box[0] + box[1]) / 2) + self.offsets
+        radii = self.abs_normals @ ((box[1] - box[0]) / 2)
+        if (distances < -radii).any():
+            return -1
+        return 1 if (distances >= radii).all() else 0
+
+    def intersects(self, box):
+        """ False if box is entirely outside of the frustum, True if unbounded """
+        return self.classify(box) >= 0
+
+
 # quaternion functions -------------------------------------------------------
 def quaternion(x=vec(0., 0., 0.), y=0.0, z=0.0, w=1.0):
     """ Init quaternion, w=real and, x,y,z or vector x imaginary components """
@@ -1,6 +1,7 @@
 """ general utility functions """
 
 import os
+import hashlib
 
 import numpy as np
 from skimage import filters
@@ -8,6 +9,11 @@ from PIL import Image
 
 import matplotlib.pyplot as plt
 
+from cache import ArrayCache, cache_key
+
+# file names of the faces of a cube map directory, in the order of the cube map targets
+CUBE_FACES = ("right", "left", "top", "bottom", "back", "front")
+
 def np_float_to_gl_ubyte(array):
     """ converts a np array of floats to the 8-bit float format used in the GPU """
     return ((array + 1) * 127).astype(np.ubyte)
@@ -19,28 +25,73 @@ def gradient_image(img):
 
     return gx, gy
 
-def displacement_to_normal_map(displacement_map, scale=1):
-    """ generates a normal map from a displacement map """
-    normal_map = np.ones((*displacement_map.shape, 3), dtype=np.float32)
+def np_octahedral_encode(normals):
+    """ octahedral encoding of unit normals (..., 3) into two components in [-1, 1] """
+    encoded = normals[..., :2] / np.abs(normals).sum(axis=-1, keepdims=True)
+    lower = normals[..., 2] < 0
+    encoded[lower] = (1 - np.abs(encoded[lower][:, ::-1])) * np.where(encoded[lower] >= 0, 1, -1)
+    return encoded
+
+def displacement_to_normal_map(displacement_map, scale=1, out=None, band_rows=256, octahedral=False):
+    """ generates a normal map from a displacement map.
+        The map is processed in bands of rows with a one pixel halo, so that the peak memory use
+        depends on band_rows and not on the map size; displacement_map and the optional out array
+        can be memory mapped. The result is a uint8 (H, W, 3) map, or a (H, W, 2) map of
+        octahedral encoded normals if octahedral is set.
+    """
+    height, width = displacement_map.shape
+    if out is None:
+        out = np.empty((height, width, 2 if octahedral else 3), dtype=np.ubyte)
+
+    for start in range(0, height, band_rows):
+        stop = min(start + band_rows, height)
+
+        # band with its halo rows, the filters reflect at the real map borders only
+        first, last = max(start - 1, 0), min(stop + 1, height)
+        band = np.asarray(displacement_map[first:last])
+        rows = slice(start - first, start - first + stop - start)
+
+        normal_map = np.ones((stop - start, width, 3), dtype=np.float32)
 
-    # gradient in x and y direction
-    gx, gy = gradient_image(displacement_map)
+        # gradient in x and y direction
+        gx, gy = gradient_image(band)
 
-    # optionally apply scaling factor since we didn't "divide by epsilon" in the gradient computation
-    normal_map[:, :, 0] = gx * scale
-    normal_map[:, :, 1] = gy * scale
-    
-    # normalize normals
-    normal_map /= np.linalg.norm(normal_map, axis=2, ord=2)[:, :, None]
+        # optionally apply scaling factor since we didn't "divide by epsilon" in the gradient computation
+        normal_map[:, :, 0] = gx[rows] * scale
+        normal_map[:, :, 1] = gy[rows] * scale
 
-    # return in 8-bit format
-    return np_float_to_gl_ubyte(normal_map)
+        # normalize normals
+        normal_map /= np.linalg.norm(normal_map, axis=2, ord=2)[:, :, None]
 
+        # store in 8-bit format
+        if octahedral:
+            normal_map = np_octahedral_encode(normal_map)
+        out[start:stop] = np_float_to_gl_ubyte(normal_map)
 
-def load_cubemap_from_directory(path, format="png", correct_rotation=False):
+    return out
+
+
+def load_cubemap_from_directory(path, format="png", correct_rotation=False, cache=None):
     """ load cubemap from directory.
         Directory must contains images with names "left", "right", "top", "bottom", "back", "front" + ".format"
+        The decoded faces are kept in the on-disk cache (default ArrayCache unless cache is False),
+        addressed by the content of the files, so that warm starts memory map them.
     """
+    if cache is False:
+        return _load_cubemap_from_directory(path, format, correct_rotation)
+
+    cache = cache or ArrayCache()
+    digest = hashlib.sha1()
+    for face in CUBE_FACES:
+        with open(os.path.join(path, face + "." + format), "rb") as file:
+            digest.update(file.read())
+    key = cache_key('cubemap', source=digest.hexdigest(), correct_rotation=correct_rotation)
+    faces = cache.get_or_create(key, lambda: dict(zip(CUBE_FACES, _load_cubemap_from_directory(
+        path, format, correct_rotation))))
+    return tuple(faces[face] for face in CUBE_FACES)
+
+
+def _load_cubemap_from_directory(path, format, correct_rotation):
     right = np.array(Image.open(os.path.join(path, "right." + format)).convert("RGB"))
     left = np.array(Image.open(os.path.join(path, "left." + format)).convert("RGB"))
     top = np.array(Image.open(os.path.join(path, "top." + format)).convert("RGB"))
@@ -1,13 +1,27 @@
 #!/usr/bin/env python3
+import argparse
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# PyOpenGL picks its platform when imported, offscreen contexts need EGL (or OSMesa) instead of GLX
+if '--headless' in sys.argv:
+    os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+
 import OpenGL.GL as GL              # standard Python OpenGL wrapper
 import glfw                         # lean window system wrapper for OpenGL
 import numpy as np                  # all matrix manipulations & OpenGL args
-from core import Shader, Viewer, Mesh, Node, load
-from texture import CubeMap, Texture
+from core import Shader, Viewer, Mesh, Node, load, load_scene, build_nodes, scene_textures
+from texture import CubeMap
+from assets import shared_texture, decode_textures
+from loader import Loader, Deferred, load_now
 from transform import Trackball, translate, rotate, scale
-from procedural import ProceduralGroundGPU, ProceduralWaterGPU
+from procedural import ProceduralGroundGPU, ClipmapGroundGPU, ProceduralWaterGPU, ProjectedWaterGPU, generate_ground_maps
+from terrain import StreamingGroundGPU
 from utils import load_cubemap_from_directory
 from primitives import Skybox, Bridge
+from instancing import Instanced
 
 
 class Axis(Mesh):
@@ -19,8 +33,8 @@ class Axis(Mesh):
 
         GL.glClearColor(0.8, 0.8, 0.8, 1)
 
-    def draw(self, primitives=GL.GL_LINES, **uniforms):
-        super().draw(primitives=primitives, **uniforms)
+    def draw(self, frame, model, primitives=GL.GL_LINES, **uniforms):
+        super().draw(frame, model, primitives, **uniforms)
 
 class FixedCameraViewer(Viewer):
     """ Viewer class with camera movement keyhandlers removed. """
@@ -31,48 +45,142 @@ class FixedCameraViewer(Viewer):
         pass
 
 # -------------- main program and scene setup --------------------------------
-def main():
-    """ create a window, add scene objects, then run rendering loop """
+@contextmanager
+def timed(phases, name):
+    """ measure the time spent in the block, in seconds, into phases[name] if phases is given """
+    start = time.perf_counter()
+    yield
+    if phases is not None:
+        phases[name] = time.perf_counter() - start
 
-    # initial camera position/orientation
-    trackball = Trackball(pitch=0, roll=75, yaw=90, distance=10)
 
-    #viewer = FixedCameraViewer(trackball=trackball, width=1920, height=1080)
-    viewer = Viewer(trackball=trackball, width=1920, height=1080)
+# files of the spider model and of its specular map, which is not part of the model file
+SPIDER_FILE = "assets/FantasyCharacters/Spider/Spider_Idle.fbx"
+SPIDER_SPECULAR_MAP = "assets/FantasyCharacters/Spider/texture/Spider_specular.png"
+
+# default water_size of every water mode: vertices per side of the sheet, or (columns, rows) of the projected grid
+WATER_SIZES = {'sheet': 500, 'projected': (320, 180)}
+
+
+def build_scene(viewer, grid_size=1024, water_size=None, crowd_size=1, phases=None, loader=None,
+                ground='clipmap', water='projected'):
+    """ add the scene objects to the viewer. The sizes of the ground, water grid and spider
+        crowd (a single spider by default, none if 0) can be changed, e.g. to benchmark how
+        they scale. The ground is a clipmap of grid_size, a full resolution grid of grid_size if 'full',
+        or infinite and streamed around the camera if 'streaming'. The water is a grid projected
+        from the screen, or a fixed sheet if 'sheet', see WATER_SIZES for the meaning of water_size. The time
+        spent in every loading phase is measured into the optional phases dict.
+        With a loader (see loader.py), files are read and maps generated in the background
+        and objects appear as they arrive, otherwise everything is loaded before returning """
+    submit = loader.submit if loader else load_now
 
     # environment is a cube map that should be available to all shaders
     # --> Viewer class has been modified to allow for that
-    environment = CubeMap(load_cubemap_from_directory("textures/interstellar", format="tga", correct_rotation=False))
-    viewer.set_environment(environment)
+    # it is black until the skybox faces are loaded
+    with timed(phases, 'environment'):
+        def environment_faces():
+            # cached faces are memory mapped, read them here rather than while uploading
+            return [np.array(face) for face in load_cubemap_from_directory("textures/interstellar", format="tga")]
+
+        viewer.set_environment(CubeMap([np.zeros((1, 1, 3), np.uint8)] * 6))
+        submit(environment_faces, lambda faces: viewer.set_environment(CubeMap(faces)))
 
     # different sets of shaders for different types of objects
-    shader = Shader("shaders/texture.vert", "shaders/texture.frag")
-    shader_axes = Shader("shaders/axes.vert", "shaders/axes.frag")
-    shader_skybox = Shader("shaders/skybox.vert", "shaders/skybox.frag")
-    shader_water = Shader("shaders/water.vert", "shaders/water.frag")
+    with timed(phases, 'shaders'):
+        shader = Shader("shaders/texture.vert", "shaders/texture.frag")
+        shader_axes = Shader("shaders/axes.vert", "shaders/axes.frag")
+        shader_skybox = Shader("shaders/skybox.vert", "shaders/skybox.frag")
+        shader_water = Shader("shaders/water.vert" if water == 'sheet' else "shaders/water_projected.vert",
+                              "shaders/water.frag")
+
+    # the ground uses displacement mapping with perlin noise,
+    # drawn as a geometry clipmap with less detail further away from the camera, or as a full resolution grid.
+    # the seed makes the maps reproducible, they are generated once and then read from the on-disk cache.
+    # the streaming ground instead generates tiles of tileable noise around the camera on its own workers
+    with timed(phases, 'ground'):
+        if ground == 'streaming':
+            ground_node = Node([StreamingGroundGPU(shader, "textures/grass.png", amplitude=20, seed=0)],
+                               transform=translate(z=-20))
+        else:
+            perlin_size = max(1, grid_size // 64)
 
-    # the ground uses displacement mapping with perlin noise
-    ground = ProceduralGroundGPU(shader, "textures/grass.png", grid_size=1024, perlin_size=(16, 16), amplitude=20)
-    ground_node = Node([ground], transform=translate(z=-20))
+            def ground_maps():
+                grass, = decode_textures("textures/grass.png")
+                # cached maps are memory mapped, read them here rather than while uploading
+                return grass, [np.array(map_) for map_ in generate_ground_maps(
+                    grid_size, (perlin_size, perlin_size), amplitude=20, seed=0)]
 
-    # the water uses a wave function in the vertex shader
-    water = ProceduralWaterGPU(shader_water, 500, 500, amplitude=0.5)
-    water_node = Node([water], transform=translate(z=-3))
+            ground_type = ProceduralGroundGPU if ground == 'full' else ClipmapGroundGPU
+            procedural_ground = Deferred()
+            submit(ground_maps, lambda loaded: procedural_ground.resolve(ground_type(
+                shader, loaded[0], grid_size=grid_size, perlin_size=(perlin_size, perlin_size),
+                amplitude=20, seed=0, maps=loaded[1])))
+            ground_node = Node([procedural_ground], transform=translate(z=-20))
+
+    # the water uses a wave function in the vertex shader, on a screen-space grid projected
+    # onto the water plane so that its cost does not depend on its size, or on a fixed sheet
+    with timed(phases, 'water'):
+        water_size = water_size or WATER_SIZES[water]
+        if water == 'sheet':
+            water_surface = ProceduralWaterGPU(shader_water, 500, water_size, amplitude=0.5)
+        else:
+            water_surface = ProjectedWaterGPU(shader_water, *water_size, amplitude=0.5)
+        water_node = Node([water_surface], transform=translate(z=-3))
 
     # water is a child of ground --> hierarchical modelling: check
     ground_node.add(water_node)
 
     # the bridge is a textured box
-    bridge = Bridge(shader, "textures/bridge/diffuse.jpg", "textures/bridge/normal.jpg", "textures/bridge/specular.jpg")
-    bridge_node = Node([bridge])
+    with timed(phases, 'bridge'):
+        bridge_node = Deferred()
+        submit(decode_textures, lambda maps: bridge_node.resolve(Bridge(shader, *maps)),
+               "textures/bridge/diffuse.jpg", "textures/bridge/normal.jpg", "textures/bridge/specular.jpg")
+
+    # skybox
+    skybox = Skybox(shader_skybox)
+
+    # the render queue draws the skybox first such that everything else is drawn in front of it
+    viewer.add(skybox)
+
+    viewer.add(bridge_node)
+    if crowd_size:
+        with timed(phases, 'spider'):
+            spiders = Deferred()
+            submit(load_spider, lambda loaded: upload_spiders(spiders, shader, crowd_size, *loaded))
+            viewer.add(spiders)
+
+    # the semi-transparent water is drawn last by the render queue
+    viewer.add(ground_node)
+
+    #viewer.add(Axis(shader_axes, length=10))
+
+
+def load_spider():
+    """ imported spider model read in memory, and its decoded textures """
+    scene = {name: np.array(array) for name, array in load_scene(SPIDER_FILE).items()}
+    return scene, decode_textures(*scene_textures(scene), SPIDER_SPECULAR_MAP)
+
+
+def upload_spiders(node, shader, crowd_size, scene, images):
+    """ upload the decoded spider textures, one per loader step, then add the spiders to node """
+    textures = []   # kept alive until the spider uses them, see TextureRegistry
+    for image in images:
+        textures.append(shared_texture(image))
+        yield
+    node.resolve(build_spiders(shader, crowd_size, scene))
+
+
+def build_spiders(shader, crowd_size, scene=None, seed=0):
+    """ node of the animated spider on the bridge and crowd_size - 1 copies of it, placed and
+        tinted at random from seed so that the same crowd is built on every run,
+        from the imported spider model if given, see load_spider """
 
     # the spider is loaded from a file
-    spider = load("assets/FantasyCharacters/Spider/Spider_Idle.fbx", shader)
+    spider = load(SPIDER_FILE, shader) if scene is None else build_nodes(scene, shader)
 
-    # it gets a specular map as an additional texture,
-    # which needs to be bound manually since it is not assigned to the model at creation time
-    spider_spec_map = Texture("assets/FantasyCharacters/Spider/texture/Spider_specular.png")
-    spider_spec_map.bind(GL.GL_TEXTURE21)
+    # it gets a specular map as an additional texture, since it is not assigned to the model at creation time.
+    # like the other maps, it is bound by the Textured decorator of the mesh
+    spider_spec_map = shared_texture(SPIDER_SPECULAR_MAP)
     spider[0].children[0].children[0].mesh.textures["specular_map"] = spider_spec_map
 
     # set uniforms required by the shader that are not part of the fbx file
@@ -81,24 +189,62 @@ def main():
     spider[0].children[0].children[0].mesh.drawable.uniforms["k_s"] = (0.8, 1, 0.8)
     spider[0].children[0].children[0].mesh.drawable.uniforms["apply_skinning"] = 1
     spider[0].children[0].children[0].mesh.drawable.uniforms["apply_displacement"] = 0
+    spider[0].children[0].children[0].mesh.drawable.uniforms["apply_clipmap"] = 0
     spider[0].children[0].children[0].mesh.drawable.uniforms["use_separate_map_coords"] = 0
 
     # lastly place the spider on top of the bridge
     spider_node = Node(spider, transform=translate(z=0.1) @ scale(0.025) @ rotate((0, 0, 1), -90) @ rotate((1, 0, 0), 90))
 
-    # skybox
-    skybox = Skybox(shader_skybox)
+    # a single spider is drawn as it is
+    if crowd_size == 1:
+        return spider_node
 
-    # skybox is added first such that everything else is drawn in front of it
-    viewer.add(skybox)
+    # a crowd of spiders along the bridge, copies of the loaded one drawn in a single instanced draw call.
+    # every spider gets its own position, heading and tint, the first one stays where it was
+    rng = np.random.default_rng(seed)
+    crowd = [translate(x, y, 0) @ rotate((0, 0, 1), heading) for x, y, heading in
+             zip(rng.uniform(-40, 40, crowd_size), rng.uniform(-1.5, 1.5, crowd_size), rng.uniform(0, 360, crowd_size))]
+    crowd[0] = np.identity(4)
+    tints = rng.uniform(0.6, 1, (crowd_size, 3))
+    tints[0] = 1
+    spider_mesh_node = spider[0].children[0]
+    spider_mesh_node.children[0] = Instanced(spider_mesh_node.children[0], crowd, tints)
+    return spider_node
 
-    viewer.add(bridge_node)
-    viewer.add(spider_node)
 
-    # ground is added last such that the semi-transparent water is drawn last
-    viewer.add(ground_node)
+def main():
+    """ create a window, add scene objects, then run rendering loop.
+        With --headless, render a fixed number of frames offscreen instead """
+    parser = argparse.ArgumentParser(description='3D graphics project viewer')
+    parser.add_argument('--headless', action='store_true', help='render offscreen, without a window')
+    parser.add_argument('--frames', type=int, default=60, help='number of headless frames')
+    parser.add_argument('--fps', type=float, default=30, help='frame rate of the headless clock')
+    parser.add_argument('--size', type=int, nargs=2, default=(1920, 1080), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--output', default='frames/%04d.png', help='file name pattern of headless frames')
+    parser.add_argument('--crowd-size', type=int, default=1,
+                        help='number of spiders, copies of the first one drawn as instances')
+    parser.add_argument('--ground', choices=('clipmap', 'full', 'streaming'), default='clipmap',
+                        help='clipmap or full resolution grid of a fixed size ground, '
+                             'or infinite ground streamed in tiles')
+    parser.add_argument('--water', choices=('projected', 'sheet'), default='projected',
+                        help='grid projected from the screen onto the water plane, or fixed sheet of water')
+    args = parser.parse_args()
 
-    #viewer.add(Axis(shader_axes, length=10))
+    # initial camera position/orientation
+    trackball = Trackball(pitch=0, roll=75, yaw=90, distance=10)
+
+    #viewer = FixedCameraViewer(trackball=trackball, width=1920, height=1080)
+    viewer = Viewer(*args.size, trackball=trackball, headless=args.headless)
+
+    # the window shows up right away, objects appear as they are loaded
+    viewer.loader = Loader()
+    build_scene(viewer, crowd_size=args.crowd_size, loader=viewer.loader, ground=args.ground, water=args.water)
+
+    if args.headless:
+        viewer.loader.finish()
+        viewer.render(args.frames, args.fps, output=args.output)
+        viewer.close()
+        return
 
     # print controls
     print("=====================================")
@@ -107,6 +253,7 @@ def main():
     print("Left Click + Drag:   Rotate camera")
     print("Right Click + Drag:  Pan camera")
     print("W:                   Toggle fill mode")
+    print("P:                   Toggle profiler, saved to profile.json")
     print("Esc:                 Quit")
     print("=====================================")
     